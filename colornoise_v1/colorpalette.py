@@ -94,28 +94,26 @@ class ColorPicker:
 
     def rgb2sml(self, rgb):
         """
-        Transfrom from rgb to sml.
+        Transfrom from rgb to sml. Accepts a single triplet or an array of triplets in shape (N, 3).
 
         """
+        rgb = np.asarray(rgb, dtype=float)[..., :3]
         if self.depthBits == 8:
-            rgb = (rgb[0] % 256, rgb[1] % 256, rgb[2] % 256)
-            c = np.array(rgb)
+            c = rgb % 256
         elif self.depthBits == 10:
-            c = (np.array(rgb) + 1) / 2 * 1023  # rescaling [0, 1] into [-1,1] as Psychopy requires in colorSpace 'rgb'
+            c = (rgb + 1) / 2 * 1023  # rescaling [0, 1] into [-1,1] as Psychopy requires in colorSpace 'rgb'
         else:
             raise ValueError
-        if len(c) > 3:
-            c = np.resize(c, 3)
-        return np.squeeze(np.asarray(np.dot(self.A, np.power(c, self.Gamma)))) + self.A0
+        return np.dot(np.power(c, self.Gamma), self.A.T) + self.A0
 
     def sml2rgb(self, sml):
         """
-        Transfrom from sml to rgb.
+        Transfrom from sml to rgb. Accepts a single triplet or an array of triplets in shape (N, 3).
         """
         InvA = np.linalg.pinv(np.around(self.A, decimals=10))  # compute the inverse A
 
-        c = np.array(sml)
-        rgb = np.power(np.abs(np.squeeze(np.asarray(np.dot(InvA, (c - self.A0))))), 1 / self.Gamma)
+        c = np.asarray(sml, dtype=float)
+        rgb = np.power(np.abs(np.dot(c - self.A0, InvA.T)), 1 / self.Gamma)
         if self.depthBits == 8:
             if rgb.any() > 255:
                 sys.exit("transformed values are out of range!")
@@ -149,12 +147,14 @@ class ColorPicker:
         c = (vertex8 + vertex1) * gray_level
         return np.array(c)
 
-    def newcolor(self, theta, iris=True):
-        """
-        Generate any new color sml and rgb values based on a hue angle - can have subjective adjustment.
+    def isoslant_dlum(self, theta):
         """
+        Luminance deviation of the subjective iso-luminance plane for an array of hue angles.
 
-        sub_dlum = 0
+        :param theta:   hue angles
+        :return:        luminance deviations in the same shape as theta; zeros if no adjustment is requested
+        """
+        sub_dlum = np.zeros(np.shape(theta))
         isoslant_file = 0
 
         if self.subject is not None:
@@ -174,7 +174,6 @@ class ColorPicker:
                             # correct the calculation as it in iris-tool:
                             sub_dlum += iso_dl * (np.cos(theta) * np.cos(iso_phi) +
                                                   np.sin(theta) * np.sin(iso_phi))
-                            # print(str(theta) + ': ' + str(sub_dlum))
             if isoslant_file < 1:
                 warnings.warn("No isoslant file is found for this subject.")
             if isoslant_file > 1:
@@ -182,27 +181,49 @@ class ColorPicker:
         else:
             warnings.warn("No subjective adjustment is requested.")
 
-        sub_gray = self.center(gray_level=self.gray_level + sub_dlum)
+        return sub_dlum
+
+    def newcolors(self, thetas, iris=True):
+        """
+        Generate sml and rgb values for an array of hue angles in one pass - can have subjective adjustment.
+
+        :param thetas:  N hue angles
+        :param iris:    use the transformation of iris-tool[default]
+        :return:        sml values in shape (N, 3), rgb values in shape (N, 3)
+        """
+        theta = np.atleast_1d(np.asarray(thetas, dtype=float))
+        sub_dlum = self.isoslant_dlum(theta)
+
+        # the gray point is linear in the gray level, so all subjective gray points are scaled copies of one vertex sum
+        sub_gray = np.outer(self.gray_level + sub_dlum, self.center(gray_level=1))
 
         if self.unit != 'rad':
             theta = theta * 2 * np.pi / 360
 
-        lmratio = 1 * sub_gray[2] / sub_gray[1]  # this ratio can be adjusted
+        lmratio = 1 * sub_gray[:, 2] / sub_gray[:, 1]  # this ratio can be adjusted
 
         if iris is True:
             # TODO: discuss and understand the transformation used in iris-tool dkl::iso_lum
-            sml = [sub_gray[0] * (1.0 + self.sscale * self.c * np.sin(theta)),
-                   sub_gray[1] * (1.0 - self.c / (1.0 + 1 / lmratio) * np.cos(theta)),
-                   sub_gray[2] * (1.0 + self.c / (1.0 + lmratio) * np.cos(theta))]
+            sml = np.column_stack([sub_gray[:, 0] * (1.0 + self.sscale * self.c * np.sin(theta)),
+                                   sub_gray[:, 1] * (1.0 - self.c / (1.0 + 1 / lmratio) * np.cos(theta)),
+                                   sub_gray[:, 2] * (1.0 + self.c / (1.0 + lmratio) * np.cos(theta))])
         else:
-            sml = [sub_gray[0] * (1.0 + self.sscale * self.c * np.sin(theta)),
-                   sub_gray[1] * (1.0 + self.c * np.cos(theta) * (1.0 - lmratio)),
-                   sub_gray[2] * (1.0 + self.c * np.cos(theta) * (1.0 - 1 / lmratio))]
+            sml = np.column_stack([sub_gray[:, 0] * (1.0 + self.sscale * self.c * np.sin(theta)),
+                                   sub_gray[:, 1] * (1.0 + self.c * np.cos(theta) * (1.0 - lmratio)),
+                                   sub_gray[:, 2] * (1.0 + self.c * np.cos(theta) * (1.0 - 1 / lmratio))])
 
         rgb = self.sml2rgb(sml)
 
         return sml, rgb
 
+    def newcolor(self, theta, iris=True):
+        """
+        Generate any new color sml and rgb values based on a hue angle - can have subjective adjustment.
+        """
+        sml, rgb = self.newcolors([theta], iris=iris)
+
+        return sml[0], rgb[0]
+
     def gencolorlist(self, hue_res):
         """
         Generate colors that are realizable in a 10-bit display and save them in a color list.
@@ -215,8 +236,7 @@ class ColorPicker:
             sys.exit("The current depthBits is NOT 10-bit!")
 
         theta = np.linspace(0, 360 - hue_res, int(360 / hue_res))
-        convt = [self.newcolor(theta=x) for x in theta]
-        rgb = [x[1] for x in convt]
+        rgb = list(self.newcolors(theta)[1])
         rgb_res = 1 / 2 ** 10  # resolution of 10bit in [0, 1] scale
         selrgb = []
         seltheta = []
@@ -258,13 +278,7 @@ class ColorPicker:
 
         """
         theta = np.linspace(0, 2 * np.pi, numStim, endpoint=False)
-
-        Msml = []
-        Mrgb = []
-        for t in theta:
-            sml, rgb = self.newcolor(theta=t)
-            Msml.append(sml)
-            Mrgb.append(rgb)
+        Msml, Mrgb = self.newcolors(theta)
 
         return Msml, Mrgb
 
@@ -25,6 +25,7 @@ def run_scrsaver(depthBits):
     win = visual.Window(fullscr=True, mouseVisible=False, bpc=(depthBits, depthBits, depthBits), depthBits=depthBits,
                         monitor=mon)
     kb = keyboard.Keyboard()
+    cp = ColorPicker(depthBits=depthBits, unit='deg')
 
     if depthBits == 8:
         colorSpace = 'rgb255'
@@ -40,8 +41,7 @@ def run_scrsaver(depthBits):
         rect.xys = [(x, y) for x in np.linspace(-1, 1, num, endpoint=False) + 1 / num for y in
                     np.linspace(-1, 1, num, endpoint=False) + 1 / num]
 
-        rect.colors = [ColorPicker(depthBits=depthBits, unit='deg').newcolor(theta=x)[1] for x in
-                       np.random.randint(0, high=360, size=num ** 2)]
+        rect.colors = cp.newcolors(np.random.randint(0, high=360, size=num ** 2))[1]
         rect.draw()
         win.mouseVisible = False
         win.flip()
@@ -5,6 +5,9 @@ Created on 16.09.20
 
 Adapted from Psychopy.data.FitCumNormal
 
+Chance and lapse rate are passed to the model explicitly instead of through module globals, so that fits can run
+concurrently. Many conditions can be fitted at once in a process pool with fit_batch.
+
 @author yannan
 """
 from __future__ import absolute_import, division, print_function
@@ -52,16 +55,18 @@ class _baseFunctionFit(object):
         from scipy import optimize
         # don't import optimize at top of script. Slow and not always present!
 
-        global _chance
-        global _lapse
-        _chance = self.expectedMin
-        _lapse = self.lapse
+        def evalFunction(xx, *params):
+            return self._eval(xx, *params, chance=self.expectedMin, lapse=self.lapse)
+
         if len(self.sems) == 1:
             sems = None
         else:
             sems = self.sems
+        guess = self.guess
+        if guess is None:
+            guess = np.ones(self._nParams)  # the default of curve_fit
         self.params, self.covar = optimize.curve_fit(
-            self._eval, self.xx, self.yy, p0=self.guess, sigma=sems,
+            evalFunction, self.xx, self.yy, p0=guess, sigma=sems,
             **self.optimize_kws)
         self.ssq = self._getErr(self.params, self.xx, self.yy, 1.0)
         self.chi = self._getErr(self.params, self.xx, self.yy, self.sems)
@@ -78,14 +83,10 @@ class _baseFunctionFit(object):
         """
         if params is None:
             params = self.params
-        global _chance
-        global _lapse
-        _chance = self.expectedMin
-        _lapse = self.lapse
         # _eval is a static method - must be done this way because the
         # curve_fit function doesn't want to have any `self` object as
         # first arg
-        yy = self._eval(xx, *params)
+        yy = self._eval(xx, *params, chance=self.expectedMin, lapse=self.lapse)
         return yy
 
     def inverse(self, yy, params=None):
@@ -95,7 +96,7 @@ class _baseFunctionFit(object):
         if params is None:
             # so the user can set params for this particular inv
             params = self.params
-        xx = self._inverse(yy, *params)
+        xx = self._inverse(yy, *params, chance=self.expectedMin, lapse=self.lapse)
         return xx
 
 
@@ -123,27 +124,57 @@ class FitCumNormal(_baseFunctionFit):
 
     """
 
+    _nParams = 2  # xShift, sd
+
     # static methods have no `self` and this is important for
     # optimise.curve_fit
     @staticmethod
-    def _eval(xx, xShift, sd):
+    def _eval(xx, xShift, sd, chance, lapse):
         from scipy import special
-        global _chance
-        global _lpase
         xx = np.asarray(xx)
         # NB np.special.erf() goes from -1:1
-        yy = (_chance + (1 - _chance - _lapse) *
+        yy = (chance + (1 - chance - lapse) *
               ((special.erf((xx - xShift) / (np.sqrt(2) * sd)) + 1) * 0.5))
         return yy
 
     @staticmethod
-    def _inverse(yy, xShift, sd):
+    def _inverse(yy, xShift, sd, chance, lapse):
         from scipy import special
-        global _chance
-        global _lpase
         yy = np.asarray(yy)
         # xx = (special.erfinv((yy-chance)/(1-chance)*2.0-1)+xShift)/xScale
         # NB: np.special.erfinv() goes from -1:1
         xx = (xShift + np.sqrt(2) * sd *
-              special.erfinv(((yy - _chance) / (1 - _chance - _lapse) - 0.5) * 2))
+              special.erfinv(((yy - chance) / (1 - chance - lapse) - 0.5) * 2))
         return xx
+
+
+def _fit_one(args):
+    xx, yy, sems, kwargs = args
+    return FitCumNormal(xx, yy, sems=sems, **kwargs)
+
+
+def fit_batch(data, processes=None, min_per_process=50, **kwargs):
+    """Fit cumulative normals to many conditions (hues, subjects) at once,
+    in a pool of processes. Fits do not share any state, so the results are
+    the same as of fitting the conditions one by one.
+
+    On platforms which spawn processes (Windows, macOS), call it under
+    `if __name__ == '__main__':` in scripts.
+
+    :param data:            list of (xx, yy, sems) of all conditions
+    :param processes:       number of processes, default: number of CPUs; 1 fits in this process
+    :param min_per_process: conditions per process at least, fewer conditions are fitted in this process
+    :param kwargs:          arguments of FitCumNormal for all conditions, e.g. expectedMin, lapse, guess
+    :return:                a list of FitCumNormal, in the order of data
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import os
+
+    jobs = [(xx, yy, sems, kwargs) for xx, yy, sems in data]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(jobs) // min_per_process)
+    if processes <= 1:
+        return [_fit_one(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(_fit_one, jobs, chunksize=-(-len(jobs) // (4 * processes))))
@@ -0,0 +1,388 @@
+# !/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+Maximum-likelihood fitting of cumulative normal psychometric functions to single trials (Bernoulli likelihood),
+instead of least squares on binned proportions as FitCumNormal.
+
+    p(correct) = guess + (1 - guess - lapse) * Phi((x - centre) / sd)
+
+All conditions (e.g. 16 hue labels, or thousands of bootstrap replicates) are fitted at once by Fisher scoring with
+analytic gradients, vectorized over conditions, from several starts, since the likelihood has local minima;
+lapse and guess rates can be fixed or fitted per condition. check_mle refits them with scipy to check them.
+Confidence intervals come from bootstrap_mle, which refits many resampled data sets at once, in a pool of processes.
+
+Main functions: fit_mle, bootstrap_mle, check_mle
+
+Check the fits of a subject in bash:
+    python3.7 FitCumNormalMLE.py fschrader --xrl_path data/fschrader/fschrader.xrl
+
+@author yannan
+"""
+import numpy as np
+from scipy import special
+from FitCumNormal import FitCumNormal
+
+
+class FitCumNormalMLE(object):
+    """Result of fit_mle for one condition, with the interface of FitCumNormal:
+    fit.params ([centre, sd]), fit.covar, fit.eval(x), fit.inverse(y).
+
+    fit.expectedMin and fit.lapse are the fixed or fitted guess and lapse
+    rates; fit.free lists the fitted parameters in the order of fit.covar;
+    fit.nll is the negative log-likelihood of the trials.
+    """
+
+    def __init__(self, xx, yy, params, expectedMin, lapse, covar, free, nll):
+        self.xx = np.asarray(xx)
+        self.yy = np.asarray(yy)
+        self.params = np.asarray(params)
+        self.expectedMin = expectedMin
+        self.lapse = lapse
+        self.covar = covar
+        self.free = free
+        self.nll = nll
+
+    def eval(self, xx, params=None):
+        if params is None:
+            params = self.params
+        return FitCumNormal._eval(xx, *params, chance=self.expectedMin, lapse=self.lapse)
+
+    def inverse(self, yy, params=None):
+        if params is None:
+            params = self.params
+        return FitCumNormal._inverse(yy, *params, chance=self.expectedMin, lapse=self.lapse)
+
+
+def _likelihood(theta, xx, yy, cond, free, fixed, nll_only=False):
+    """Negative log-likelihood of every condition, with its gradient and Fisher information.
+
+    :param theta:       (conditions, len(free)) parameters
+    :param xx:          intensities of all trials
+    :param yy:          responses of all trials, 0 or 1
+    :param cond:        condition index of all trials
+    :param free:        names of the fitted parameters, 'centre', 'sd' and optionally 'lapse', 'guess'
+    :param fixed:       values of the parameters which are not fitted
+    :param nll_only:    return only the negative log-likelihood
+    :return:            nll (conditions,), gradient (conditions, len(free)), information (conditions, len(free),
+                        len(free))
+    """
+    n = len(theta)
+    par = dict(fixed)
+    par.update({name: theta[:, idx] for idx, name in enumerate(free)})
+    centre, sd, lapse, guess = (np.broadcast_to(par[name], (n,))[cond] for name in ['centre', 'sd', 'lapse', 'guess'])
+
+    z = (xx - centre) / sd
+    cum = 0.5 * (special.erf(z / np.sqrt(2)) + 1)
+    scale = 1 - guess - lapse
+    p = np.clip(guess + scale * cum, 1e-12, 1 - 1e-12)
+    nll = -np.bincount(cond, weights=yy * np.log(p) + (1 - yy) * np.log(1 - p), minlength=n)
+    if nll_only:
+        return nll
+
+    # d p / d parameters; d nll / d p; and the Fisher information of Bernoulli trials, sum of dp dp / p(1-p)
+    dp = {'centre': -scale * np.exp(-z ** 2 / 2) / np.sqrt(2 * np.pi) / sd}
+    dp['sd'] = dp['centre'] * z
+    dp['lapse'] = -cum
+    dp['guess'] = 1 - cum
+    dnll_dp = -(yy / p - (1 - yy) / (1 - p))
+    weight = 1 / (p * (1 - p))
+    grad = np.stack([np.bincount(cond, weights=dnll_dp * dp[name], minlength=n) for name in free], axis=1)
+    info = np.empty((n, len(free), len(free)))
+    for i, a in enumerate(free):
+        for j, b in enumerate(free[i:], i):
+            info[:, i, j] = info[:, j, i] = np.bincount(cond, weights=weight * dp[a] * dp[b], minlength=n)
+    return nll, grad, info
+
+
+def _active(args, active):
+    """Trials of the active conditions only, with conditions renumbered.
+
+    :param args:    xx, yy, cond, free, fixed, see _likelihood
+    :param active:  boolean mask of the conditions
+    """
+    xx, yy, cond, free, fixed = args
+    trials = active[cond]
+    renumber = np.cumsum(active) - 1
+    return xx[trials], yy[trials], renumber[cond[trials]], free, fixed
+
+
+def _scoring(theta, lower, upper, args, tol=1e-9, maxiter=500):
+    """Minimize the negative log-likelihood of every condition by Fisher scoring with Levenberg-Marquardt damping,
+    all conditions at once; converged conditions drop out.
+
+    Steps are taken in (centre, log(sd), rates) and scaled as a whole into a trust region (two sd in the centre, a
+    factor e in sd, 0.05 in rates), so that they stay descent directions, and shortened to stay within the bounds.
+    Parameters at their bounds are held while the gradient or the step points outwards. A step which does not
+    lower the negative log-likelihood raises the damping. A condition has converged when its Newton decrement, the
+    decrease predicted by the undamped step at the held bounds, is below tol.
+
+    :param theta:   (conditions, parameters) starting values
+    :param lower:   lower bounds of the parameters
+    :param upper:   upper bounds of the parameters
+    :param args:    xx, yy, cond, free, fixed, see _likelihood
+    :param tol:     predicted decrease of the negative log-likelihood of a condition at convergence
+    :param maxiter: maximal number of iterations
+    :return:        fitted parameters
+    """
+    theta = np.clip(theta, lower, upper)
+    n, k = theta.shape
+    damping = np.full(n, 1e-3)
+    done = np.zeros(n, dtype=bool)
+    diag_idx = np.arange(k)
+
+    def solve(info, grad, held, lam):
+        system = info * ~(held[:, :, None] | held[:, None, :])
+        system[:, diag_idx, diag_idx] = np.where(held, 1, np.einsum('nii->ni', info) * (1 + lam[:, None]) + 1e-12)
+        return -np.linalg.solve(system, np.where(held, 0, grad)[:, :, None])[:, :, 0]
+
+    for it in range(maxiter):
+        active = ~done
+        sub_args = _active(args, active) if done.any() else args
+        current, lam = theta[active], damping[active]
+        nll, grad, info = _likelihood(current, *sub_args)
+
+        # in log(sd)
+        sd = current[:, 1]
+        grad[:, 1] *= sd
+        info[:, 1, :] *= sd[:, None]
+        info[:, :, 1] *= sd[:, None]
+        at_lower, at_upper = current <= lower + 1e-10, current >= upper - 1e-10  # steps shortened to a bound
+        held = (at_lower & (grad > 0)) | (at_upper & (grad < 0))
+        newton = solve(info, grad, held, np.full_like(lam, 1e-8))  # barely damped, rates may be collinear
+        step = solve(info, grad, held, lam)
+        outwards = (at_lower & (step < 0)) | (at_upper & (step > 0))
+        if outwards.any():  # hold these as well, the step would leave the bounds right away
+            held |= outwards
+            newton = solve(info, grad, held, np.full_like(lam, 1e-8))
+            step = solve(info, grad, held, lam)
+        decrement = -np.sum(np.where(held, 0, grad) * newton, axis=1) / 2
+
+        # scale the whole step into the trust region, and shorten it to the bounds (log(sd) has none)
+        radius = np.column_stack([2 * sd, np.ones(len(sd))] + [np.full(len(sd), 0.05)] * (k - 2))
+        step /= np.maximum(1, np.max(np.abs(step) / radius, axis=1))[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            room = np.where(step < 0, (lower - current) / step, np.where(step > 0, (upper - current) / step, np.inf))
+        room[:, 1] = np.inf
+        step *= np.clip(np.min(room, axis=1), 0, 1)[:, None]
+        trial = current + step
+        trial[:, 1] = sd * np.exp(step[:, 1])
+        trial = np.clip(trial, lower, upper)
+        trial_nll = _likelihood(trial, *sub_args, nll_only=True)
+
+        better = trial_nll < nll
+        current[better] = trial[better]
+        theta[active] = current
+        damping[active] = np.where(better, np.maximum(lam / 10, 1e-8), lam * 10)
+        done[active] = (decrement < tol) | (lam > 1e12)  # the latter if no step lowers it within precision
+        if done.all():
+            break
+    return theta
+
+
+def fit_mle(data, expectedMin=0.5, lapse=0.01, fit_lapse=False, fit_guess=False, max_lapse=0.1, start=None):
+    """Fit cumulative normals to the single trials of many conditions at once, by maximum likelihood.
+
+    :param data:        list of (xx, yy) of all conditions: intensities and responses (0 or 1) of single trials
+    :param expectedMin: guess rate (chance level), fixed unless fit_guess; starting value otherwise
+    :param lapse:       lapse rate, fixed unless fit_lapse; starting value otherwise
+    :param fit_lapse:   fit the lapse rate per condition, within [0, max_lapse]
+    :param fit_guess:   fit the guess rate per condition, within [0, 0.5]
+    :param max_lapse:   upper bound of fitted lapse rates
+    :param start:       starting [centre, sd] for all or each condition, default: the best fit from the mean and
+                        std, and a quarter of the std, of the intensities (and half of max_lapse if fit_lapse)
+    :return:            a list of FitCumNormalMLE, in the order of data
+    """
+    n = len(data)
+    if n == 0:
+        return []
+    xx = np.concatenate([np.asarray(x, dtype=float) for x, y in data])
+    yy = np.concatenate([np.asarray(y, dtype=float) for x, y in data])
+    cond = np.repeat(np.arange(n), [len(x) for x, y in data])
+
+    free = ['centre', 'sd'] + ['lapse'] * fit_lapse + ['guess'] * fit_guess
+    fixed = {'lapse': lapse, 'guess': expectedMin}
+
+    if start is None:  # the likelihood has local minima, e.g. of flat curves, so try steeper ones as well
+        counts = np.bincount(cond, minlength=n)
+        mean = np.bincount(cond, weights=xx, minlength=n) / counts
+        var = np.bincount(cond, weights=(xx - mean[cond]) ** 2, minlength=n) / counts
+        sd = np.maximum(np.sqrt(var), 0.1)
+        starts = [np.column_stack([mean, sd]), np.column_stack([mean, sd / 4])]
+    else:
+        starts = [np.broadcast_to(start, (n, 2))]
+    rates = [{'lapse': lapse, 'guess': expectedMin}]
+    lower, upper = [-np.inf, 1e-3], [np.inf, np.inf]
+    if fit_lapse:
+        lower.append(0)
+        upper.append(max_lapse)
+        if start is None:
+            rates.append({'lapse': max_lapse / 2, 'guess': expectedMin})
+    if fit_guess:
+        lower.append(0)
+        upper.append(0.5)
+
+    args = (xx, yy, cond, free, fixed)
+    theta, nll = None, None
+    for centre_sd in starts:
+        for rate in rates:
+            theta0 = np.column_stack([centre_sd] + [np.full(n, rate[name]) for name in free[2:]])
+            if len(free) > 2:  # centre and sd first, at the starting rates
+                theta0[:, :2] = _scoring(theta0[:, :2], np.array(lower[:2]), np.array(upper[:2]),
+                                         (xx, yy, cond, free[:2], dict(fixed, **rate)))
+            fit = _scoring(theta0, np.array(lower), np.array(upper), args)
+            fit_nll = _likelihood(fit, *args, nll_only=True)
+            if theta is None:
+                theta, nll = fit, fit_nll
+            else:
+                better = fit_nll < nll
+                theta[better], nll[better] = fit[better], fit_nll[better]
+
+    # covariance from the Fisher information of the single trials
+    nll, grad, info = _likelihood(theta, *args)
+    fits = []
+    for idx, (x, y) in enumerate(data):
+        try:
+            covar = np.linalg.inv(info[idx])
+        except np.linalg.LinAlgError:
+            covar = np.full(info[idx].shape, np.inf)
+        par = dict(zip(free, theta[idx]))
+        fits.append(FitCumNormalMLE(x, y, theta[idx, :2], par.get('guess', expectedMin), par.get('lapse', lapse),
+                                    covar, free, nll[idx]))
+    return fits
+
+
+def param_stats(centre, sd, guess, lapse, thresh_level=0.75, pse_level=None):
+    """Threshold, PSE, sd and slope of psychometric functions, element-wise for arrays of parameters.
+
+    :param thresh_level:    response level of the threshold
+    :param pse_level:       response level of the PSE, default: the midpoint of the function, i.e. the centre
+    :return:                a dictionary with 'thresh', 'pse', 'sd' and 'slope' (at the centre)
+    """
+    stats = {'thresh': FitCumNormal._inverse(thresh_level, centre, sd, guess, lapse),
+             'pse': centre if pse_level is None else FitCumNormal._inverse(pse_level, centre, sd, guess, lapse),
+             'sd': sd,
+             'slope': (1 - guess - lapse) / (np.sqrt(2 * np.pi) * sd)}
+    return {k: np.asarray(v, dtype=float) for k, v in stats.items()}
+
+
+def _boot_chunk(args):
+    """Resample all conditions n_boot times and refit them in one call of fit_mle.
+
+    :return: (n_boot, conditions, 4) array of centre, sd, guess and lapse
+    """
+    data, fits, method, seed, n_boot, kwargs = args
+    rng = np.random.default_rng(seed)
+    resampled = []
+    for rep in range(n_boot):
+        for (xx, yy), (centre, sd, guess, lapse) in zip(data, fits):
+            if method == 'parametric':
+                p = FitCumNormal._eval(xx, centre, sd, chance=guess, lapse=lapse)
+                resampled.append((xx, (rng.random(len(xx)) < p).astype(float)))
+            else:
+                idx = rng.integers(len(xx), size=len(xx))
+                resampled.append((xx[idx], yy[idx]))
+    refits = fit_mle(resampled, start=np.tile(fits[:, :2], (n_boot, 1)), **kwargs)
+    return np.array([[f.params[0], f.params[1], f.expectedMin, f.lapse] for f in refits]).reshape(n_boot, len(data), 4)
+
+
+def bootstrap_mle(data, n_boot=2000, method='parametric', seed=0, processes=None, chunk=50, **kwargs):
+    """Bootstrap the maximum-likelihood fits of many conditions.
+
+    Trials are resampled per condition, either from the fitted functions at the tested intensities (parametric)
+    or with replacement from the trials (nonparametric). Chunks of replicates are refitted with fit_mle in a pool
+    of processes; every chunk has its own seed derived from seed, so the results do not depend on processes.
+
+    On platforms which spawn processes (Windows, macOS), call it under
+    `if __name__ == '__main__':` in scripts.
+
+    :param data:        list of (xx, yy) of all conditions, as for fit_mle
+    :param n_boot:      number of bootstrap replicates
+    :param method:      'parametric' or 'nonparametric'
+    :param seed:        seed of the resampling
+    :param processes:   number of processes, default: number of CPUs; 1 runs in this process
+    :param chunk:       replicates refitted together in one job
+    :param kwargs:      arguments of fit_mle, e.g. expectedMin, lapse, fit_lapse
+    :return:            the fits of the data (list of FitCumNormalMLE), and a (n_boot, conditions, 4) array of
+                        centre, sd, guess and lapse of the replicates
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import os
+
+    if method not in ['parametric', 'nonparametric']:
+        raise ValueError("method should be 'parametric' or 'nonparametric'!")
+    data = [(np.asarray(xx, dtype=float), np.asarray(yy, dtype=float)) for xx, yy in data]
+    fits = fit_mle(data, **kwargs)
+    fitted = np.array([[f.params[0], f.params[1], f.expectedMin, f.lapse] for f in fits])
+
+    sizes = [min(chunk, n_boot - start) for start in range(0, n_boot, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [(data, fitted, method, s, n, kwargs) for s, n in zip(seeds, sizes)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(jobs))
+    if processes <= 1:
+        samples = [_boot_chunk(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            samples = list(pool.map(_boot_chunk, jobs))
+    return fits, np.concatenate(samples)
+
+
+def check_mle(data, fits, max_lapse=0.1):
+    """Refit every condition with scipy.optimize.minimize (L-BFGS-B), from its fit, to check that it is a minimum.
+
+    :param data:        list of (xx, yy) of all conditions, as for fit_mle
+    :param fits:        their fits by fit_mle
+    :param max_lapse:   upper bound of fitted lapse rates, as for fit_mle
+    :return:            decrease of the negative log-likelihood by the refit of each condition, about 0 at minima
+    """
+    from scipy.optimize import minimize
+
+    bounds = {'centre': (None, None), 'sd': (1e-3, None), 'lapse': (0, max_lapse), 'guess': (0, 0.5)}
+    decrease = []
+    for (xx, yy), fit in zip(data, fits):
+        xx, yy = np.asarray(xx, dtype=float), np.asarray(yy, dtype=float)
+        args = (xx, yy, np.zeros(len(xx), dtype=int), fit.free, {'lapse': fit.lapse, 'guess': fit.expectedMin})
+        theta = [dict(centre=fit.params[0], sd=fit.params[1], lapse=fit.lapse, guess=fit.expectedMin)[name]
+                 for name in fit.free]
+
+        def nll(par):
+            value, grad, info = _likelihood(par[None, :], *args)
+            return value[0], grad[0]
+
+        refit = minimize(nll, theta, jac=True, method='L-BFGS-B', bounds=[bounds[name] for name in fit.free])
+        decrease.append(fit.nll - refit.fun)
+    return np.array(decrease)
+
+
+"""example"""
+
+# simulate 16 hues with 300 trials each and fit them with a free lapse rate
+# rng = np.random.default_rng(0)
+# true = FitCumNormal._eval
+# data = [(x, rng.random(300) < true(x, 1.5, 0.8, chance=0.5, lapse=0.02))
+#         for x in rng.uniform(0, 5, (16, 300))]
+# fits = fit_mle(data, fit_lapse=True)
+# print([f.params for f in fits], [f.lapse for f in fits])
+# fits, samples = bootstrap_mle(data, n_boot=1000)
+# thresh = param_stats(*np.moveaxis(samples, -1, 0))['thresh']
+# print(np.nanpercentile(thresh, [2.5, 97.5], axis=0))
+
+""" check the fits of a subject against scipy in bash """
+if __name__ == '__main__':
+    import argparse
+    from exploredata import ExploreData
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sub')
+    parser.add_argument('--xrl_path', default=None)
+    args = parser.parse_args()
+    explorer = ExploreData(args.sub, xrl_path=args.xrl_path)
+    for fit_lapse, fit_guess in [(True, False), (False, True)]:
+        ntrial, res = explorer._fitmle(fit_lapse=fit_lapse, fit_guess=fit_guess)
+        fits = [r['fit'] for r in res.values()]
+        decrease = check_mle([(r['intensities'], r['responses']) for r in res.values()], fits)
+        print('fit_lapse={}, fit_guess={}:'.format(fit_lapse, fit_guess))
+        for label, fit, d in zip(res, fits, decrease):
+            print('  {}: centre {:.3f}, sd {:.3f}, guess {:.3f}, lapse {:.3f}, nll {:.3f}, scipy lower by {:.2g}'
+                  .format(label, *fit.params, fit.expectedMin, fit.lapse, fit.nll, d))
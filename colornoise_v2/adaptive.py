@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# python version 3.7.6
+
+"""
+This module contains the QUEST and Psi procedures of the sessions, with the semantics of PsychoPy's QuestHandler and
+PsiHandler (v2020.1) but fast posterior updates:
+    QuestPosterior  - the QUEST pdf in log domain, updated in place from a precomputed log-likelihood table
+    PsiPosterior    - the Psi posterior over (alpha, beta), updated in place; the next intensity is chosen from
+                      precomputed likelihood and response-entropy tables, which are shared by all handlers with the
+                      same grid
+    QuestHandler, PsiHandler - subclasses of PsychoPy's handlers using them, for make_stairs
+
+PsychoPy's PsiObject recomputes the posterior and its entropy for every intensity and response after each trial,
+about 0.3 s with the grid of the sessions. The expected entropy of the posterior after a trial at x is, up to a
+constant,
+    - sum_l w(l) T(l, x) + P(1|x) log P(1|x) + P(0|x) log P(0|x),  T = p1 log p1 + p0 log p0
+with the posterior w and the psychometric function p1(l, x) = P(1|l, x), so a trial costs one pass over the tables.
+The update time of every trial is kept in the handlers (update_times, in sec).
+
+Compare with PsychoPy in Python3.7:
+    bench_updates(n_trials)
+Or in bash:
+    python3.7 adaptive.py [optional n_trials]
+
+@author: yannansu
+"""
+
+import math
+import time
+import warnings
+import argparse
+import numpy as np
+from scipy import special
+from psychopy import data
+
+_TABLES = {}  # Psi tables, by grid
+
+
+class QuestPosterior:
+    def __init__(self, tGuess, tGuessSd, pThreshold, beta, delta, gamma, grain=0.01, range=None):
+        """
+        QUEST posterior over the threshold, as psychopy.contrib.quest.QuestObject (Weibull psychometric function).
+
+        :param tGuess:      prior threshold estimate
+        :param tGuessSd:    sd of the prior
+        :param pThreshold:  threshold criterion, probability of response 1
+        :param beta:        steepness of the Weibull function
+        :param delta:       fraction of blind responses
+        :param gamma:       probability of response 1 at intensity -inf
+        :param grain:       quantization of the tables
+        :param range:       intensity range of the pdf, centred on tGuess; default 500 * grain
+        """
+        grain = float(grain)
+        if range is None:
+            dim = 500
+        else:
+            if range <= 0:
+                raise ValueError('argument "range" must be greater than zero.')
+            dim = 2 * math.ceil(range / grain / 2.0)
+        if gamma > pThreshold:
+            warnings.warn('reducing gamma from %.2f to 0.5' % gamma)
+            gamma = 0.5
+        self.tGuess = tGuess
+        self.tGuessSd = tGuessSd
+        self.pThreshold = pThreshold
+        self.beta = beta
+        self.delta = delta
+        self.gamma = gamma
+        self.grain = grain
+        self.dim = dim
+
+        self.i = np.arange(-dim / 2, dim / 2 + 1)
+        self.x = self.i * grain
+        self.x2 = np.arange(-dim, dim + 1) * grain
+        p2 = self._weibull(0.0)
+        if p2[0] >= pThreshold or p2[-1] <= pThreshold:
+            raise RuntimeError('psychometric function range [%.2f %.2f] omits %.2f threshold'
+                               % (p2[0], p2[-1], pThreshold))
+        index = np.nonzero(p2[1:] - p2[:-1])[0]  # strictly monotonic subset
+        self.xThreshold = np.interp(pThreshold, p2[index], self.x2[index])
+        self.p2 = self._weibull(self.xThreshold)
+        with np.errstate(divide='ignore'):
+            self.log_s2 = np.log(np.array([(1 - self.p2)[::-1], self.p2[::-1]]))  # log-likelihood table
+
+        eps = 1e-14
+        pL, pH = self.p2[0], self.p2[-1]
+        pE = pH * math.log(pH + eps) - pL * math.log(pL + eps) + (1 - pH + eps) * math.log(1 - pH + eps) - \
+            (1 - pL + eps) * math.log(1 - pL + eps)
+        pE = 1 / (1 + math.exp(pE / (pL - pH)))
+        self.quantileOrder = (pE - pL) / (pH - pL)
+
+        self.log_pdf = -0.5 * (self.x / tGuessSd) ** 2
+        self._pdf = None
+        self.intensity = []
+        self.response = []
+
+    def _weibull(self, shift):
+        """
+        :param shift:   intensity shift of the Weibull function
+        :return:        probabilities of response 1 at x2
+        """
+        return self.delta * self.gamma + (1 - self.delta) * (
+                1 - (1 - self.gamma) * np.exp(-10 ** (self.beta * (self.x2 + shift))))
+
+    @property
+    def pdf(self):
+        """
+        :return: the (unnormalized) posterior pdf at tGuess + x
+        """
+        if self._pdf is None:
+            self._pdf = np.exp(self.log_pdf)
+        return self._pdf
+
+    def update(self, intensity, response):
+        """
+        Multiply the pdf in place by the likelihood of a response.
+
+        :param intensity:   intensity of the trial
+        :param response:    0 or 1
+        """
+        response = int(response)
+        if response < 0 or response > 1:
+            raise RuntimeError('response %g out of range 0 to 1' % response)
+        inten = max(-1e10, min(1e10, intensity))  # make intensity finite
+        start = len(self.x) - 1 + int(self.i[0]) - int(round((inten - self.tGuess) / self.grain))
+        if start < 0 or start + len(self.x) > self.log_s2.shape[1]:
+            warnings.warn('intensity %.2f out of range. Pdf will be inexact.' % intensity, RuntimeWarning,
+                          stacklevel=2)
+            start = min(max(start, 0), self.log_s2.shape[1] - len(self.x))
+        self.log_pdf += self.log_s2[response, start:start + len(self.x)]
+        self.log_pdf -= self.log_pdf.max()  # the pdf is unnormalized, keep its maximum at 1
+        self._pdf = None
+        self.intensity.append(intensity)
+        self.response.append(response)
+
+    def mean(self):
+        """
+        :return: mean of the posterior
+        """
+        return self.tGuess + np.sum(self.pdf * self.x) / np.sum(self.pdf)
+
+    def mode(self):
+        """
+        :return: mode of the posterior and the (unnormalized) pdf at the mode
+        """
+        i_mode = np.argmax(self.pdf)
+        return self.x[i_mode] + self.tGuess, self.pdf[i_mode]
+
+    def quantile(self, quantileOrder=None):
+        """
+        :param quantileOrder:   quantile order; default: the most informative one for the next trial
+        :return:                quantile of the posterior
+        """
+        if quantileOrder is None:
+            quantileOrder = self.quantileOrder
+        p = np.cumsum(self.pdf)
+        index = np.nonzero(np.diff(np.r_[-1, p]))[0]
+        if len(index) < 2:
+            raise RuntimeError('pdf has only %g nonzero point(s)' % len(index))
+        return self.tGuess + np.interp(quantileOrder * p[-1], p[index], self.x[index])
+
+    def sd(self):
+        """
+        :return: sd of the posterior
+        """
+        p = np.sum(self.pdf)
+        return math.sqrt(np.sum(self.pdf * self.x ** 2) / p - (np.sum(self.pdf * self.x) / p) ** 2)
+
+    def p(self, x):
+        """
+        :param x:   intensity relative to the threshold
+        :return:    probability of response 1
+        """
+        return np.interp(x, self.x2, self.p2)
+
+    def simulate(self, tTest, tActual):
+        """
+        :param tTest:       intensity of the test
+        :param tActual:     true threshold
+        :return:            a simulated response
+        """
+        return self.p(tTest - tActual) > np.random.random()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pdf'] = None
+        return state
+
+
+def psi_tables(x, alpha, beta, delta, TwoAFC):
+    """
+    Likelihood and response-entropy tables of the Psi method, computed once for every grid.
+
+    :param x:       intensities
+    :param alpha:   locations
+    :param beta:    slopes (sd of the cumulative normal)
+    :param delta:   lapse rate
+    :param TwoAFC:  2AFC (True) or yes/no design
+    :return:        a (len(alpha) * len(beta), 2 * len(x)) array: p1 = P(1|alpha, beta, x) and
+                    T = p1 log p1 + p0 log p0 side by side
+    """
+    key = (x.tobytes(), alpha.tobytes(), beta.tobytes(), delta, TwoAFC)
+    if key not in _TABLES:
+        n_x = len(x)
+        tables = np.empty((len(alpha) * len(beta), 2 * n_x))
+        p1 = tables[:, :n_x].reshape(len(alpha), len(beta), n_x)
+        p1[:] = special.ndtr((x[None, None, :] - alpha[:, None, None]) / beta[None, :, None])
+        if TwoAFC:
+            p1 *= 0.5 * (1 - delta)
+            p1 += 0.5 * (1 - delta) + delta / 2
+        else:
+            p1 *= 1 - delta
+            p1 += delta / 2
+        tables[:, n_x:] = special.xlogy(tables[:, :n_x], tables[:, :n_x]) + \
+            special.xlogy(1 - tables[:, :n_x], 1 - tables[:, :n_x])
+        _TABLES[key] = tables
+    return _TABLES[key]
+
+
+class PsiPosterior:
+    def __init__(self, x, alpha, beta, xPrecision, aPrecision, bPrecision, delta=0, stepType='lin', TwoAFC=False,
+                 prior=None):
+        """
+        Psi posterior over (alpha, beta) of a cumulative normal, as psychopy.contrib.psi.PsiObject.
+
+        :param x:           intensity range
+        :param alpha:       location range
+        :param beta:        slope range
+        :param xPrecision:  intensity step ('lin') or number of intensities ('log')
+        :param aPrecision:  location step
+        :param bPrecision:  slope step
+        :param delta:       lapse rate
+        :param stepType:    'lin' or 'log' intensities
+        :param TwoAFC:      2AFC (True) or yes/no design
+        :param prior:       prior over (alpha, beta), e.g. a saved posterior; default: uniform
+        """
+        if stepType == 'lin':
+            self.x = np.linspace(x[0], x[1], int(round((x[1] - x[0]) / xPrecision) + 1), True)
+        elif stepType == 'log':
+            self.x = np.logspace(np.log10(x[0]), np.log10(x[1]), xPrecision, True)
+        else:
+            raise RuntimeError('Invalid step type. Unable to initialize PsiObject.')
+        self.alpha = np.linspace(alpha[0], alpha[1], int(round((alpha[1] - alpha[0]) / aPrecision) + 1), True)
+        self.beta = np.linspace(beta[0], beta[1], int(round((beta[1] - beta[0]) / bPrecision) + 1), True)
+        self.delta = delta
+        self._TwoAFC = TwoAFC
+
+        n_lambda = len(self.alpha) * len(self.beta)
+        if prior is not None and np.size(prior) == n_lambda:
+            self.posterior = np.array(prior, dtype=float).ravel()
+            self.posterior /= self.posterior.sum()
+        else:
+            if prior is not None:
+                warnings.warn('Prior has incompatible dimensions. Using uniform (1/N) probabilities.')
+            self.posterior = np.full(n_lambda, 1.0 / n_lambda)
+        self._tables = None
+        self.intensity = []
+        self.response = []
+        self.update(None)
+
+    @property
+    def tables(self):
+        """
+        :return: the shared tables of this grid (see psi_tables)
+        """
+        if self._tables is None:
+            self._tables = psi_tables(self.x, self.alpha, self.beta, self.delta, self._TwoAFC)
+        return self._tables
+
+    def update(self, response=None, intensity=None):
+        """
+        Update the posterior in place with a response, and choose the next intensity.
+
+        :param response:    0 or 1; None only at the start
+        :param intensity:   intensity of the trial, default: the chosen next intensity. Unlike PsychoPy, which always
+                            updates at its chosen intensity, the nearest intensity of the grid is used.
+        """
+        n_x = len(self.x)
+        if response is not None:
+            idx = self.nextIntensityIndex if intensity is None else int(np.argmin(np.abs(self.x - intensity)))
+            if response:
+                self.posterior *= self.tables[:, idx]
+            else:
+                self.posterior *= 1 - self.tables[:, idx]
+            self.posterior /= self.posterior.sum()
+            self.intensity.append(self.x[idx] if intensity is None else intensity)
+            self.response.append(int(response))
+        w_tables = self.posterior @ self.tables
+        self._p1 = w_tables[:n_x]
+        p0 = 1 - self._p1
+        self._expectedEntropyX = -w_tables[n_x:] + special.xlogy(self._p1, self._p1) + special.xlogy(p0, p0)
+        self.nextIntensityIndex = int(np.argmin(self._expectedEntropyX))
+        self.nextIntensity = self.x[self.nextIntensityIndex]
+
+    def estimateLambda(self):
+        """
+        :return: posterior means of location and slope
+        """
+        prob = self.posterior.reshape(len(self.alpha), len(self.beta))
+        return np.sum(self.alpha * prob.sum(axis=1)), np.sum(self.beta * prob.sum(axis=0))
+
+    def estimateThreshold(self, thresh, lam=None):
+        """
+        :param thresh:  probability correct
+        :param lam:     (location, slope), default: estimateLambda()
+        :return:        intensity at this probability
+        """
+        lamb = self.estimateLambda() if lam is None else lam
+        if self._TwoAFC:
+            return lamb[0] + lamb[1] * special.ndtri((2 * thresh - 1) / (1 - self.delta))
+        return lamb[0] + lamb[1] * special.ndtri((thresh - self.delta / 2) / (1 - self.delta))
+
+    def savePosterior(self, file):
+        """
+        Save the posterior as PsychoPy does, e.g. as the prior of a later session.
+
+        :param file:    npy file path
+        """
+        np.save(file, self.posterior.reshape(1, len(self.alpha), len(self.beta), 1))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tables'] = None  # shared, computed again when needed
+        return state
+
+
+class QuestHandler(data.QuestHandler):
+    """
+    PsychoPy's QuestHandler with the posterior of QuestPosterior.
+    """
+
+    def __init__(self, startVal, startValSd, pThreshold=0.82, nTrials=None, stopInterval=None, method='quantile',
+                 beta=3.5, delta=0.01, gamma=0.5, grain=0.01, range=None, extraInfo=None, minVal=None, maxVal=None,
+                 staircase=None, originPath=None, name='', autoLog=True, **kwargs):
+        data.QuestHandler.__init__(self, startVal, startValSd, pThreshold=pThreshold, nTrials=nTrials,
+                                   stopInterval=stopInterval, method=method, beta=beta, delta=delta, gamma=gamma,
+                                   grain=grain, range=range, extraInfo=extraInfo, minVal=minVal, maxVal=maxVal,
+                                   originPath=originPath, name=name, autoLog=autoLog)
+        self._quest = QuestPosterior(startVal, startValSd, pThreshold, beta, delta, gamma, grain=grain, range=range)
+        self.update_times = []
+        if staircase is not None:
+            self.importData(staircase.intensities, staircase.data)
+
+    def addResponse(self, result, intensity=None):
+        start = time.perf_counter()
+        data.QuestHandler.addResponse(self, result, intensity)
+        self.update_times.append(time.perf_counter() - start)
+
+
+class PsiHandler(data.PsiHandler):
+    """
+    PsychoPy's PsiHandler with the posterior of PsiPosterior. Its next intensity is also in _nextIntensity.
+    """
+
+    def __init__(self, nTrials, intensRange, alphaRange, betaRange, intensPrecision, alphaPrecision, betaPrecision,
+                 delta, stepType='lin', expectedMin=0.5, prior=None, fromFile=False, extraInfo=None, name=''):
+        if expectedMin not in [0, 0.5]:
+            raise NotImplementedError('Currently, only Yes/No and 2-AFC designs are supported. Please specify either '
+                                      '`expectedMin=0` (Yes/No) or `expectedMin=0.5` (2-AFC).')
+        data.StairHandler.__init__(self, startVal=None, nTrials=nTrials, extraInfo=extraInfo, stepType=stepType,
+                                   minVal=intensRange[0], maxVal=intensRange[1], name=name)
+        if prior is not None and fromFile:
+            try:
+                prior = np.load(prior)
+            except IOError:
+                warnings.warn('The specified prior file could not be read. Using a uniform prior instead.')
+                prior = None
+        self._psi = PsiPosterior(intensRange, alphaRange, betaRange, intensPrecision, alphaPrecision, betaPrecision,
+                                 delta=delta, stepType=stepType, TwoAFC=(expectedMin == 0.5), prior=prior)
+        self._nextIntensity = self._psi.nextIntensity
+        self.update_times = []
+
+    def addResponse(self, result, intensity=None):
+        start = time.perf_counter()
+        self.data.append(result)
+        if intensity is not None:
+            if len(self.intensities) != 0:  # sessions take _nextIntensity without next()
+                self.intensities.pop()
+            self.intensities.append(intensity)
+        if self.getExp() is not None:
+            self.getExp().addData(self.name + ".response", result)
+        self._psi.update(result, intensity)
+        self._nextIntensity = self._psi.nextIntensity
+        self.update_times.append(time.perf_counter() - start)
+
+
+def bench_updates(n_trials=30, seed=0):
+    """
+    Time the trials of PsychoPy's handlers and of this module's, with the settings of the sessions (see
+    multinoisecolor10bit.make_stairs) and the same simulated responses. A trial is addResponse and the estimates
+    written by the session.
+
+    :param n_trials:    number of trials
+    :param seed:        seed of the responses
+    :return:            a dictionary of methods: mean and max trial time (ms) of PsychoPy and native handlers,
+                        and the largest difference of their estimates
+    """
+    quest_args = dict(startVal=5.0, startValSd=10, pThreshold=0.63, nTrials=n_trials, minVal=0.2, maxVal=10.0,
+                      grain=0.02)
+    psi_args = dict(nTrials=n_trials, intensRange=[1, 10], alphaRange=[1, 10], betaRange=[0.01, 10],
+                    intensPrecision=0.1, alphaPrecision=0.1, betaPrecision=0.01, delta=0.01)
+    handlers = {'quest': (data.QuestHandler(**quest_args), QuestHandler(**quest_args)),
+                'psi': (data.PsiHandler(**psi_args), PsiHandler(**psi_args))}
+    results = {}
+    for method, pair in handlers.items():
+        rng = np.random.default_rng(seed)
+        times = [[], []]
+        estimates = [[], []]
+        for trial in range(n_trials):
+            intensities = [next(handler) for handler in pair]
+            judge = int(rng.random() < 0.5 + 0.5 * special.ndtr(intensities[1] - 3.0))
+            for k, handler in enumerate(pair):
+                start = time.perf_counter()
+                handler.addResponse(judge)
+                if method == 'psi':
+                    estimates[k].append([handler.estimateLambda()[0], handler.estimateLambda()[1],
+                                         handler.estimateThreshold(0.75)])
+                else:
+                    estimates[k].append([handler.mean(), handler.mode(), handler.quantile(0.5)])
+                times[k].append(time.perf_counter() - start)
+        results[method] = {'psychopy_mean_ms': 1000 * np.mean(times[0]), 'psychopy_max_ms': 1000 * np.max(times[0]),
+                           'native_mean_ms': 1000 * np.mean(times[1]), 'native_max_ms': 1000 * np.max(times[1]),
+                           'max_diff': np.max(np.abs(np.array(estimates[0]) - np.array(estimates[1])))}
+    return results
+
+
+"""example"""
+
+# handler = PsiHandler(nTrials=30, intensRange=[1, 10], alphaRange=[1, 10], betaRange=[0.01, 10],
+#                      intensPrecision=0.1, alphaPrecision=0.1, betaPrecision=0.01, delta=0.01)
+# for intensity in handler:
+#     handler.addResponse(int(intensity > 3))
+# print(handler.estimateThreshold(0.75), np.max(handler.update_times))
+
+""" compare with PsychoPy in bash """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('n_trials', nargs='?', type=int, default=30)
+    args = parser.parse_args()
+    for key, val in bench_updates(args.n_trials).items():
+        print(key, ', '.join('%s: %.4g' % (k, v) for k, v in val.items()))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+
+# python version 3.7.6
+"""
+This module analyses all subjects at once: every *.xrl file under the data directory (including nested ones like
+data/ysu/noise_test/ysu.xrl) is found, and the analyses run in a pool of processes with the Agg backend:
+    - a staircase profile of every finished session (session_profile)
+    - psychometric function fits and plots of every parameter file of a subject (ExploreData)
+
+Outputs are incremental: a manifest in the output directory keeps a fingerprint of the session files of every
+analysis, and only analyses whose files changed since the last run (or whose outputs are missing) are run again.
+Analyses which failed are run again on the next run; their errors stay in the manifest until they succeed.
+The results stores of the data tree (datastore) are filled before the analyses start, so that the processes only
+read them.
+
+Outputs, with the directories of the data tree:
+    <out_dir>/staircase_plots/ysu/ysu-20200916T1708L-L.png
+    <out_dir>/pf_plots/ysu/cn2x8_LL_easy_a/pfplot.png, threshplot.png, paramplot.png, fit.csv
+
+Run in Python3.7:
+    run_batch(data_dir[optional], out_dir[optional])
+Or in bash:
+    python3.7 batch_analysis.py [optional data_dir] [--out out_dir] [--processes N] [--force]
+
+@author: yannansu
+"""
+import matplotlib
+
+matplotlib.use('Agg')  # before pyplot is imported by exploredata, also in the worker processes
+
+import os
+import glob
+import json
+import warnings
+import argparse
+import pandas as pd
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from exploredata import session_profile, ExploreData
+import datastore
+
+MANIFEST = 'batch_manifest.json'
+PLOTS = ['pfplot', 'threshplot', 'paramplot']
+
+
+def find_xrl(data_dir='data'):
+    """
+    :param data_dir:    data directory
+    :return:            all xrl files under the data directory
+    """
+    return sorted(glob.glob(os.path.join(data_dir, '**', '*.xrl'), recursive=True))
+
+
+def finished_sessions(xrl_file):
+    """
+    :param xrl_file:    xrl file of a subject
+    :return:            lines of all finished sessions
+    """
+    with open(xrl_file) as f:
+        return [line for line in f.read().splitlines() if line.endswith('.xlsx')]
+
+
+def make_jobs(data_dir='data', out_dir='data_analysis_LL'):
+    """
+    :param data_dir:    data directory
+    :param out_dir:     output directory
+    :return:            a list of analyses (dictionaries), staircase profiles of sessions and fits of parameter files
+    """
+    jobs = []
+    for xrl_file in find_xrl(data_dir):
+        sub = os.path.splitext(os.path.basename(xrl_file))[0]
+        rel_dir = os.path.relpath(os.path.dirname(xrl_file), data_dir)
+        lines = finished_sessions(xrl_file)
+        for line in lines:
+            xls_file = line.split(', ')[3]
+            session = os.path.splitext(os.path.basename(xls_file))[0]
+            jobs.append({'kind': 'profile', 'key': 'profile:' + xls_file, 'xls_file': xls_file,
+                         'outputs': [os.path.join(out_dir, 'staircase_plots', rel_dir, sub + '-' + session + '.png')]})
+        for par_file in sorted(set(line.split(', ')[1] for line in lines)):
+            res_dir = os.path.join(out_dir, 'pf_plots', rel_dir, os.path.splitext(os.path.basename(par_file))[0])
+            jobs.append({'kind': 'fit', 'key': 'fit:' + xrl_file + ':' + par_file, 'sub': sub, 'xrl_file': xrl_file,
+                         'par_file': par_file, 'res_dir': res_dir,
+                         'outputs': [os.path.join(res_dir, p + '.png') for p in PLOTS] +
+                                    [os.path.join(res_dir, 'fit.csv')]})
+    return jobs
+
+
+def explorer(job):
+    """
+    :param job:     a fit analysis from make_jobs
+    :return:        ExploreData of the sessions of this parameter file
+    """
+    return ExploreData(job['sub'], sel_par=[job['par_file']], xrl_path=job['xrl_file'])
+
+
+def fingerprint(job):
+    """
+    :param job:     an analysis from make_jobs
+    :return:        a fingerprint of its session files, which changes with any of them
+    """
+    if job['kind'] == 'profile':
+        return str(os.path.getmtime(job['xls_file'])) if os.path.exists(job['xls_file']) else None
+    return explorer(job).cache_key()
+
+
+def run_job(job):
+    """
+    Run one analysis and save its figures, in a worker process.
+
+    :param job:     an analysis from make_jobs
+    :return:        error messages, empty if all outputs are written
+    """
+    errors = []
+    os.makedirs(os.path.dirname(job['outputs'][0]), exist_ok=True)
+    try:
+        if job['kind'] == 'profile':
+            session_profile(xls_file=job['xls_file'], title=job['xls_file'], res_file=job['outputs'][0],
+                            show_fig=False)
+        else:
+            exp_data = explorer(job)
+            ntrial, res = exp_data.fitpf()
+            pd.DataFrame({'centre': [r['fit'].params[0] for r in res.values()],
+                          'sd': [r['fit'].params[1] for r in res.values()],
+                          'thresh': [r['thresh'] for r in res.values()]},
+                         index=list(res.keys())).to_csv(os.path.join(job['res_dir'], 'fit.csv'))
+            for plot, output in zip(PLOTS, job['outputs']):
+                try:
+                    getattr(exp_data, plot)()
+                    plt.gcf().savefig(output)
+                except Exception as err:
+                    errors.append(plot + ': ' + repr(err))
+                finally:
+                    plt.close('all')
+    except Exception as err:
+        errors.append(repr(err))
+    finally:
+        plt.close('all')
+    return errors
+
+
+def up_to_date(job, entry, current):
+    """
+    :param job:     an analysis from make_jobs
+    :param entry:   its entry in the manifest, None if it has not been run
+    :param current: the current fingerprint of its session files
+    :return:        True if it has been run without errors on the same files, and all its outputs exist
+    """
+    return entry is not None and entry['fingerprint'] == current and not entry['errors'] and \
+        all(os.path.exists(output) for output in job['outputs'])
+
+
+def run_batch(data_dir='data', out_dir='data_analysis_LL', processes=None, force=False):
+    """
+    Run all analyses of the data tree whose session files changed since the last run.
+
+    On platforms which spawn processes (Windows, macOS), call it under
+    `if __name__ == '__main__':` in scripts.
+
+    :param data_dir:    data directory
+    :param out_dir:     output directory
+    :param processes:   number of processes, default: number of CPUs; 1 runs in this process
+    :param force:       run all analyses again
+    :return:            numbers of run, skipped and failed analyses
+    """
+    manifest_file = os.path.join(out_dir, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_file) and not force:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    jobs = make_jobs(data_dir, out_dir)
+    prints = {job['key']: fingerprint(job) for job in jobs}
+    todo = [job for job in jobs if not up_to_date(job, manifest.get(job['key']), prints[job['key']])]
+
+    # sessions missing in the stores are added here, not by the processes, which all write the same store files
+    if todo and datastore.tables is not None:
+        datastore.convert_tree(data_dir)
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(todo))
+    if processes <= 1:
+        results = [run_job(job) for job in todo]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(run_job, todo))
+
+    failed = 0
+    for job, errors in zip(todo, results):
+        if errors:
+            failed += 1
+            warnings.warn(job['key'] + ' failed: ' + '; '.join(errors))
+        manifest[job['key']] = {'fingerprint': prints[job['key']], 'errors': errors}
+    os.makedirs(out_dir, exist_ok=True)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+    return len(todo), len(jobs) - len(todo), failed
+
+
+"""example"""
+
+# run_batch('data', 'data_analysis_LL')
+
+""" run all analyses in bash """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_dir', nargs='?', default='data')
+    parser.add_argument('--out', default='data_analysis_LL')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args()
+    run, skipped, failed = run_batch(args.data_dir, args.out, args.processes, args.force)
+    print('{} analyses run ({} failed), {} up to date.'.format(run, failed, skipped))
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# python version 3.7.6
+
+"""
+This module benchmarks the staircase methods of config_tools.write_par (simple up-down, QUEST and Psi) by Monte-Carlo
+runs against a bank of simulated observers (simobserver.SimObserver) whose thresholds are known.
+The staircases are created by multinoisecolor10bit.make_stairs as in sessions and answered headless, one condition
+at a time. Nothing is displayed, so intensities are not rounded to displayable hues and repeated intensities are not
+nudged; the warm-up trials of the quest and psi methods count as trials but are not added to the staircases.
+
+Every run records the threshold estimate after each trial:
+    simple  - mean of the last 3 reversal intensities (as in exploredata), none before the first reversal
+    quest   - mean of the posterior (QuestHandler.mean)
+    psi     - intensity at 75% correct (PsiHandler.estimateThreshold)
+and it is compared with the threshold of the observer at the probability targeted by the method: pThreshold for
+quest, 0.75 for psi, 0.5 ** (1 / nDown) for 1-up-n-down staircases. The staircases do not depend on the number of
+trials, so the estimate after n trials is the one of a session with trial_nmb = n: one run at the largest trial_nmb
+shows what cutting trials would cost.
+
+Results are one compact table (HDF5 with PyTables, else gzipped csv), one row per trial of every run:
+    summarize       - bias, variance and rmse of the estimates per number of trials
+    convergence     - trials until the estimate stays within a tolerance of the true threshold
+    trials_needed   - the smallest trial_nmb whose rmse meets a criterion
+
+Run in Python3.7:
+    par_files = write_designs('config/bench')
+    results = benchmark(par_files, observer_bank(), n_rep=100, trial_nmb=40, out_file='bench_staircase.h5')
+    trials_needed(summarize(results))
+Or in bash:
+    python3.7 bench_staircase.py [optional design_dir] [--n_rep N] [--trial_nmb N] [--out file] [--processes N]
+
+@author: yannansu
+"""
+
+import os
+import copy
+import warnings
+import argparse
+import numpy as np
+import pandas as pd
+import config_tools
+from FitCumNormal import FitCumNormal
+from simobserver import SimObserver
+
+try:
+    import tables
+except ImportError:
+    tables = None
+
+PSI_P = 0.75  # probability of the psi threshold, as in sessions
+DESIGNS = {'simple_1u2d': dict(method='simple', step_type='lin', up_down=[1, 2]),
+           'simple_1u3d': dict(method='simple', step_type='lin', up_down=[1, 3]),
+           'quest_63': dict(method='quest', p_threshold=0.63),
+           'quest_75': dict(method='quest', p_threshold=0.75),
+           'psi': dict(method='psi')}
+RUN = ['design', 'observer', 'rep', 'label']  # columns identifying a run
+
+
+def write_designs(design_dir='config/bench', noise='L-L', designs=None, hue_num=8):
+    """
+    Write a parameter file for every design.
+
+    :param design_dir:  directory of the parameter files
+    :param noise:       'L-L', 'L-H', 'H-H'
+    :param designs:     a dictionary of designs, each a dictionary of arguments of config_tools.write_par;
+                        default: DESIGNS
+    :param hue_num:     hue numbers
+    :return:            a dictionary of parameter files with the design names as keys
+    """
+    if designs is None:
+        designs = DESIGNS
+    os.makedirs(design_dir, exist_ok=True)
+    par_files = {}
+    for name, kwargs in designs.items():
+        par_files[name] = os.path.join(design_dir, name + '.yaml')
+        config_tools.write_par(par_files[name], noise, hue_num=hue_num, **kwargs)
+    return par_files
+
+
+def observer_bank(thresholds=(1.0, 2.0, 4.0), sds=(0.5, 1.5), lapses=(0.0, 0.04)):
+    """
+    :param thresholds:  thresholds (75% correct, deg)
+    :param sds:         sds of the psychometric functions (deg)
+    :param lapses:      lapse rates
+    :return:            a dictionary of SimObserver of all combinations, with names like 't2.0_sd0.5_l0.04'
+    """
+    return {'t%g_sd%g_l%g' % (t, sd, l): SimObserver(threshold=t, sd=sd, lapse=l)
+            for t in thresholds for sd in sds for l in lapses}
+
+
+def target_p(cond):
+    """
+    :param cond:    condition from the parameter file
+    :return:        probability correct targeted by the staircase of this condition
+    """
+    if cond['stairType'] == 'quest':
+        return cond['pThreshold']
+    if cond['stairType'] == 'psi':
+        return PSI_P
+    if cond['nUp'] == 1:
+        return 0.5 ** (1 / cond['nDown'])
+    if cond['nDown'] == 1:
+        return 1 - 0.5 ** (1 / cond['nUp'])
+    raise ValueError('Only 1-up-n-down and n-up-1-down staircases have a known target probability!')
+
+
+def true_threshold(observer, cond):
+    """
+    :param observer:    SimObserver
+    :param cond:        condition from the parameter file
+    :return:            threshold of the observer at the probability targeted by the staircase
+    """
+    centre, sd = observer.params(cond)
+    return FitCumNormal._inverse(target_p(cond), centre, sd, chance=0.5, lapse=observer.lapse)
+
+
+def estimate(handler):
+    """
+    :param handler:     a staircase after some trials
+    :return:            its current threshold estimate, nan if there is none yet
+    """
+    from psychopy import data
+
+    if isinstance(handler, data.PsiHandler):
+        return handler.estimateThreshold(PSI_P)
+    if isinstance(handler, data.QuestHandler):
+        return handler.mean()
+    reversals = handler.reversalIntensities[-3:]
+    return np.mean(reversals) if reversals else np.nan
+
+
+def _bench_part(args):
+    """
+    Run staircases of one design against one observer, in a worker process.
+
+    :return: a dictionary of columns: rep, label, trial, estimate and true threshold
+    """
+    from multinoisecolor10bit import make_stairs, WARMUP_N  # imports PsychoPy, only in the workers
+
+    par_file, observer, obs_idx, reps, trial_nmb, labels, seed = args
+    param = config_tools.read_yml(par_file)
+    conditions = [dict({'stimulus': key}, **value) for key, value in param.items() if key.startswith('stimulus')]
+    if labels is not None:
+        conditions = [cond for cond in conditions if cond['label'] in labels]
+
+    columns = {'rep': [], 'label': [], 'trial': [], 'estimate': [], 'true': []}
+    for cond in sorted(conditions, key=lambda c: c['label']):
+        warmup_n = 0 if cond['stairType'] == 'simple' else WARMUP_N
+        if trial_nmb <= warmup_n:
+            raise ValueError('trial_nmb has to be larger than the %d warm-up trials!' % warmup_n)
+        stairs = make_stairs([cond], trial_nmb - warmup_n)
+        template = stairs.staircases[0] if cond['stairType'] == 'simple' else stairs[0]
+        true = true_threshold(observer, cond)
+        label_idx = int(cond['label'][4:-1]) * 2 + cond['label'].endswith('m')  # the same seeds in all designs
+        for rep in reps:
+            handler = copy.deepcopy(template)  # cheaper than a new posterior grid of psi
+            sim = observer.reseed([seed, obs_idx, rep, label_idx])
+            est = np.full(trial_nmb, np.nan)
+            for n, intensity in enumerate(handler):
+                handler.addResponse(sim.respond(intensity, cond)[0])
+                est[warmup_n + n] = estimate(handler)
+                if warmup_n + n + 1 == trial_nmb:  # simple staircases go on until their reversals are reached
+                    break
+            columns['rep'].append(np.full(trial_nmb, rep))
+            columns['label'].append(np.full(trial_nmb, cond['label']))
+            columns['trial'].append(np.arange(1, trial_nmb + 1))
+            columns['estimate'].append(est)
+            columns['true'].append(np.full(trial_nmb, true))
+    return {c: np.concatenate(v) if v else np.array([]) for c, v in columns.items()}
+
+
+def benchmark(par_files, observers, n_rep=100, trial_nmb=40, labels=None, out_file=None, processes=None, seed=0,
+              chunk=10):
+    """
+    Run the staircases of every design against every observer, n_rep times for every condition, in a pool of
+    processes. The observers answer with the same seeds in all designs, so designs are compared on the same runs.
+    Psi takes by far the longest, with about 20 ms per trial.
+
+    On platforms which spawn processes (Windows, macOS), call it under
+    `if __name__ == '__main__':` in scripts.
+
+    :param par_files:   a dictionary of parameter files with design names as keys, e.g. from write_designs
+    :param observers:   a dictionary of SimObserver with names as keys, e.g. from observer_bank
+    :param n_rep:       number of runs of every condition
+    :param trial_nmb:   number of trials of every run, warm-up trials included
+    :param labels:      labels of the conditions to run, default: all conditions of the parameter files
+    :param out_file:    file to save the results in (see save_results), optional
+    :param processes:   number of processes, default: number of CPUs; 1 runs in this process
+    :param seed:        seed of all runs
+    :param chunk:       number of runs of a condition in one job
+    :return:            a dataframe with one row per trial of every run: design, observer, rep, label, trial,
+                        estimate and true threshold
+    """
+    jobs, keys = [], []
+    for design, par_file in par_files.items():
+        for obs_idx, (name, observer) in enumerate(observers.items()):
+            for start in range(0, n_rep, chunk):
+                jobs.append((par_file, observer, obs_idx, range(start, min(start + chunk, n_rep)), trial_nmb, labels,
+                             seed))
+                keys.append((design, name))
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(jobs))
+    if processes <= 1:
+        parts = [_bench_part(job) for job in jobs]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            parts = list(pool.map(_bench_part, jobs))
+
+    results = pd.DataFrame({
+        'design': pd.Categorical(np.concatenate([np.full(len(p['rep']), k[0]) for k, p in zip(keys, parts)]),
+                                 categories=list(par_files)),
+        'observer': pd.Categorical(np.concatenate([np.full(len(p['rep']), k[1]) for k, p in zip(keys, parts)]),
+                                   categories=list(observers)),
+        'rep': np.concatenate([p['rep'] for p in parts]).astype(np.int32),
+        'label': pd.Categorical(np.concatenate([p['label'] for p in parts])),
+        'trial': np.concatenate([p['trial'] for p in parts]).astype(np.int16),
+        'estimate': np.concatenate([p['estimate'] for p in parts]).astype(np.float32),
+        'true': np.concatenate([p['true'] for p in parts]).astype(np.float32)})
+    if out_file is not None:
+        save_results(results, out_file)
+    return results
+
+
+def save_results(results, out_file):
+    """
+    Save results as a compressed HDF5 table, or as a gzipped csv file (out_file + '.csv.gz') without PyTables.
+
+    :param results:     results from benchmark
+    :param out_file:    file path, e.g. 'bench_staircase.h5'
+    :return:            the path of the saved file
+    """
+    if tables is None:
+        out_file = os.path.splitext(out_file)[0] + '.csv.gz'
+        warnings.warn('PyTables is not available, results are saved in ' + out_file)
+        results.to_csv(out_file, index=False)
+    else:
+        results.to_hdf(out_file, key='results', mode='w', format='table', complevel=9, complib='zlib')
+    return out_file
+
+
+def load_results(out_file):
+    """
+    :param out_file:    file saved by save_results
+    :return:            results, as returned by benchmark
+    """
+    if out_file.endswith('.csv.gz'):
+        return pd.read_csv(out_file, dtype={'design': 'category', 'observer': 'category', 'label': 'category'})
+    return pd.read_hdf(out_file, key='results')
+
+
+def summarize(results):
+    """
+    :param results:     results from benchmark
+    :return:            a dataframe indexed by design, observer and trial: number of estimates (n), bias, variance
+                        (var) and rmse of the estimates, and rmse relative to the true thresholds (rel_rmse)
+    """
+    err = results['estimate'].astype(float) - results['true']
+    grouped = pd.DataFrame({'err': err, 'sq': err ** 2, 'rel_sq': (err / results['true']) ** 2}).groupby(
+        [results['design'], results['observer'], results['trial']], observed=True)
+    summary = pd.DataFrame({'n': grouped['err'].count(),
+                            'bias': grouped['err'].mean(),
+                            'var': grouped['err'].var(),
+                            'rmse': np.sqrt(grouped['sq'].mean()),
+                            'rel_rmse': np.sqrt(grouped['rel_sq'].mean())})
+    return summary
+
+
+def convergence(results, tol=0.2):
+    """
+    The trials to convergence of a run are the trials until its estimate stays within tol (relative) of the true
+    threshold up to the last trial; runs whose last estimate is outside are not converged.
+
+    :param results:     results from benchmark
+    :param tol:         relative tolerance
+    :return:            a dataframe indexed by design and observer: fraction of converged runs, median and 90%
+                        quantile of the trials to convergence of the converged runs
+    """
+    results = results.sort_values(RUN + ['trial'])
+    outside = ~(np.abs(results['estimate'] - results['true']) <= tol * results['true'])
+    runs = results.groupby(RUN, observed=True)
+    last_out = results['trial'].where(outside).groupby([results[c] for c in RUN], observed=True).max()
+    trials = last_out.fillna(0) + 1
+    trials[last_out == runs['trial'].max()] = np.nan
+    grouped = trials.groupby(level=['design', 'observer'], observed=True)
+    return pd.DataFrame({'converged': grouped.count() / grouped.size(),
+                         'median': grouped.median(),
+                         'q90': grouped.quantile(0.9)})
+
+
+def trials_needed(summary, max_rel_rmse=0.2):
+    """
+    :param summary:         summary from summarize
+    :param max_rel_rmse:    criterion of the relative rmse
+    :return:                a dataframe of designs x observers: the smallest trial_nmb from which on the relative rmse
+                            stays below the criterion, nan if it is never met
+    """
+    failed = summary['rel_rmse'].isna() | (summary['rel_rmse'] > max_rel_rmse)
+    trial = summary.index.get_level_values('trial').to_series(index=summary.index)
+    last_failed = trial.where(failed).groupby(level=['design', 'observer'], observed=True).max()
+    needed = last_failed.fillna(0) + 1
+    needed[last_failed == trial.groupby(level=['design', 'observer'], observed=True).max()] = np.nan
+    return needed.unstack('observer')
+
+
+"""example"""
+
+# par_files = write_designs('config/bench')
+# results = benchmark(par_files, observer_bank(), n_rep=200, trial_nmb=40, labels=['hue_1p', 'hue_1m'],
+#                     out_file='bench_staircase.h5')
+# summary = summarize(results)
+# summary.xs(30, level='trial')  # bias, variance and rmse with trial_nmb = 30
+# convergence(results, tol=0.2)
+# trials_needed(summary, max_rel_rmse=0.2).max(axis=1)  # trial_nmb needed by each design for all observers
+
+""" run the benchmark in bash """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('design_dir', nargs='?', default='config/bench')
+    parser.add_argument('--n_rep', type=int, default=100)
+    parser.add_argument('--trial_nmb', type=int, default=40)
+    parser.add_argument('--labels', nargs='*', default=None)
+    parser.add_argument('--out', default='bench_staircase.h5')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max_rel_rmse', type=float, default=0.2)
+    args = parser.parse_args()
+    res = benchmark(write_designs(args.design_dir), observer_bank(), args.n_rep, args.trial_nmb, args.labels,
+                    args.out, args.processes, args.seed)
+    print(convergence(res))
+    print(trials_needed(summarize(res), args.max_rel_rmse))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# python version 3.7.6
+
+"""
+This module measures the per-trial stimulus setup of color-noise experiments (in a small window, not fullscreen):
+    before - all stimulus objects are created in every trial
+    after  - the persistent stimulus objects of the session are updated
+
+The setup time includes the first draw of all stimuli, since PsychoPy builds its vertex and color buffers lazily.
+
+Run in Python3.7:
+    bench_setup(subject, par_file, cfg_file[optional], n_trials[optional])
+Or in bash:
+    python3.7 bench_stimuli.py [subject] [par_file] [optional cfg_file] [optional n_trials]
+
+@author: yannansu
+"""
+
+import numpy as np
+import time
+from psychopy import visual
+from multinoisecolor10bit import Exp
+import argparse
+
+
+def create_trial(exp, stim, count):
+    """
+    Create the stimulus objects of one trial, as done before the session pool.
+
+    :param exp:     experiment (Exp)
+    :param stim:    stimulus arrays from gen_stim, including colors
+    :param count:   count of this trial
+    :return:        reference, standard patch, test patch, fixation cross and trial number
+    """
+    ref = exp.patch_ref(color=stim['refColor'], pos=exp.cfg['ref.pos'])
+    sPatch = exp.patch_stim(stim['sPos'])
+    tPatch = exp.patch_stim(stim['tPos'])
+    sPatch.colors, tPatch.colors = stim['sColors'], stim['tColors']
+    fix = visual.TextStim(exp.win, text="+", units='deg', pos=[0, 0], height=0.5, color='black',
+                          colorSpace=exp.ColorSpace)
+    num = visual.TextStim(exp.win, text="trial " + str(count), units='deg', pos=[12, -10], height=0.4,
+                          color='black', colorSpace=exp.ColorSpace)
+    return ref, sPatch, tPatch, fix, num
+
+
+def time_setup(exp, setup, stims):
+    """
+    Time the setup and the first draw of all trials.
+
+    :param exp:     experiment (Exp)
+    :param setup:   function(exp, stim, count) returning the stimulus objects of a trial
+    :param stims:   stimulus arrays of all trials
+    :return:        setup times in ms
+    """
+    times = []
+    for count, stim in enumerate(stims):
+        t_start = time.perf_counter()
+        for obj in setup(exp, stim, count):
+            obj.draw()
+        times.append((time.perf_counter() - t_start) * 1000)
+        exp.win.flip()
+    return np.array(times)
+
+
+def bench_setup(subject, par_file, cfg_file='config/expconfig.yaml', n_trials=50):
+    """
+    Compare the per-trial setup times of created and pooled stimulus objects.
+
+    :param subject:     subject, for the isoslant of the color picker
+    :param par_file:    parameter file of a session, the first condition is used
+    :param cfg_file:    experiment config file
+    :param n_trials:    number of trials
+    :return:            setup times in ms, before and after
+    """
+    exp = Exp(subject, par_file, cfg_file, None, None)
+    # replace the fullscreen window by a small one, and rebuild the pool on it
+    exp.win.close()
+    exp.win = visual.Window(monitor=exp.mon, size=[800, 600], unit='deg', colorSpace=exp.ColorSpace,
+                            color=exp.Crgb, allowGUI=True, fullscr=False,
+                            bpc=(exp.depthBits, exp.depthBits, exp.depthBits), depthBits=exp.depthBits)
+    exp.stim_pool = exp.make_pool()
+
+    cond = [dict({'stimulus': key}, **value) for key, value in exp.param.items() if key.startswith('stimulus')][0]
+    stims = [exp.gen_stim(cond, rot) for rot in np.random.uniform(-5, 5, n_trials)]
+
+    before = time_setup(exp, create_trial, stims)
+    after = time_setup(exp, Exp.set_trial, stims)
+    exp.win.close()
+
+    for label, times in [('before (create)', before), ('after (pool)', after)]:
+        print('{}: mean {:.2f} ms, max {:.2f} ms'.format(label, times.mean(), times.max()))
+    return before, after
+
+# bench_setup(subject='ysu', par_file='config/cn2x8_LL_easy_a.yaml')
+
+""" run benchmark in bash """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('subject')
+    parser.add_argument('par_file')
+    parser.add_argument('cfg_file', nargs='?', default='config/expconfig.yaml')
+    parser.add_argument('n_trials', nargs='?', type=int, default=50)
+    args = parser.parse_args()
+    bench_setup(args.subject, args.par_file, args.cfg_file, args.n_trials)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+
+# python version 3.7.6
+"""
+This module builds the precomputed colors of all subjects ahead of their sessions, in a pool of processes:
+hue and rgb lists (ColorPicker.gencolorlist), hue lookup tables (HueLUT) and gamut tables (Gamut),
+for every subject x contrast (with its sscale) x color depth.
+Their file names carry the key of ColorPicker.colors_key: the calibration with its content hash, the color parameters
+and the isoslant of the subject. Sessions find them as long as none of these changes, and only rebuild them then.
+Files which already exist are kept.
+
+By default, the subjects are those with isoluminance measurements (isolum/subject), and contrasts, sscales and color
+depths are those of the parameter and experiment config files (config/*.yaml).
+
+Build in Python3.7:
+    build_all()
+Or in bash:
+    python3.7 build_colorlists.py [--subjects s1 s2] [--contrasts c1 c2] [--depthBits 8 10] [--res 0.2] [--lut_res 0.01]
+
+@author: yannansu
+"""
+import os
+import glob
+import time
+import argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import config_tools
+
+
+def find_subjects(isolum_dir='isolum'):
+    """
+    :param isolum_dir:  directory of the isoluminance measurements
+    :return:            subjects with isoluminance measurements
+    """
+    return sorted(name for name in os.listdir(isolum_dir) if os.path.isdir(os.path.join(isolum_dir, name)))
+
+
+def config_colors(config_dir='config'):
+    """
+    Color parameters of all config files.
+
+    :param config_dir:  config directory
+    :return:            sorted (contrast, sscale) of the parameter files, sorted color depths of the experiment configs
+    """
+    colors = set()
+    depths = set()
+    for file_path in glob.glob(os.path.join(config_dir, '*.yaml')):
+        par = config_tools.read_yml(file_path)
+        if not isinstance(par, dict):
+            continue
+        if 'c' in par and 'sscale' in par:
+            colors.add((par['c'], par['sscale']))
+        if 'depthBits' in par:
+            depths.add(par['depthBits'])
+    return sorted(colors), sorted(depths)
+
+
+def _build(args):
+    """
+    Build the colors of one subject, contrast and color depth, in a worker process.
+
+    :return: a list of rows of the built or existing files
+    """
+    from colorpalette import ColorPicker, HueLUT, Gamut  # imports PsychoPy, only in the workers
+
+    subject, c, sscale, depthBits, hue_res, lut_res, gamut, calib = args
+    start = time.time()
+    cp = ColorPicker(c=c, sscale=sscale, unit='deg', depthBits=depthBits, subject=subject, calib=calib)
+    paths = []
+    for res in hue_res:
+        cp.colorlist(res)
+        paths += list(cp.colorlist_paths(res))
+    if lut_res is not None:
+        paths.append(HueLUT(cp, lut_res).path)
+    if gamut:
+        paths.append(Gamut(cp).path)
+    return [{'subject': subject, 'c': c, 'sscale': sscale, 'depthBits': depthBits, 'path': path,
+             'built': os.path.getmtime(path) >= start} for path in paths]
+
+
+def build_session(par_file, cfg_file, subject):
+    """
+    Build the colors which sessions of a parameter file use (see Exp), e.g. once before processes run sessions.
+
+    :param par_file:    parameter file of the sessions
+    :param cfg_file:    experiment config file
+    :param subject:     subject whose isoslant is used
+    :return:            a list of rows of the built or existing files
+    """
+    param = config_tools.read_yml(par_file)
+    cfg = config_tools.read_yml(cfg_file)
+    return _build((subject, param['c'], param['sscale'], cfg['depthBits'], (0.2,), cfg.get('lut_res', 0.01), True,
+                   cfg.get('calib')))
+
+
+def build_all(subjects=None, colors=None, depths=None, hue_res=(0.2,), lut_res=0.01, calib=None, processes=None,
+              isolum_dir='isolum', config_dir='config'):
+    """
+    Build the color lists, hue lookup tables and gamut tables of all subjects, contrasts and color depths.
+
+    On platforms which spawn processes (Windows, macOS), call it under
+    `if __name__ == '__main__':` in scripts.
+
+    :param subjects:    subjects; default: all subjects in isolum_dir
+    :param colors:      list of (contrast, sscale); default: those of the parameter files in config_dir
+    :param depths:      color depths; default: those of the experiment config files in config_dir
+    :param hue_res:     resolutions of the color lists
+    :param lut_res:     resolution of the hue lookup tables, as lut_res of the experiment config; None for none
+    :param calib:       calibration id, as calib of the experiment config; default: the only calibration file
+    :param processes:   number of processes, default: number of CPUs
+    :param isolum_dir:  directory of the isoluminance measurements
+    :param config_dir:  config directory
+    :return:            a DataFrame of all files, with whether they have been built now
+    """
+    if subjects is None:
+        subjects = find_subjects(isolum_dir)
+    if colors is None or depths is None:
+        par_colors, cfg_depths = config_colors(config_dir)
+        colors = par_colors if colors is None else colors
+        depths = cfg_depths if depths is None else depths
+
+    jobs = []
+    for subject in subjects:
+        for depthBits in depths:
+            sscales = set()
+            for c, sscale in colors:
+                # gamut tables do not depend on the contrast, so they are built once, never by two processes
+                jobs.append((subject, c, sscale, depthBits, tuple(hue_res), lut_res, sscale not in sscales, calib))
+                sscales.add(sscale)
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(jobs)))
+    if processes == 1:
+        results = [_build(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_build, jobs))
+    return pd.DataFrame([row for rows in results for row in rows])
+
+
+"""example"""
+
+# files = build_all()  # all subjects, contrasts and color depths of the config files
+# files = build_all(subjects=['ysu'], colors=[(0.145, 2.6)], depths=[10], hue_res=[0.2, 0.5, 1.0])
+# files[files['built']]
+
+""" build colors in bash """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subjects', nargs='+', default=None)
+    parser.add_argument('--contrasts', nargs='+', type=float, default=None)
+    parser.add_argument('--sscale', type=float, default=2.6, help='sscale of the given contrasts')
+    parser.add_argument('--depthBits', nargs='+', type=int, default=None)
+    parser.add_argument('--res', nargs='+', type=float, default=[0.2])
+    parser.add_argument('--lut_res', type=float, default=0.01)
+    parser.add_argument('--calib', default=None)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+    t0 = time.time()
+    built = build_all(args.subjects, None if args.contrasts is None else [(c, args.sscale) for c in args.contrasts],
+                      args.depthBits, args.res, args.lut_res, args.calib, args.processes)
+    print('{} files, {} built in {:.1f} s.'.format(len(built), int(built['built'].sum()), time.time() - t0))
@@ -2,12 +2,15 @@
 # -*- coding: utf-8 -*-
 
 """
-This module generates sml and RGB values with hue angles on an iso-luminance plane, and vice versa.
+This module generates sml and RGB values with hue angles on an iso-luminance plane, and vice versa
+(ColorPicker.transform, ColorPicker.sml2hue and ColorPicker.rgb2hue, for arrays of colors).
 Main module: ColorPicker
+Calibrations (*.rgb2lms in the config folder) are parsed once and cached by the hash of their content, see get_calib.
 
 @author: yannansu
 """
 import os
+import hashlib
 import numpy as np
 from psychopy import visual, misc, event
 import config_tools
@@ -15,10 +18,65 @@ import warnings
 import sys
 
 
-def read_calib():
+CALIB_CACHE = 'config/calib'  # compiled calibrations, one *.npz per calibration file content (see Calibration)
+
+_CALIB_FILES = {}  # calibration id -> file path, found once per process
+_CALIBS = {}  # (file path, mtime, size) -> Calibration
+
+
+def find_calibs(refresh=False):
+    """
+    Search all *.rgb2lms calibration files in the config folder. The search runs once per process.
+
+    :param refresh: search again, e.g. after adding a calibration file
+    :return:        a dictionary of calibration id (file name without extension) -> calibration file path
+    """
+    if refresh or not _CALIB_FILES:
+        _CALIB_FILES.clear()
+        for root, dirs, names in os.walk('./config'):  # show names also in subfolders
+            for name in sorted(names):
+                if name.endswith(".rgb2lms"):
+                    _CALIB_FILES.setdefault(os.path.splitext(name)[0], root + '/' + name)
+    return _CALIB_FILES
+
+
+def find_calib(calib=None):
+    """
+    Search the *.rgb2lms calibration file in the config folder.
+
+    :param calib:   calibration id (file name without extension) or file path; the only calibration file if None
+    :return:        calibration file path
+    """
+    if calib is not None and os.path.isfile(calib):
+        return calib
+    calib_files = find_calibs()
+    if calib is not None:
+        if calib not in calib_files:
+            sys.exit('Calibration ' + calib + ' is not found.')
+        return calib_files[calib]
+
+    if len(calib_files) < 1:
+        sys.exit('No calibration file is found.')
+    if len(calib_files) > 1:
+        sys.exit('Multiple calibration files are found: ' + ', '.join(sorted(calib_files)) +
+                 '. Please specify one by its id!')
+    return list(calib_files.values())[0]
+
+
+def calib_hash(calib_file):
+    """
+    :param calib_file:  calibration file path
+    :return:            hash of the content of the calibration file (16 hex digits)
+    """
+    with open(calib_file, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()[:16]
+
+
+def read_calib(calib_file=None):
     """
     Load and read calibration outputs from *.rgb2lms file.
 
+    :param calib_file:  calibration file path; searched in the config folder if None
     :return:
     """
     gray_level = 0
@@ -26,41 +84,94 @@ def read_calib():
     A = []
     v = []
     Gamma = []
-    basepath = './config'
-    file_num = 0
-    for root, dirs, names in os.walk(basepath):  # show names also in subfolders
-        for name in names:
-            if name.endswith(".rgb2lms"):
-                file_num += 1
-                file = open(root + '/' + name, "r", encoding='utf-8')
-                lines = file.read().splitlines()
-
-    if file_num < 1:
-        sys.exit('No calibration file is found.')
-    if file_num > 1:
-        sys.exit('Multiple calibration files are found. Please specify one!')
-    else:
-        for lidx, line in enumerate(lines):
-            if line.lstrip().find('gray-level') != -1:
-                gray_level = float(line.strip().split(": ")[1])
-            if line.lstrip().find("[A₀S, A₀M, A₀L]") != -1:  # strip(None) removes whitespace of the string
-                for b in lines[lidx + 1].strip().split(","):
-                    A0.append(float(b))
-            if line.lstrip().find("ArL, AgL, AbL") != -1:
-                for k in range(1, 4):
-                    for c in lines[lidx + k].strip().split(","):
-                        v.append(float(c))
-                    A.append(v)
-                    v = []
-            if line.lstrip().find("[rˠ, gˠ, bˠ]") != -1:
-                for b in lines[lidx + 1].strip().split(","):
-                    Gamma.append(float(b))
+    if calib_file is None:
+        calib_file = find_calib()
+    file = open(calib_file, "r", encoding='utf-8')
+    lines = file.read().splitlines()
+
+    for lidx, line in enumerate(lines):
+        if line.lstrip().find('gray-level') != -1:
+            gray_level = float(line.strip().split(": ")[1])
+        if line.lstrip().find("[A₀S, A₀M, A₀L]") != -1:  # strip(None) removes whitespace of the string
+            for b in lines[lidx + 1].strip().split(","):
+                A0.append(float(b))
+        if line.lstrip().find("ArL, AgL, AbL") != -1:
+            for k in range(1, 4):
+                for c in lines[lidx + k].strip().split(","):
+                    v.append(float(c))
+                A.append(v)
+                v = []
+        if line.lstrip().find("[rˠ, gˠ, bˠ]") != -1:
+            for b in lines[lidx + 1].strip().split(","):
+                Gamma.append(float(b))
 
     return gray_level, np.array(A0), np.array(A), np.array(Gamma)
 
 
+class Calibration:
+    def __init__(self, calib_file):
+        """
+        A display calibration, parsed once and kept in a binary cache (CALIB_CACHE/<hash>.npz) keyed by the hash of
+        the calibration file, so that it is only parsed again when the file changes.
+        All arrays are read-only, since they are shared by all ColorPickers of this calibration.
+
+        :param calib_file:  calibration file path
+        """
+        self.path = calib_file
+        self.id = os.path.splitext(os.path.basename(calib_file))[0]
+        self.hash = calib_hash(calib_file)
+        cache_path = os.path.join(CALIB_CACHE, self.hash + '.npz')
+        if os.path.exists(cache_path):
+            with np.load(cache_path, allow_pickle=False) as cache:
+                arrays = {key: cache[key] for key in cache.files}
+        else:
+            gray_level, A0, A, Gamma = read_calib(calib_file)
+            arrays = {'gray_level': np.array(gray_level),
+                      'A0': np.around(A0, decimals=10),
+                      'A': np.around(A, decimals=10),
+                      'Gamma': np.around(Gamma, decimals=10)}
+            arrays['InvA'] = np.linalg.pinv(arrays['A'])  # the inverse A
+            os.makedirs(CALIB_CACHE, exist_ok=True)
+            tmp_path = cache_path[:-len('.npz')] + '.tmp%d.npz' % os.getpid()  # processes may build it at once
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, cache_path)  # never leave a half-written cache behind
+
+        self.gray_level = float(arrays['gray_level'])
+        for key in ['A0', 'A', 'Gamma', 'InvA']:
+            arrays[key].setflags(write=False)
+            setattr(self, key, arrays[key])
+
+
+def get_calib(calib=None):
+    """
+    Get a calibration from the registry of this process, a dictionary lookup after its first use.
+
+    :param calib:   calibration id (file name without extension) or file path; the only calibration file if None
+    :return:        Calibration
+    """
+    calib_file = find_calib(calib)
+    stat = os.stat(calib_file)
+    key = (os.path.abspath(calib_file), stat.st_mtime_ns, stat.st_size)
+    if key not in _CALIBS:
+        _CALIBS[key] = Calibration(calib_file)
+    return _CALIBS[key]
+
+
+def level_changes(levels):
+    """
+    Mark where a run of identical display levels starts, so that repeated colors can be collapsed.
+
+    :param levels:  display levels in shape (N, 3), ordered by hue angle
+    :return:        boolean mask in shape (N,), True for the first color of every run
+    """
+    levels = np.asarray(levels)
+    new_level = np.ones(len(levels), dtype=bool)
+    new_level[1:] = np.any(levels[1:] != levels[:-1], axis=1)
+    return new_level
+
+
 class ColorPicker:
-    def __init__(self, c=0.15, sscale=2.6, unit='rad', depthBits=8, subject=None):
+    def __init__(self, c=0.15, sscale=2.6, unit='rad', depthBits=8, subject=None, calib=None):
         """
         Color Picker for generating sml and RGB values with hue angles on an iso-luminance plane.
 
@@ -75,11 +186,17 @@ class ColorPicker:
         :param unit:       hue angle unit: radian[default] or degree
         :param depthBits:  color depth: 8[default] or 10
         :param subject:    perform subjective adjustment if not None. Subject isolum files will be searched and used.
+        :param calib:      calibration id (file name without extension) or file path; default: the only calibration
+                           file in the config folder
         """
-        self.gray_level, A0, A, Gamma = read_calib()
-        self.A0 = np.around(A0, decimals=10)
-        self.A = np.around(A, decimals=10)
-        self.Gamma = np.around(Gamma, decimals=10)
+        self.calib = get_calib(calib)
+        self.calib_file = self.calib.path
+        self.calib_id = self.calib.id
+        self.calib_hash = self.calib.hash
+        self.gray_level = self.calib.gray_level
+        self.A0 = self.calib.A0
+        self.A = self.calib.A
+        self.Gamma = self.calib.Gamma
         self.c = c
         self.sscale = sscale
         self.unit = unit
@@ -92,48 +209,54 @@ class ColorPicker:
             raise ValueError
         self.subject = subject
 
+        # cached once per instance, so that generating colors is pure arithmetic
+        self.InvA = self.calib.InvA  # the inverse A, precomputed with the calibration
+        self.vertex_sum = self._vertex_sum()
+        self.isoslant_path = None
+        self.isoslant_mtime = None
+        self.isoslant = None
+        self.load_isoslant()
+        self.lut = None
+
     def rgb2sml(self, rgb):
         """
-        Transfrom from rgb to sml.
+        Transfrom from rgb to sml. Accepts a single triplet or an array of triplets in shape (N, 3).
 
         """
+        rgb = np.asarray(rgb, dtype=float)[..., :3]
         if self.depthBits == 8:
-            rgb = (rgb[0] % 256, rgb[1] % 256, rgb[2] % 256)
-            c = np.array(rgb)
+            c = rgb % 256
         elif self.depthBits == 10:
-            c = (np.array(rgb) + 1) / 2 * 1023  # rescaling [0, 1] into [-1,1] as Psychopy requires in colorSpace 'rgb'
+            c = (rgb + 1) / 2 * 1023  # rescaling [0, 1] into [-1,1] as Psychopy requires in colorSpace 'rgb'
         else:
             raise ValueError
-        if len(c) > 3:
-            c = np.resize(c, 3)
-        return np.squeeze(np.asarray(np.dot(self.A, np.power(c, self.Gamma)))) + self.A0
+        return np.dot(np.power(c, self.Gamma), self.A.T) + self.A0
 
     def sml2rgb(self, sml):
         """
-        Transfrom from sml to rgb.
+        Transfrom from sml to rgb. Accepts a single triplet or an array of triplets in shape (N, 3).
+        Colors out of the display gamut are not realizable: they are kept (8-bit) or wrapped (10-bit) with a warning,
+        see Gamut for checking hue angles and contrasts beforehand.
         """
-        InvA = np.linalg.pinv(np.around(self.A, decimals=10))  # compute the inverse A
-
-        c = np.array(sml)
-        rgb = np.power(np.abs(np.squeeze(np.asarray(np.dot(InvA, (c - self.A0))))), 1 / self.Gamma)
+        c = np.asarray(sml, dtype=float)
+        linear = np.dot(c - self.A0, self.InvA.T)
+        rgb = np.power(np.abs(linear), 1 / self.Gamma)
         if self.depthBits == 8:
-            if rgb.any() > 255:
-                sys.exit("transformed values are out of range!")
+            if np.any(linear < 0) or np.any(rgb > 255):
+                warnings.warn("transformed values are out of range!")
             np_rgb = np.array(rgb)
         elif self.depthBits == 10:
+            if np.any(linear < 0) or np.any(rgb > 1023):
+                warnings.warn("transformed values are out of range!")
             np_rgb = np.array(rgb) % 1024 / 1023 * 2 - 1  # scale to [-1, 1] used in Psychopy 'rgb' color space
-            if abs(np_rgb.any()) > 1:
-                sys.exit("transformed values are out of range!")
         else:
             raise ValueError
         return np_rgb
 
-    def center(self, gray_level=None):
+    def _vertex_sum(self):
         """
-        Calculate sml value of the central gray color based on the gray level (from 0 to 1.0).
+        Sum of the sml values of the black, red, green and blue vertices, i.e. the central gray at gray level 1.0.
         """
-        if gray_level is None:
-            gray_level = self.gray_level
         vertex1 = self.A0
         if self.depthBits == 8:
             vertex2 = self.rgb2sml((255, 0, 0))  # red
@@ -146,15 +269,24 @@ class ColorPicker:
         else:
             raise ValueError
         vertex8 = vertex2 + vertex3 + vertex4
-        c = (vertex8 + vertex1) * gray_level
-        return np.array(c)
+        return vertex8 + vertex1
 
-    def newcolor(self, theta, iris=True):
+    def center(self, gray_level=None):
         """
-        Generate any new color sml and rgb values based on a hue angle - can have subjective adjustment.
+        Calculate sml value of the central gray color based on the gray level (from 0 to 1.0).
         """
+        if gray_level is None:
+            gray_level = self.gray_level
+        c = self.vertex_sum * gray_level
+        return np.array(c)
 
-        sub_dlum = 0
+    def load_isoslant(self):
+        """
+        Search and read the isoslant file of the subject, and keep its parameters (dl, phi) for this instance.
+        """
+        self.isoslant_path = None
+        self.isoslant_mtime = None
+        self.isoslant = None
         isoslant_file = 0
 
         if self.subject is not None:
@@ -165,16 +297,7 @@ class ColorPicker:
                     for name in names:
                         if name.endswith('.isoslant'):
                             isoslant_file += 1
-                            filepath = basepath + '/' + name
-                            iso_dl = config_tools.read_value(filepath, ['dl'], sep=':')
-                            iso_phi = config_tools.read_value(filepath, ['phi'], sep=':')
-
-                            # sub_dlum += iso_dl * np.sin(theta + iso_phi)  # this is incorrect!
-
-                            # correct the calculation as it in iris-tool:
-                            sub_dlum += iso_dl * (np.cos(theta) * np.cos(iso_phi) +
-                                                  np.sin(theta) * np.sin(iso_phi))
-                            # print(str(theta) + ': ' + str(sub_dlum))
+                            self.isoslant_path = basepath + '/' + name
             if isoslant_file < 1:
                 warnings.warn("No isoslant file is found for this subject.")
             if isoslant_file > 1:
@@ -182,63 +305,274 @@ class ColorPicker:
         else:
             warnings.warn("No subjective adjustment is requested.")
 
-        sub_gray = self.center(gray_level=self.gray_level + sub_dlum)
+        if self.isoslant_path is not None:
+            iso_dl = config_tools.read_value(self.isoslant_path, ['dl'], sep=':')
+            iso_phi = config_tools.read_value(self.isoslant_path, ['phi'], sep=':')
+            self.isoslant = (iso_dl, iso_phi)
+            self.isoslant_mtime = os.path.getmtime(self.isoslant_path)
+
+    def refresh_isoslant(self):
+        """
+        Invalidate the cached isoslant parameters if the isoslant file has been changed, removed or added.
+        A hue lookup table in use is switched to the table of the new parameters, at the same resolution.
+
+        :return: True if the cached parameters have changed
+        """
+        if self.subject is None:
+            return False
+        if self.isoslant_path is not None and os.path.isfile(self.isoslant_path) \
+                and os.path.getmtime(self.isoslant_path) == self.isoslant_mtime:
+            return False
+        cached = self.isoslant
+        self.load_isoslant()
+        if self.isoslant == cached:
+            return False
+        if self.lut is not None:
+            self.use_lut(self.lut.hue_res)
+        return True
+
+    def isoslant_dlum(self, theta):
+        """
+        Luminance deviation of the subjective iso-luminance plane for an array of hue angles.
+
+        :param theta:   hue angles
+        :return:        luminance deviations in the same shape as theta; zeros if no adjustment is available
+        """
+        if self.isoslant is None:
+            return np.zeros(np.shape(theta))
+        iso_dl, iso_phi = self.isoslant
+
+        # sub_dlum = iso_dl * np.sin(theta + iso_phi)  # this is incorrect!
+
+        # correct the calculation as it in iris-tool:
+        return iso_dl * (np.cos(theta) * np.cos(iso_phi) + np.sin(theta) * np.sin(iso_phi))
+
+    def use_lut(self, hue_res=0.01):
+        """
+        Read colors from a precomputed hue lookup table instead of transforming every hue angle.
+        Hue angles are quantized to the table resolution.
+
+        :param hue_res: the resolution of hue angles in degree; None to switch back to the transformation
+        :return:        the lookup table
+        """
+        if hue_res is None:
+            self.lut = None
+        else:
+            self.lut = HueLUT(self, hue_res)
+        return self.lut
+
+    def newcolors(self, thetas, iris=True):
+        """
+        Generate sml and rgb values for an array of hue angles in one pass - can have subjective adjustment.
+        Colors are gathered from the lookup table if one is in use (see use_lut).
+
+        :param thetas:  N hue angles
+        :param iris:    use the transformation of iris-tool[default]
+        :return:        sml values in shape (N, 3), rgb values in shape (N, 3)
+        """
+        if self.lut is not None and iris is True:
+            return self.lut.colors(thetas)
+        return self.transform(thetas, iris=iris)
+
+    def transform(self, thetas, iris=True):
+        """
+        Transform an array of hue angles into sml and rgb values, bypassing any lookup table.
+
+        :param thetas:  N hue angles
+        :param iris:    use the transformation of iris-tool[default]
+        :return:        sml values in shape (N, 3), rgb values in shape (N, 3)
+        """
+        sml = self.hue2sml(thetas, iris=iris)
+        rgb = self.sml2rgb(sml)
+
+        return sml, rgb
+
+    def hue2sml(self, thetas, c=None, iris=True):
+        """
+        Transform an array of hue angles into sml values, at the contrast of this ColorPicker or at given contrasts.
+
+        :param thetas:  N hue angles
+        :param c:       contrast, or N contrasts; default: the contrast of this ColorPicker
+        :param iris:    use the transformation of iris-tool[default]
+        :return:        sml values in shape (N, 3)
+        """
+        if c is None:
+            c = self.c
+        theta = np.atleast_1d(np.asarray(thetas, dtype=float))
+        # the isoslant is evaluated on hue angles within one turn, as in the lookup tables and in sml2hue, so that
+        # hue angles below 0 or beyond one turn get the colors of their equivalents
+        theta = theta % (2 * np.pi if self.unit == 'rad' else 360)
+        sub_dlum = self.isoslant_dlum(theta)
+
+        # the gray point is linear in the gray level, so all subjective gray points are scaled copies of one vertex sum
+        sub_gray = np.outer(self.gray_level + sub_dlum, self.vertex_sum)
 
         if self.unit != 'rad':
             theta = theta * 2 * np.pi / 360
 
-        lmratio = 1 * sub_gray[2] / sub_gray[1]  # this ratio can be adjusted
+        lmratio = 1 * sub_gray[:, 2] / sub_gray[:, 1]  # this ratio can be adjusted
 
         if iris is True:
             # TODO: discuss and understand the transformation used in iris-tool dkl::iso_lum
-            sml = [sub_gray[0] * (1.0 + self.sscale * self.c * np.sin(theta)),
-                   sub_gray[1] * (1.0 - self.c / (1.0 + 1 / lmratio) * np.cos(theta)),
-                   sub_gray[2] * (1.0 + self.c / (1.0 + lmratio) * np.cos(theta))]
+            sml = np.column_stack([sub_gray[:, 0] * (1.0 + self.sscale * c * np.sin(theta)),
+                                   sub_gray[:, 1] * (1.0 - c / (1.0 + 1 / lmratio) * np.cos(theta)),
+                                   sub_gray[:, 2] * (1.0 + c / (1.0 + lmratio) * np.cos(theta))])
         else:
-            sml = [sub_gray[0] * (1.0 + self.sscale * self.c * np.sin(theta)),
-                   sub_gray[1] * (1.0 + self.c * np.cos(theta) * (1.0 - lmratio)),
-                   sub_gray[2] * (1.0 + self.c * np.cos(theta) * (1.0 - 1 / lmratio))]
+            sml = np.column_stack([sub_gray[:, 0] * (1.0 + self.sscale * c * np.sin(theta)),
+                                   sub_gray[:, 1] * (1.0 + c * np.cos(theta) * (1.0 - lmratio)),
+                                   sub_gray[:, 2] * (1.0 + c * np.cos(theta) * (1.0 - 1 / lmratio))])
+        return sml
 
-        rgb = self.sml2rgb(sml)
+    def sml2hue(self, sml, iris=True):
+        """
+        Inverse of transform: recover hue angles and chromatic contrasts from an array of sml values.
 
-        return sml, rgb
+        The luminance of the gray point is recovered as well; its deviation from the subjective iso-luminance plane
+        (see isoslant_dlum) is zero for colors generated by this ColorPicker, and shows otherwise how far a color lies
+        off the plane.
+
+        :param sml:     sml values in shape (N, 3), or a single triplet
+        :param iris:    use the transformation of iris-tool[default]
+        :return:        hue angles in the unit of this ColorPicker in [0, 360) or [0, 2pi), contrasts (c),
+                        and luminance deviations from the subjective iso-luminance plane, each in shape (N,)
+        """
+        u = np.atleast_2d(np.asarray(sml, dtype=float))[:, :3] / self.vertex_sum
+        lmratio = self.vertex_sum[2] / self.vertex_sum[1]
+
+        # M and L are weighted such that their chromatic modulations cancel, in both transformations
+        gray = (u[:, 1] + lmratio * u[:, 2]) / (1.0 + lmratio)
+        if iris is True:
+            c_cos = (u[:, 2] - u[:, 1]) / gray
+        else:
+            c_cos = (u[:, 2] - u[:, 1]) / gray / (lmratio - 1 / lmratio)
+        c_sin = (u[:, 0] / gray - 1.0) / self.sscale
+
+        theta = np.arctan2(c_sin, c_cos) % (2 * np.pi)
+        if self.unit != 'rad':
+            theta = theta * 360 / (2 * np.pi)
+        contrast = np.hypot(c_sin, c_cos)
+        dlum = gray - self.gray_level - self.isoslant_dlum(theta)
+        return theta, contrast, dlum
+
+    def rgb2hue(self, rgb, iris=True):
+        """
+        Inverse of transform: recover hue angles and chromatic contrasts from an array of rgb values.
+
+        Colors out of the display gamut, whose rgb values are wrapped by sml2rgb, cannot be recovered.
+
+        :param rgb:     rgb values in the color space of this ColorPicker in shape (N, 3), or a single triplet
+        :param iris:    use the transformation of iris-tool[default]
+        :return:        hue angles, contrasts and luminance deviations, see sml2hue
+        """
+        return self.sml2hue(self.rgb2sml(rgb), iris=iris)
+
+    def levels2rgb(self, levels):
+        """
+        Inverse of rgb2levels: rgb values of integer display levels.
+
+        :param levels:  display levels
+        :return:        rgb values in the color space of this ColorPicker
+        """
+        if self.depthBits == 10:
+            return np.asarray(levels, dtype=float) / 1023 * 2 - 1
+        return np.asarray(levels, dtype=float)
+
+    def displayed(self, thetas, iris=True):
+        """
+        Hue angles and contrasts which are truly displayed for an array of hue angles, i.e. after the rgb values are
+        quantized to the display levels of the color depth.
+
+        :param thetas:  N hue angles in the unit of this ColorPicker
+        :param iris:    use the transformation of iris-tool[default]
+        :return:        hue angles, contrasts and luminance deviations, see sml2hue
+        """
+        rgb = self.transform(thetas, iris=iris)[1]
+        return self.rgb2hue(self.levels2rgb(self.rgb2levels(rgb)), iris=iris)
+
+    def newcolor(self, theta, iris=True):
+        """
+        Generate any new color sml and rgb values based on a hue angle - can have subjective adjustment.
+        """
+        sml, rgb = self.newcolors([theta], iris=iris)
+
+        return sml[0], rgb[0]
+
+    def rgb2levels(self, rgb):
+        """
+        Quantize rgb values to the integer levels of the display color depth.
+
+        :param rgb: rgb values in the color space of this ColorPicker
+        :return:    display levels
+        """
+        if self.depthBits == 10:
+            return np.rint((np.asarray(rgb) + 1) / 2 * 1023)
+        return np.rint(np.asarray(rgb))
+
+    def colorlist_dir(self):
+        """
+        :return: the directory of the color lists and lookup tables of the subject of this ColorPicker
+        """
+        if self.subject is None:
+            return 'config/colorlist'
+        return 'config/colorlist/' + self.subject
+
+    def colors_key(self, contrast=True):
+        """
+        Key of precomputed colors (color lists, lookup tables) in their file names: contrast, sscale, unit,
+        calibration with its content hash, isoslant and subject, so that they are rebuilt whenever one of them changes.
+
+        :param contrast:    include the contrast, for colors which depend on it
+        :return:            the key
+        """
+        isoslant = 'None' if self.isoslant is None else '%.6g_%.6g' % tuple(self.isoslant)
+        return ('-c' + str(self.c) if contrast else '') + '-sscale' + str(self.sscale) + '-' + self.unit + \
+            '-calib-' + self.calib_id + '-' + self.calib_hash + '-iso' + isoslant + '-sub-' + str(self.subject)
+
+    def colorlist_paths(self, hue_res):
+        """
+        :param hue_res: the resolution of hue angles, i.e. hue angle bins
+        :return:        paths of the hue list and of the rgb list of this ColorPicker
+        """
+        name = str(self.depthBits) + 'bit-res' + str(hue_res) + self.colors_key() + '.npy'
+        return self.colorlist_dir() + '/hue-list-' + name, self.colorlist_dir() + '/rgb-list-' + name
 
     def gencolorlist(self, hue_res):
         """
-        Generate colors that are realizable in a 10-bit display and save them in a color list.
+        Generate colors that are realizable in the color depth of the display and save them in a color list.
+        Consecutive hue angles whose rgb falls on the same display levels are collapsed into the first one.
 
         :param hue_res: the resolution of hue angles, i.e. hue angle bins
         :return: all rgb, realizable rgb,
                  all theta, realizable theta
         """
-        if self.depthBits != 10:
-            sys.exit("The current depthBits is NOT 10-bit!")
-
-        theta = np.linspace(0, 360 - hue_res, int(360 / hue_res))
-        convt = [self.newcolor(theta=x) for x in theta]
-        rgb = [x[1] for x in convt]
-        rgb_res = 1 / 2 ** 10  # resolution of 10bit in [0, 1] scale
-        selrgb = []
-        seltheta = []
-        it = iter(list(range(0, len(rgb) - 2)))
-
-        for idx in it:
-            selrgb.append(rgb[idx])
-            seltheta.append(theta[idx])
-            if sum(abs(rgb[idx] - rgb[idx + 1]) > rgb_res) == 0:  # skip the repeated RGB
-                next(it)
-            if sum(abs(rgb[idx] - rgb[idx + 2]) > rgb_res) == 0:
-                next(it)
-                next(it)
-
-        subpath = 'config/colorlist/' + self.subject
-        if not os.path.exists(subpath):
-            os.makedirs(subpath)
-        np.save(subpath + '/hue-list-10bit-res' + str(hue_res) + '-sub-' + str(self.subject), seltheta)
-        np.save(subpath + '/rgb-list-10bit-res' + str(hue_res) + '-sub-' + str(self.subject), selrgb)
+        theta = np.linspace(0, 360 - hue_res, int(round(360 / hue_res)))
+        rgb = self.transform(theta)[1]
+        first = level_changes(self.rgb2levels(rgb))
+        selrgb = rgb[first]
+        seltheta = theta[first]
+
+        os.makedirs(self.colorlist_dir(), exist_ok=True)
+        for path, values in zip(self.colorlist_paths(hue_res), [seltheta, selrgb]):
+            tmp_path = path[:-len('.npy')] + '.tmp%d.npy' % os.getpid()  # processes may build it at once
+            np.save(tmp_path, values)
+            os.replace(tmp_path, path)  # never leave a half-written list behind
 
         return rgb, selrgb, theta, seltheta
 
+    def colorlist(self, hue_res):
+        """
+        Read the color list of this ColorPicker; it is only generated if there is none for its current key
+        (see colors_key), e.g. after a new calibration. Color lists can be built ahead of time by build_colorlists.
+
+        :param hue_res: the resolution of hue angles, i.e. hue angle bins
+        :return:        realizable theta, realizable rgb
+        """
+        hue_path, rgb_path = self.colorlist_paths(hue_res)
+        if not (os.path.exists(hue_path) and os.path.exists(rgb_path)):
+            warnings.warn("No color list is found for this calibration and these parameters, generate " + hue_path)
+            self.gencolorlist(hue_res)
+        return np.load(hue_path), np.load(rgb_path)
+
     def displaycolor(self, rgb):
         """
         Simply fill a window with the color RGB you want to dislplay.
@@ -258,13 +592,7 @@ class ColorPicker:
 
         """
         theta = np.linspace(0, 2 * np.pi, numStim, endpoint=False)
-
-        Msml = []
-        Mrgb = []
-        for t in theta:
-            sml, rgb = self.newcolor(theta=t)
-            Msml.append(sml)
-            Mrgb.append(rgb)
+        Msml, Mrgb = self.newcolors(theta)
 
         return Msml, Mrgb
 
@@ -299,11 +627,221 @@ class ColorPicker:
         winM.close()
 
 
+class HueLUT:
+    def __init__(self, colorpicker, hue_res=0.01):
+        """
+        Lookup table of hue angle -> sml, rgb and realizable hue angle on a regular hue grid.
+
+        The table is computed once per subject, contrast, sscale, unit, color depth, resolution, calibration and
+        isoslant (see ColorPicker.colors_key), saved in config/colorlist/subject and memory-mapped afterwards.
+        Each row holds [S, M, L, R, G, B, theta], where theta is the first grid hue angle (in degree) showing the same
+        display-quantized rgb, i.e. the hue angle that is truly realized on the display.
+
+        :param colorpicker: the ColorPicker whose transformation is tabulated
+        :param hue_res:     the resolution of hue angles in degree; must divide 360
+        """
+        self.hue_res = hue_res
+        self.unit = colorpicker.unit
+        self.n = int(round(360 / hue_res))
+        if abs(self.n * hue_res - 360) > 1e-9:
+            sys.exit("The hue resolution must divide 360 degrees!")
+
+        subpath = colorpicker.colorlist_dir()
+        self.path = subpath + '/hue-lut-' + str(colorpicker.depthBits) + 'bit-res' + str(hue_res) + \
+            colorpicker.colors_key() + '.npy'
+
+        if not os.path.exists(self.path):
+            if not os.path.exists(subpath):
+                os.makedirs(subpath)
+            tmp_path = self.path[:-len('.npy')] + '.tmp%d.npy' % os.getpid()  # processes may build it at once
+            np.save(tmp_path, self.build(colorpicker))
+            os.replace(tmp_path, self.path)  # never leave a half-written table behind
+        self.table = np.load(self.path, mmap_mode='r')
+
+    def build(self, colorpicker):
+        """
+        Compute all rows of the table.
+
+        :param colorpicker: the ColorPicker whose transformation is tabulated
+        :return:            table in shape (n, 7)
+        """
+        theta = np.arange(self.n) * self.hue_res
+        if self.unit == 'rad':
+            sml, rgb = colorpicker.transform(theta * 2 * np.pi / 360)
+        else:
+            sml, rgb = colorpicker.transform(theta)
+
+        new_level = level_changes(colorpicker.rgb2levels(rgb))
+        first = np.maximum.accumulate(np.where(new_level, np.arange(self.n), 0))
+
+        return np.column_stack([sml, rgb, theta[first]])
+
+    def index(self, thetas):
+        """
+        Table rows of the nearest grid hue angles.
+
+        :param thetas:  hue angles in the unit of the ColorPicker
+        :return:        row indices
+        """
+        theta = np.asarray(thetas, dtype=float)
+        if self.unit == 'rad':
+            theta = theta * 360 / (2 * np.pi)
+        # within one turn, as the transformation (see ColorPicker.hue2sml): hue angles just below a full turn take
+        # the last row, not the row of 0
+        return np.minimum(np.rint(theta % 360 / self.hue_res).astype(int), self.n - 1)
+
+    def colors(self, thetas):
+        """
+        Gather sml and rgb values for an array of hue angles.
+
+        :param thetas:  N hue angles in the unit of the ColorPicker
+        :return:        sml values in shape (N, 3), rgb values in shape (N, 3)
+        """
+        rows = self.table[self.index(np.atleast_1d(thetas))]
+        return rows[:, 0:3], rows[:, 3:6]
+
+    def realizable(self, thetas):
+        """
+        Hue angles that are truly displayed for the given hue angles.
+
+        :param thetas:  hue angles in the unit of the ColorPicker
+        :return:        realizable hue angles in degree
+        """
+        return self.table[self.index(thetas), 6]
+
+
+class Gamut:
+    def __init__(self, colorpicker, hue_res=0.01, iris=True):
+        """
+        Gamut boundary of the display: the maximal realizable contrast of every hue angle on a regular hue grid.
+
+        Along one hue angle, sml values are affine in the contrast, and so are the linear rgb values before the gamma
+        correction: p + c * q. A contrast is realizable as long as every linear value stays within [0, top], where top
+        is the highest display level raised to the gamma, which bounds the contrast of each channel in closed form.
+        The table is computed once per calibration, color depth, sscale, unit, isoslant and resolution (the contrast
+        of the ColorPicker does not matter), saved in config/colorlist/subject and memory-mapped afterwards.
+
+        :param colorpicker: the ColorPicker whose transformation is bounded
+        :param hue_res:     the resolution of hue angles in degree; must divide 360
+        :param iris:        use the transformation of iris-tool[default]
+        """
+        self.hue_res = hue_res
+        self.unit = colorpicker.unit
+        self.c = colorpicker.c
+        self.n = int(round(360 / hue_res))
+        if abs(self.n * hue_res - 360) > 1e-9:
+            sys.exit("The hue resolution must divide 360 degrees!")
+
+        subpath = colorpicker.colorlist_dir()
+        self.path = subpath + '/gamut-' + str(colorpicker.depthBits) + 'bit-res' + str(hue_res) + \
+            ('' if iris else '-noniris') + colorpicker.colors_key(contrast=False) + '.npy'
+
+        if not os.path.exists(self.path):
+            if not os.path.exists(subpath):
+                os.makedirs(subpath)
+            tmp_path = self.path[:-len('.npy')] + '.tmp%d.npy' % os.getpid()  # processes may build it at once
+            np.save(tmp_path, self.build(colorpicker, iris))
+            os.replace(tmp_path, self.path)  # never leave a half-written table behind
+        self.table = np.load(self.path, mmap_mode='r')
+
+    def build(self, colorpicker, iris=True):
+        """
+        Compute the maximal contrast of all grid hue angles.
+
+        :param colorpicker: the ColorPicker whose transformation is bounded
+        :param iris:        use the transformation of iris-tool[default]
+        :return:            maximal contrasts in shape (n,)
+        """
+        theta = np.arange(self.n) * self.hue_res
+        if self.unit == 'rad':
+            theta = theta * 2 * np.pi / 360
+        p = np.dot(colorpicker.hue2sml(theta, c=0.0, iris=iris) - colorpicker.A0, colorpicker.InvA.T)
+        q = np.dot(colorpicker.hue2sml(theta, c=1.0, iris=iris) - colorpicker.A0, colorpicker.InvA.T) - p
+        top = np.power(255.0 if colorpicker.depthBits == 8 else 1023.0, colorpicker.Gamma)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bound = np.where(q > 0, (top - p) / q, np.where(q < 0, -p / q, np.inf))
+        return np.clip(bound.min(axis=1), 0, None)  # 0 where even the gray point is out of the gamut
+
+    def index(self, thetas):
+        """
+        Table rows of the grid hue angles below and above the given hue angles.
+
+        :param thetas:  hue angles in the unit of the ColorPicker
+        :return:        row indices below, row indices above
+        """
+        theta = np.asarray(thetas, dtype=float)
+        if self.unit == 'rad':
+            theta = theta * 360 / (2 * np.pi)
+        below = np.floor(theta / self.hue_res + 1e-9).astype(int)
+        return below % self.n, (below + 1) % self.n
+
+    def max_contrast(self, thetas):
+        """
+        Maximal realizable contrasts of an array of hue angles, the lower one of the two neighbouring grid hue angles.
+
+        :param thetas:  hue angles in the unit of the ColorPicker
+        :return:        maximal contrasts in the same shape as thetas
+        """
+        below, above = self.index(thetas)
+        return np.minimum(self.table[below], self.table[above])
+
+    def limit(self):
+        """
+        :return: the maximal contrast which is realizable for all hue angles
+        """
+        return float(np.min(self.table))
+
+    def valid(self, thetas, c=None):
+        """
+        Validity mask of a batch of (hue angle, contrast) pairs.
+
+        :param thetas:  hue angles in the unit of the ColorPicker
+        :param c:       contrast, or contrasts in the same shape as thetas; default: the contrast of the ColorPicker
+        :return:        True where the color is realizable
+        """
+        if c is None:
+            c = self.c
+        return np.asarray(c) <= self.max_contrast(thetas)
+
+    def fraction_out(self, thetas, std=0.0, c=None):
+        """
+        Expected fraction of out-of-gamut colors of noise patches, i.e. of hue angles drawn from normal distributions
+        around the given hue angles; without noise, 1 for out-of-gamut hue angles and 0 otherwise.
+
+        :param thetas:  mean hue angles in the unit of the ColorPicker
+        :param std:     sd of the hue angles in the unit of the ColorPicker
+        :param c:       contrast; default: the contrast of the ColorPicker
+        :return:        fractions in the same shape as thetas
+        """
+        grid = np.arange(self.n) * self.hue_res
+        invalid = (~self.valid(grid * 2 * np.pi / 360 if self.unit == 'rad' else grid, c)).astype(float)
+        if std > 0:
+            std_deg = std * 360 / (2 * np.pi) if self.unit == 'rad' else std
+            distance = np.minimum(grid, 360 - grid)
+            kernel = np.exp(-0.5 * (distance / std_deg) ** 2)
+            kernel /= kernel.sum()
+            invalid = np.fft.irfft(np.fft.rfft(invalid) * np.fft.rfft(kernel), self.n)  # circular convolution
+            invalid = np.round(np.clip(invalid, 0, 1), 12)
+        below, above = self.index(thetas)
+        return np.maximum(invalid[below], invalid[above])
+
+
 "example: to show color circle"
 # ColorPicker(depthBits=8, subject=None).showcolorcircle(numStim=16)
 
-"example: to generate hue-list and rgb-list"
+"example: to recover the displayed hue angles of trials and of noise patches"
+# cp = ColorPicker(c=0.15, unit='deg', depthBits=10, subject='ysu')
+# theta, contrast, dlum = cp.displayed([standard, test])
+# theta, contrast, dlum = cp.displayed(standard + std * np.random.randn(16))
+# theta, contrast, dlum = cp.rgb2hue(rgb)
+
+"example: to check the display gamut"
+# gamut = Gamut(ColorPicker(c=0.145, unit='deg', depthBits=10, subject='ysu'))
+# gamut.limit(), gamut.valid(thetas, c), gamut.fraction_out(standards, std=10)
+
+"example: to generate hue-list and rgb-list (for all subjects and contrasts, see build_colorlists)"
 # ColorPicker(depthBits=10).gencolorlist(0.2)
 # ColorPicker(depthBits=10).gencolorlist(0.5)
 # ColorPicker(depthBits=10).gencolorlist(1.0)
-
+# ColorPicker(depthBits=10).gencolorlist(0.01)
@@ -10,19 +10,27 @@ This module contains all writing and reading functions for configuration files f
 Functions for writing:
     function write_cfg:     write experiment config file *.yaml
     function write_par:     write parameter file *.yaml
-    class WriteXpp:         write session log file *.yaml
+    class WriteXpp:         write session log file *.yaml and its trial log *.jsonl
     function write_xrl:     write subject log file *.xrl
+    function trials2yaml:   export a session log with its trials as a single *.yaml
 
 Functions for reading:
     function read_yml:      read all types of *.yaml
     function read_xrl:      read subject log file *.xrl
+    function read_trials:   read trial log file *.jsonl
+    function read_xpp:      read session log file *.yaml together with its trials
 
 @author: yannansu
 """
 import os
+import json
 import numpy as np
 import yaml
 
+# fields of every trial in session logs
+TRIAL_FIELDS = ['count', 'stimulus', 'standard_stim', 'test_stim', 'calculated_intensity', 'actual_intensity',
+                'judge', 'react_time', 'trial_time_stamp', 'dropped_frames']
+
 
 def read_yml(file_path):
     """
@@ -62,6 +70,7 @@ def write_cfg(file_path):
 
     cfg_dict['trial_nmb'] = 20
     cfg_dict['trial_dur'] = 1.5
+    cfg_dict['lut_res'] = 0.01
 
     with open(file_path, 'w') as file:
         yaml.dump(cfg_dict, file, default_flow_style=False, sort_keys=False)
@@ -144,35 +153,59 @@ def write_par(file_path, noise, method, seed=42, hue_num=8, min_max=None, start_
 
 
 class WriteXpp:
-    def __init__(self, subject, idx, dir_path='data'):
+    def __init__(self, subject, idx, dir_path='data', trial_log='jsonl', sync_every=10):
         """
         Create a log YAML file for one session.
+        Trials are appended line by line to a JSONL file next to it (*.jsonl), or to the YAML file itself.
 
         :param subject:     subject name [string]
         :param idx:         date and time [string]
         :param dir_path:    the directory for storing. default: data/subject
+        :param trial_log:   'jsonl' or 'yaml' (every trial dumped into the log YAML file)
+        :param sync_every:  force the trial log to disk (fsync) every n trials; 0 for never, it is flushed anyway
         """
-        if not os.path.exists('data/' + subject):
-            os.makedirs('data/' + subject)
-
         self.idx = idx
         if dir_path == 'data':
             self.file_path = os.path.join(dir_path, subject, subject + idx + '.yaml')
         else:
             self.file_path = os.path.join(dir_path, subject + idx + '.yaml')
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
         self.f = open(self.file_path, 'w+')
 
-    def head(self, cfg_file, par_file):
+        if trial_log not in ['jsonl', 'yaml']:
+            raise ValueError("trial_log should be 'jsonl' or 'yaml'!")
+        self.trial_log = trial_log
+        self.sync_every = sync_every
+        self.n_unsynced = 0
+        if trial_log == 'jsonl':
+            self.trial_path = os.path.splitext(self.file_path)[0] + '.jsonl'
+            self.t = open(self.trial_path, 'w')
+        else:
+            self.trial_path = self.file_path
+            self.t = self.f
+
+    def head(self, cfg_file, par_file, frame_rate=None, calib_id=None, calib_hash=None):
         """
         Copy the metadata from experiment config and parameter file into the head part of this log file.
 
         :param cfg_file:    experiment config file path
         :param par_file:    parameter file path
+        :param frame_rate:  measured refresh rate of the screen in Hz [optional]
+        :param calib_id:    id of the display calibration [optional]
+        :param calib_hash:  content hash of the display calibration file [optional]
         :return:            the log file path
         """
         info = {'time': self.idx,
                 'cfg_file': cfg_file,
                 'par_file': par_file}
+        if frame_rate is not None:
+            info['frame_rate'] = float(frame_rate)
+        if calib_id is not None:
+            info['calib_id'] = calib_id
+        if calib_hash is not None:
+            info['calib_hash'] = calib_hash
+        if self.trial_log == 'jsonl':
+            info['trials_file'] = os.path.basename(self.trial_path)
         # yaml.safe_dump(info, self.f, default_flow_style=False, sort_keys=False)
 
         cfg_dict = read_yml(cfg_file)
@@ -180,7 +213,7 @@ class WriteXpp:
         yaml.safe_dump({**info, **cfg_dict, **par_dict}, self.f, default_flow_style=False, sort_keys=False)
         return self.file_path
 
-    def task(self, count, cond, rot, disp_intensity, judge, react_time, trial_stamp):
+    def task(self, count, cond, rot, disp_intensity, judge, react_time, trial_stamp, dropped_frames=None):
         """
         Append log of every single trials in iterations to this log file.
 
@@ -191,21 +224,38 @@ class WriteXpp:
         :param disp_intensity:  the actual and realizable rotation of hue angle
         :param judge:           correctness, 0 or 1
         :param t:               reaction time
+        :param dropped_frames:  number of frames dropped during the frame-counted phases of this trial [optional]
+        """
+        trial = {'count': count,
+                 'stimulus': cond['stimulus'],
+                 'standard_stim': float(cond['standard']),
+                 'test_stim': float(cond['standard'] + rot),
+                 'calculated_intensity': float(rot),
+                 'actual_intensity': float(round(disp_intensity, 1)),
+                 'judge': judge,
+                 'react_time': react_time,
+                 'trial_time_stamp': trial_stamp}
+        if dropped_frames is not None:
+            trial['dropped_frames'] = int(dropped_frames)
+
+        if self.trial_log == 'jsonl':
+            self.t.write(json.dumps(trial) + '\n')
+        else:
+            yaml.safe_dump({'trial_' + str(count): trial}, self.t, default_flow_style=False, sort_keys=False)
+        self.t.flush()
+        self.n_unsynced += 1
+        if self.sync_every and self.n_unsynced >= self.sync_every:
+            os.fsync(self.t.fileno())
+            self.n_unsynced = 0
+
+    def close(self):
+        """
+        Force the logs to disk and close them, at the end of a session.
         """
-        trial_dict = {}
-        this_trial = 'trial_' + str(count)
-        trial_dict[this_trial] = {}
-        trial_dict[this_trial]['count'] = count
-        trial_dict[this_trial]['stimulus'] = cond['stimulus']
-        trial_dict[this_trial]['standard_stim'] = float(cond['standard'])
-        trial_dict[this_trial]['test_stim'] = float(cond['standard'] + rot)
-        trial_dict[this_trial]['calculated_intensity'] = float(rot)
-        trial_dict[this_trial]['actual_intensity'] = float(round(disp_intensity, 1))
-        trial_dict[this_trial]['judge'] = judge
-        trial_dict[this_trial]['react_time'] = react_time
-        trial_dict[this_trial]['trial_time_stamp'] = trial_stamp
-        yaml.safe_dump(trial_dict, self.f, default_flow_style=False, sort_keys=False)
-        self.f.flush()
+        for f in {self.f, self.t}:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
 
 
 def write_xrl(subject, cfg_file=None, par_file=None, xpp_file=None, break_info=None, xls_file=None, dir_path='data'):
@@ -251,6 +301,63 @@ def read_xrl(xrl_file):
     return sessions
 
 
+def read_trials(trials_file):
+    """
+    Read trial log file *.jsonl.
+
+    :param trials_file: trial log file path
+    :return:            a dictionary of columns, trials[field] = numpy array of all trials
+    """
+    with open(trials_file) as file:
+        rows = [json.loads(line) for line in file if line.strip()]
+    return _trial_columns(rows)
+
+
+def _trial_columns(rows):
+    fields = [f for f in TRIAL_FIELDS if any(f in row for row in rows)]
+    fields += [f for f in (rows[0] if rows else {}) if f not in fields]  # fields of older logs
+    trials = {}
+    for f in fields:
+        column = [row.get(f) for row in rows]
+        trials[f] = np.array(column, dtype=object) if None in column else np.array(column)
+    return trials
+
+
+def read_xpp(xpp_file):
+    """
+    Read session log file *.yaml together with its trials, either from its trial log *.jsonl,
+    or from the log YAML file itself (written with trial_log='yaml' or before trial logs existed).
+
+    :param xpp_file:    session log YAML path
+    :return:            a dictionary of the head part, and a dictionary of trial columns (see read_trials)
+    """
+    xpp = read_yml(xpp_file)
+    is_trial = {k: k.startswith('trial_') and k[len('trial_'):].isdigit() for k in xpp}
+    head = {k: v for k, v in xpp.items() if not is_trial[k]}
+    if 'trials_file' in head:
+        trials = read_trials(os.path.join(os.path.dirname(xpp_file), head['trials_file']))
+    else:
+        trials = _trial_columns([v for k, v in xpp.items() if is_trial[k]])
+    return head, trials
+
+
+def trials2yaml(xpp_file, yaml_file):
+    """
+    Export a session log with its trials as a single YAML file, in the format of trial_log='yaml'.
+
+    :param xpp_file:    session log YAML path
+    :param yaml_file:   exported YAML path
+    """
+    head, trials = read_xpp(xpp_file)
+    head.pop('trials_file', None)
+    fields = list(trials.keys())
+    with open(yaml_file, 'w') as file:
+        yaml.safe_dump(head, file, default_flow_style=False, sort_keys=False)
+        for values in zip(*trials.values()):
+            trial = {f: v.item() if isinstance(v, np.generic) else v for f, v in zip(fields, values)}
+            yaml.safe_dump({'trial_' + str(trial['count']): trial}, file, default_flow_style=False, sort_keys=False)
+
+
 """example"""
 
 
@@ -261,7 +368,10 @@ def read_xrl(xrl_file):
 # pseudo_cond = {'stimulus':'stimulus_0', 'label': 'hue_5p', 'standard': 180.0, 'leftRef': 190.0, 'rightRef': 170.0,
 # 'stairType': 'quest', 'startVal': 5.0, 'min_val': 1, 'max_val': 10, 'stepType': None, 'nReversals': 2, 'stepSizes':
 # [2, 1], 'nUp': None, 'nDown': None, 'startValSd': 10, 'pThreshold': None}
-# xpp.task(1, pseudo_cond, 5, 5.1, 0, 4.6)
+# xpp.task(1, pseudo_cond, 5, 5.1, 0, 4.6, 1600000000.0)
+# xpp.close()
+# head, trials = read_xpp('data/subject_example/subject_example20200000T0000.yaml')
+# trials2yaml('data/subject_example/subject_example20200000T0000.yaml', 'subject_example20200000T0000_export.yaml')
 # write_xrl('subject_example', cfg_file='metadata_examples/expconfig_example.yaml', par_file='metadata_examples/parameter_example.yaml',
 #           xpp_file='subject_example20200000T0000.yaml', break_info='userbreak')
 
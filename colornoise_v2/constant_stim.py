@@ -26,15 +26,16 @@ It saves results in data folder:
 import numpy as np
 import time
 from psychopy import visual, data, core, event, monitors, misc
-from psychopy.hardware import keyboard
 import os
 from colorpalette import ColorPicker
 import config_tools
+import datastore
 import sys
 import xlsxwriter
 import csv
-from bisect import bisect_left
 import argparse
+from stimqueue import StimQueue
+from frametimer import FrameTimer
 
 
 class Exp:
@@ -59,6 +60,7 @@ class Exp:
         self.trial_nmb = self.cfg['trial_nmb']
         self.trial_dur = self.cfg['trial_dur']
         self.depthBits = self.cfg['depthBits']
+        self.mask_n = [30, 20]  # horizontal and vertical number of rects in the checkerboard mask
 
         self.ColorPicker = ColorPicker(c=self.param['c'],
                                        sscale=self.param['sscale'],
@@ -66,11 +68,12 @@ class Exp:
                                        depthBits=self.depthBits,
                                        subject=self.subject)
         self.ColorSpace = self.ColorPicker.colorSpace
+        # gather colors from a hue lookup table; set lut_res to null in the config file to transform every hue angle
+        self.ColorPicker.use_lut(self.cfg.get('lut_res', 0.01))
 
-        hue_list_path = 'config/colorlist/' + self.subject
-        if not os.path.exists(hue_list_path):
-            self.ColorPicker.gencolorlist(0.2)
-        self.hue_list = hue_list_path + '/hue-list-10bit-res0.2-sub-' + self.subject + '.npy'
+        self.hue_list = self.ColorPicker.colorlist_paths(0.2)[0]
+        # realizable hue angles, sorted; the color list is only generated if there is none for its key
+        self.valid_theta = np.round(self.ColorPicker.colorlist(0.2)[0], decimals=1)
 
         self.Csml = self.ColorPicker.center()
         self.Crgb = self.ColorPicker.sml2rgb(self.ColorPicker.center())
@@ -85,25 +88,32 @@ class Exp:
                                  allowGUI=True,
                                  fullscr=True,
                                  bpc=(self.depthBits, self.depthBits, self.depthBits), depthBits=self.depthBits)
+        # stimulus objects are created once per session; trials only update colors, positions and text
+        self.stim_pool = self.make_pool()
+        # phases of a trial are presented for fixed numbers of frames
+        self.timer = FrameTimer(self.win)
 
     """stimulus features"""
 
-    def patch_ref(self, theta, pos):  # reference patches
+    def patch_ref(self, color, pos):  # reference patches
         ref = visual.Circle(win=self.win,
                             units='deg',
                             pos=pos,
                             radius=self.cfg['ref_size'],
                             fillColorSpace=self.ColorSpace,
                             lineColorSpace=self.ColorSpace)
-        ref.fillColor = self.ColorPicker.newcolor(theta=theta)[1]
+        ref.fillColor = color
         ref.lineColor = ref.fillColor
         return ref
 
-    def patch_stim(self, xlim, ylim):  # standard and test stimuli
+    def patch_pos(self, xlim, ylim):  # positions of patches in standard and test stimuli
         n = int(np.sqrt(self.patch_nmb))
         pos = [[x, y]
                for x in np.linspace(xlim[0], xlim[1], n)
                for y in np.linspace(ylim[0], ylim[1], n)]
+        return pos
+
+    def patch_stim(self, pos):  # standard and test stimuli
         patch = visual.ElementArrayStim(win=self.win,
                                         units='deg',
                                         fieldSize=self.cfg['field_size'],
@@ -115,16 +125,36 @@ class Exp:
                                         colorSpace=self.ColorSpace)
         return patch
 
+    def make_pool(self):
+        """
+        Create all stimulus objects used in trials, in a dictionary.
+        """
+        horiz_n, vertic_n = self.mask_n
+        mask = visual.ElementArrayStim(self.win, units='norm', nElements=horiz_n * vertic_n, elementMask=None,
+                                       elementTex=None,
+                                       sizes=(2 / horiz_n, 2 / vertic_n), colorSpace=self.ColorSpace)
+        mask.xys = [(x, y) for x in np.linspace(-1, 1, horiz_n, endpoint=False) + 1 / horiz_n
+                    for y in np.linspace(-1, 1, vertic_n, endpoint=False) + 1 / vertic_n]
+        pool = {'ref': self.patch_ref(color=self.Crgb, pos=self.cfg['ref.pos']),
+                'sPatch': self.patch_stim(self.patch_pos(self.cfg['standard.xlim'], self.cfg['standard.ylim'])),
+                'tPatch': self.patch_stim(self.patch_pos(self.cfg['test.xlim'], self.cfg['test.ylim'])),
+                'fix': visual.TextStim(self.win, text="+", units='deg', pos=[0, 0], height=0.5, color='black',
+                                       colorSpace=self.ColorSpace),
+                'num': visual.TextStim(self.win, text="trial 0", units='deg', pos=[12, -10], height=0.4,
+                                       color='black', colorSpace=self.ColorSpace),
+                'mask': mask}
+        return pool
+
 
     """color noise & noise conditions"""
 
-    def rand_color(self, theta, std, npatch):  # generate color noise
-        noise = np.random.normal(theta, std, npatch)
-        color = [self.ColorPicker.newcolor(theta=n) for n in noise]
-        sml, rgb = zip(*color)
+    def rand_color(self, theta, std, npatch, noise=None):  # generate color noise
+        if noise is None:
+            noise = np.random.normal(0, 1, npatch)  # standard normal samples, can be drawn ahead of time
+        sml, rgb = self.ColorPicker.newcolors(theta + std * np.asarray(noise))
         return sml, rgb
 
-    def choose_con(self, standard, test, std):  # choose noise condition
+    def choose_con(self, standard, test, std, sNoise=None, tNoise=None):  # choose noise condition
         sColor = None
         tColor = None
         if self.param['noise_condition'] == 'L-L':  # low - low noise
@@ -133,130 +163,166 @@ class Exp:
 
         elif self.param['noise_condition'] == 'L-H':  # low - high noise: only test stimulus has high noise
             sColor = self.ColorPicker.newcolor(theta=standard)[1]
-            tColor = self.rand_color(test, std, self.patch_nmb)[1]
+            tColor = self.rand_color(test, std, self.patch_nmb, tNoise)[1]
 
         elif self.param['noise_condition'] == 'H-H':  # high - high noise
-            sColor = self.rand_color(standard, std, self.patch_nmb)[1]
-            tColor = self.rand_color(test, std, self.patch_nmb)[1]
+            sColor = self.rand_color(standard, std, self.patch_nmb, sNoise)[1]
+            tColor = self.rand_color(test, std, self.patch_nmb, tNoise)[1]
 
         else:
             print("No noise condition corresponds to the input!")
 
         return sColor, tColor
 
+    """stimulus generation ahead of time"""
+
+    def gen_stim(self, cond=None, rot=None):
+        """
+        Generate the arrays of one trial without touching the window, so that it can run on a worker thread:
+        random patch positions, noise samples and mask colors; and also the reference and patch colors
+        if the condition and the rotation are given (see set_stim_colors).
+
+        :param cond:    condition of this trial
+        :param rot:     rotation of hue angle of the test stimulus
+        :return:        a dictionary of stimulus arrays
+        """
+        # Randomly assign patch positions: upper (+) or lower (-)
+        patchpos = [self.cfg['standard.ylim'],
+                    self.cfg['test.ylim']]
+        rndpos = patchpos.copy()
+        np.random.shuffle(rndpos)
+
+        stim = {'rndpos': rndpos,
+                'sPos': self.patch_pos(self.cfg['standard.xlim'], rndpos[0]),
+                'tPos': self.patch_pos(self.cfg['test.xlim'], rndpos[1]),
+                'sNoise': np.random.normal(0, 1, self.patch_nmb),
+                'tNoise': np.random.normal(0, 1, self.patch_nmb),
+                'maskColors': self.ColorPicker.newcolors(
+                    np.random.randint(0, high=360, size=self.mask_n[0] * self.mask_n[1]))[1]}
+        if cond is not None:
+            self.set_stim_colors(stim, cond, rot)
+        return stim
+
+    def set_stim_colors(self, stim, cond, rot):
+        """
+        Add the reference and patch colors of a trial to its stimulus arrays.
+
+        :param stim:    stimulus arrays from gen_stim
+        :param cond:    condition of this trial
+        :param rot:     rotation of hue angle of the test stimulus
+        """
+        standard = cond['standard']  # standard should be fixed
+        test = standard + rot
+        stim['refColor'] = self.ColorPicker.newcolor(theta=cond['ref'])[1]
+        stim['sColors'], stim['tColors'] = self.choose_con(standard, test, cond['std'], stim['sNoise'], stim['tNoise'])
+
     """tool fucntion"""
 
     def take_closest(self, arr, val):
         """
-        Assumes arr is sorted. Returns closest value to val (could be itself).
+        Assumes arr is sorted. Returns closest value to val (could be itself); val can be a number or an array.
         If two numbers are equally close, return the smallest number.
         """
-        pos = bisect_left(arr, val)
-        if pos == 0:
-            return arr[0]
-        if pos == len(arr):
-            return arr[-1]
+        val = np.asarray(val)
+        pos = np.clip(np.searchsorted(arr, val, side='left'), 1, len(arr) - 1)
         before = arr[pos - 1]
         after = arr[pos]
-        if after - val < val - before:
-            return after
-        else:
-            return before
+        return np.where(after - val < val - before, after, before)
+
+    def disp_hues(self, standard, test):
+        """
+        Hue angles truly displayed for the standard and the test, read from the hue lookup table if it is in use.
+        """
+        if self.ColorPicker.lut is not None:
+            return self.ColorPicker.lut.realizable([standard, test])
+        return self.take_closest(self.valid_theta, [standard, test])
 
     """main experiment"""
 
-    def run_trial(self, rot, cond, count):
+    def set_trial(self, stim, count):
+        """
+        Update the pooled stimulus objects with the arrays of one trial.
 
-        ref = self.patch_ref(theta=cond['ref'],
-                             pos=self.cfg['ref.pos'])
+        :param stim:    stimulus arrays from gen_stim, including colors
+        :param count:   count of this trial
+        :return:        reference, standard patch, test patch, fixation cross and trial number
+        """
+        ref = self.stim_pool['ref']
+        ref.fillColor = stim['refColor']
+        ref.lineColor = ref.fillColor
 
-        # randomly assign patch positions: upper (+) or lower (-)
-        patchpos = [self.cfg['standard.ylim'],
-                    self.cfg['test.ylim']]
-        rndpos = patchpos.copy()
-        np.random.shuffle(rndpos)
+        sPatch = self.stim_pool['sPatch']
+        tPatch = self.stim_pool['tPatch']
+        sPatch.xys, tPatch.xys = stim['sPos'], stim['tPos']
 
-        sPatch = self.patch_stim(self.cfg['standard.xlim'], rndpos[0])
-        tPatch = self.patch_stim(self.cfg['test.xlim'], rndpos[1])
+        # Set colors of two stimuli
+        sPatch.colors, tPatch.colors = stim['sColors'], stim['tColors']
 
-        # set colors of two stimuli
-        standard = cond['standard']  # standard should be fixed
-        test = standard + rot
-        sPatch.colors, tPatch.colors = self.choose_con(standard, test, cond['std'])
+        # Fixation cross & Number of trial
+        fix = self.stim_pool['fix']
+        num = self.stim_pool['num']
+        num.text = "trial " + str(count)
+        return ref, sPatch, tPatch, fix, num
 
-        # fixation cross
-        fix = visual.TextStim(self.win, text="+", units='deg', pos=[0, 0], height=0.5, color='black',
-                              colorSpace=self.ColorSpace)
-        # number of trial
-        num = visual.TextStim(self.win, text="trial " + str(count), units='deg', pos=[12, -10], height=0.4,
-                              color='black', colorSpace=self.ColorSpace)
+    def run_trial(self, rot, cond, count, stim=None):
 
-        trial_time_start = time.time()
+        # stimulus arrays are usually prepared ahead of time; only the colors may be left for this trial
+        if stim is None:
+            stim = self.gen_stim(cond, rot)
+        elif 'sColors' not in stim:
+            self.set_stim_colors(stim, cond, rot)
+        rndpos = stim['rndpos']
 
-        # present the standard and the test stimuli as well
-        fix.draw()
-        num.draw()
-        ref.draw()
-        sPatch.draw()
-        tPatch.draw()
-        self.win.flip()
-        core.wait(self.trial_dur)
+        ref, sPatch, tPatch, fix, num = self.set_trial(stim, count)
 
-        fix.draw()
-        self.win.flip()
-        core.wait(0.2)  # 0.2 sec gray background
-        react_time_start = time.time()
+        trial_time_start = time.time()
+        self.timer.start_trial()
 
-        # refresh the window and show a colored checkerboard
-        horiz_n = 30
-        vertic_n = 20
-        rect = visual.ElementArrayStim(self.win, units='norm', nElements=horiz_n * vertic_n, elementMask=None,
-                                       elementTex=None,
-                                       sizes=(2 / horiz_n, 2 / vertic_n), colorSpace=self.ColorSpace)
-        rect.xys = [(x, y) for x in np.linspace(-1, 1, horiz_n, endpoint=False) + 1 / horiz_n
-                    for y in np.linspace(-1, 1, vertic_n, endpoint=False) + 1 / vertic_n]
+        # present the standard and the test stimuli as well, for a fixed number of frames
+        self.timer.present([fix, num, ref, sPatch, tPatch], self.trial_dur)
+        self.timer.present([fix], 0.2)  # 0.2 sec gray background
+        event.clearEvents('keyboard')
 
-        rect.colors = [self.ColorPicker.newcolor(theta=x)[1] for x in
-                       np.random.randint(0, high=360, size=horiz_n * vertic_n)]
-        rect.draw()
-        self.win.flip()
-        core.wait(0.5)  # 0.5 sec checkerboard
+        # refresh the window and show a colored checkerboard
+        rect = self.stim_pool['mask']
+        rect.colors = stim['maskColors']
+        react_time_start, _ = self.timer.present([rect], 0.5)  # 0.5 sec checkerboard
 
         judge = None
         react_time_stop = -1
-        kb = keyboard.Keyboard()
-        get_keys = kb.getKeys(['up', 'down', 'escape'])  # if response during the checkerboard
-        if ('up' in get_keys and rndpos[1][0] > 0) or ('down' in get_keys and rndpos[1][0] < 0):
+        get_keys = event.getKeys(keyList=['up', 'down', 'escape'], timeStamped=self.timer.clock)
+        keys = [key for key, key_time in get_keys]  # if response during the checkerboard
+        if ('up' in keys and rndpos[1][0] > 0) or ('down' in keys and rndpos[1][0] < 0):
             judge = 1  # correct
-            react_time_stop = time.time()
-        elif ('up' in get_keys and rndpos[1][0] < 0) or ('down' in get_keys and rndpos[1][0] > 0):
+            react_time_stop = get_keys[0][1]
+        elif ('up' in keys and rndpos[1][0] < 0) or ('down' in keys and rndpos[1][0] > 0):
             judge = 0  # incorrect
-            react_time_stop = time.time()
-        if 'escape' in get_keys:
+            react_time_stop = get_keys[0][1]
+        if 'escape' in keys:
             config_tools.write_xrl(self.subject, break_info='userbreak')
             core.quit()
 
-        self.win.flip()
+        self.timer.flip()  # end of the checkerboard, the last frame counted for dropped frames
         fix.draw()
         self.win.flip()
 
         if judge is None:  # if response after the checkerboard
-            for wait_keys in event.waitKeys():
+            for wait_keys, key_time in event.waitKeys(timeStamped=self.timer.clock):
                 if (wait_keys == 'up' and rndpos[1][0] > 0) or (
                         wait_keys == 'down' and rndpos[1][0] < 0):
                     judge = 1  # correct
-                    react_time_stop = time.time()
+                    react_time_stop = key_time
                 elif (wait_keys == 'up' and rndpos[1][0] < 0) or (
                         wait_keys == 'down' and rndpos[1][0] > 0):
                     judge = 0  # incorrect
-                    react_time_stop = time.time()
+                    react_time_stop = key_time
                 elif wait_keys == 'escape':
                     config_tools.write_xrl(self.subject, break_info='userbreak')
                     core.quit()
 
         react_time = react_time_stop - react_time_start
 
-        return judge, react_time, trial_time_start
+        return judge, react_time, trial_time_start, self.timer.dropped
 
     def run_session(self):
 
@@ -276,6 +342,11 @@ class Exp:
         self.win.flip()
         event.waitKeys()
 
+        # the isoslant may have been refitted since the session was prepared
+        if self.ColorPicker.refresh_isoslant():
+            self.hue_list = self.ColorPicker.colorlist_paths(0.2)[0]
+            self.valid_theta = np.round(self.ColorPicker.colorlist(0.2)[0], decimals=1)
+
         # read staircase parameters
         conditions = [dict({'stimulus': key}, **value) for key, value in self.param.items() if
                       key.startswith('stimulus')]
@@ -297,7 +368,7 @@ class Exp:
 
         # write configuration files
         xpp = config_tools.WriteXpp(self.subject, self.idx)
-        xpp_file = xpp.head(self.cfg_file, self.par_file)
+        xpp_file = xpp.head(self.cfg_file, self.par_file, self.timer.frame_rate)
         config_tools.write_xrl(self.subject, cfg_file=self.cfg_file, par_file=self.par_file, xpp_file=xpp_file)
 
         xlsname = path + '/' + self.idx + self.param['noise_condition'] + '.xlsx'
@@ -307,25 +378,34 @@ class Exp:
         if isinstance(stairs, data.TrialHandler):
             count = 0
             results = {cond['label']: [] for cond in conditions}
+
+            # the order of constant stimuli is fixed once the TrialHandler is created, so all stimuli of this session
+            # can be generated ahead of time
+            trial_order = [stairs.trialList[stairs.sequenceIndices[trial_n][rep_n]]
+                           for rep_n in range(stairs.nReps) for trial_n in range(len(stairs.trialList))]
+            stim_queue = StimQueue(self.gen_stim, [(t['cond'], t['diff']) for t in trial_order])
+
             for trial in stairs:
                 count += 1
-                judge, react_time, trial_time_start = self.run_trial(trial['diff'], trial['cond'], count)
-                valid_theta = np.round(np.load(self.hue_list), decimals=1)
-                disp_standard = self.take_closest(valid_theta, cond['standard'])
+                judge, react_time, trial_time_start, dropped_frames = self.run_trial(trial['diff'], trial['cond'],
+                                                                                     count, stim_queue.get())
                 stair_test = cond['standard'] + trial['diff']
                 if stair_test < 0:
                     stair_test += 360
-                disp_test = self.take_closest(valid_theta, stair_test)
+                disp_standard, disp_test = self.disp_hues(cond['standard'], stair_test)
                 disp_intensity = disp_test - disp_standard
                 if disp_intensity > 300:
                     disp_intensity = (disp_test + disp_standard) - 360
-                xpp.task(count, cond, cond['diff'], float(disp_intensity), judge, react_time, trial_time_start)
+                xpp.task(count, cond, cond['diff'], float(disp_intensity), judge, react_time, trial_time_start,
+                         dropped_frames)
                 results[trial['label']].append((trial['diff'], judge))
 
                 if 'escape' in event.waitKeys():
                     config_tools.write_xrl(self.subject, break_info='userbreak')
                     core.quit()
+            stim_queue.stop()
 
+            xpp.close()
             config_tools.write_xrl(self.subject, xls_file=xlsname)
 
             # save results in xls-file
@@ -340,6 +420,7 @@ class Exp:
                     worksheet.write('C' + str(i + 2), res_diff)
                     worksheet.write('D' + str(i + 2), res_resp)
             workbook.close()
+            datastore.store_xlsx(xlsname)  # for analysis, alongside the xlsx
         else:
             sys.exit("The stimuli are not constant!")
 
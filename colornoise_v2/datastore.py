@@ -0,0 +1,228 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+
+# python version 3.7.6
+"""
+This module keeps the results of all sessions in one HDF5 store per data directory (results.h5), next to the xlsx
+workbooks, so that analyses load them in bulk instead of parsing every workbook with openpyxl.
+All sessions are in one table: the sheets of the workbooks stacked, partitioned by the columns 'session' and
+'label' (hue label). A second table keeps the modification time and size of the workbook of every session, so that
+rewritten workbooks are read again.
+
+Write the results of a session, at the end of the session:
+    store_xlsx(xls_file)
+Convert the existing data tree once, in Python3.7 or in bash:
+    convert_tree(data_dir)
+    python3.7 datastore.py [optional data_dir]
+Read the results of sessions, as pd.read_excel(xls_file, sheet_name=None) would:
+    read_sessions(xls_files)
+
+HDF5 stores are written with pandas and PyTables (which comes with PsychoPy for iohub). Without PyTables, the
+workbooks are read as before.
+
+@author: yannansu
+"""
+import os
+import glob
+import warnings
+import numpy as np
+import pandas as pd
+import argparse
+
+try:
+    import tables
+except ImportError:
+    tables = None
+
+STORE_NAME = 'results.h5'
+TABLE = 'results'  # the table of all sessions in a store
+FILES = 'files'  # modification times and sizes of the xlsx files of all sessions in a store
+
+
+def store_path(xls_file):
+    """
+    :param xls_file:    data xlsx file path
+    :return:            the store of the directory of this xlsx file
+    """
+    return os.path.join(os.path.dirname(xls_file), STORE_NAME)
+
+
+def session_key(xls_file):
+    """
+    :param xls_file:    data xlsx file path
+    :return:            the session name in the store, e.g. '20200916T1708L-L'
+    """
+    return os.path.splitext(os.path.basename(xls_file))[0]
+
+
+def file_stat(xls_file):
+    """
+    :param xls_file:    data xlsx file path
+    :return:            modification time (ns) and size of this xlsx file, None if it does not exist
+    """
+    if not os.path.exists(xls_file):
+        return None
+    stat = os.stat(xls_file)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def stack_sheets(xls_file, sheets):
+    """
+    :param xls_file:    data xlsx file path
+    :param sheets:      a dictionary of sheets (dataframes) with hue labels as keys
+    :return:            one dataframe with the columns 'session' and 'label'
+    """
+    return pd.concat([sheet.assign(session=session_key(xls_file), label=label) for label, sheet in sheets.items()],
+                     ignore_index=True)
+
+
+def split_sheets(table):
+    """
+    Split a table of stacked sheets into sessions and sheets; rows of one sheet are contiguous.
+
+    :param table:   a dataframe from stack_sheets, or of several sessions
+    :return:        a dictionary of sessions, each a dictionary of sheets with hue labels as keys
+    """
+    session = table['session'].to_numpy()
+    label = table['label'].to_numpy()
+    columns = {c: table[c].to_numpy() for c in table.columns if c not in ['session', 'label']}
+    starts = np.flatnonzero(np.r_[True, (session[1:] != session[:-1]) | (label[1:] != label[:-1])])
+    ends = np.r_[starts[1:], len(table)]
+    sessions = {}
+    for start, end in zip(starts, ends):
+        sessions.setdefault(session[start], {})[label[start]] = pd.DataFrame({c: v[start:end]
+                                                                            for c, v in columns.items()})
+    return sessions
+
+
+def store_sheets(xls_file, sheets):
+    """
+    Put the sheets of a session into the store, replacing earlier ones of this session, together with the
+    modification time and size of its xlsx file.
+
+    :param xls_file:    data xlsx file path
+    :param sheets:      a dictionary of sheets with hue labels as keys
+    """
+    stat = file_stat(xls_file)
+    where = 'session == %r' % session_key(xls_file)
+    with pd.HDFStore(store_path(xls_file), mode='a') as store:
+        for table in [TABLE, FILES]:
+            if table in store:
+                store.remove(table, where=where)
+        store.append(TABLE, stack_sheets(xls_file, sheets), format='table', data_columns=['session', 'label'],
+                     min_itemsize={'session': 64, 'label': 32}, index=False)
+        if stat is not None:
+            store.append(FILES, pd.DataFrame({'session': [session_key(xls_file)], 'mtime_ns': [stat[0]],
+                                              'size': [stat[1]]}),
+                         format='table', data_columns=['session'], min_itemsize={'session': 64}, index=False)
+
+
+def stored_sessions(path):
+    """
+    :param path:    store path
+    :return:        a dictionary of all sessions in this store (see split_sheets)
+    """
+    if not os.path.exists(path):
+        return {}
+    with pd.HDFStore(path, mode='r') as store:
+        if TABLE not in store:
+            return {}
+        return split_sheets(store.select(TABLE))
+
+
+def stored_files(path):
+    """
+    :param path:    store path
+    :return:        a dictionary of sessions -> modification time (ns) and size of their xlsx files when stored
+    """
+    if not os.path.exists(path):
+        return {}
+    with pd.HDFStore(path, mode='r') as store:
+        if FILES not in store:
+            return {}
+        files = store.select(FILES)
+    return {session: (int(mtime_ns), int(size))
+            for session, mtime_ns, size in zip(files['session'], files['mtime_ns'], files['size'])}
+
+
+def is_stale(xls_file, files):
+    """
+    :param xls_file:    data xlsx file path
+    :param files:       stored modification times and sizes, from stored_files
+    :return:            True if the xlsx file has been changed since its session was stored (or is not recorded)
+    """
+    stat = file_stat(xls_file)
+    return stat is not None and files.get(session_key(xls_file)) != stat
+
+
+def store_xlsx(xls_file):
+    """
+    Read a data xlsx file once and put it into the store, e.g. at the end of a session.
+
+    :param xls_file:    data xlsx file path
+    """
+    if tables is None:
+        warnings.warn('PyTables is not available, results are only saved in ' + xls_file)
+        return
+    store_sheets(xls_file, pd.read_excel(pd.ExcelFile(xls_file), sheet_name=None))
+
+
+def read_sessions(xls_files):
+    """
+    Read the results of sessions from the stores. Sessions missing in the stores, or whose xlsx files have been
+    changed since, are read from their xlsx files and (re)stored.
+
+    :param xls_files:   data xlsx file paths
+    :return:            a list of dictionaries of sheets, in the order of xls_files
+    """
+    if tables is None:
+        return [pd.read_excel(pd.ExcelFile(f), sheet_name=None) for f in xls_files]
+
+    paths = set(store_path(f) for f in xls_files)
+    stored = {path: stored_sessions(path) for path in paths}
+    files = {path: stored_files(path) for path in paths}
+    sessions = []
+    for xls_file in xls_files:
+        sheets = stored[store_path(xls_file)].get(session_key(xls_file))
+        if sheets is None or is_stale(xls_file, files[store_path(xls_file)]):
+            sheets = pd.read_excel(pd.ExcelFile(xls_file), sheet_name=None)
+            store_sheets(xls_file, sheets)
+        sessions.append(sheets)
+    return sessions
+
+
+def convert_tree(data_dir='data', overwrite=False):
+    """
+    Convert all data xlsx files under a directory into stores, one store per directory. Sessions whose xlsx files
+    have been changed since they were stored are converted again.
+
+    :param data_dir:    data directory, e.g. 'data' or 'data/ysu'
+    :param overwrite:   convert all sessions which are already in the stores again
+    :return:            number of converted sessions
+    """
+    if tables is None:
+        raise ImportError('PyTables is required for converting data into HDF5 stores!')
+    xls_files = sorted(glob.glob(os.path.join(data_dir, '**', '*.xlsx'), recursive=True))
+    paths = set(store_path(f) for f in xls_files)
+    stored = {path: set(stored_sessions(path)) for path in paths}
+    files = {path: stored_files(path) for path in paths}
+    count = 0
+    for xls_file in xls_files:
+        if overwrite or session_key(xls_file) not in stored[store_path(xls_file)] or \
+                is_stale(xls_file, files[store_path(xls_file)]):
+            store_sheets(xls_file, pd.read_excel(pd.ExcelFile(xls_file), sheet_name=None))
+            count += 1
+    return count
+
+
+"""example"""
+
+# convert_tree('data')
+# sheets = read_sessions(['data/ysu/20200916T1708L-L.xlsx'])[0]
+
+""" convert data in bash """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_dir', nargs='?', default='data')
+    args = parser.parse_args()
+    print(str(convert_tree(args.data_dir)) + ' sessions converted.')
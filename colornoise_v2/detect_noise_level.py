@@ -8,14 +8,14 @@ Created on 25.09.20
 import numpy as np
 import time
 from psychopy import visual, data, core, event, monitors, misc
-from psychopy.hardware import keyboard
 import os
 from colorpalette import ColorPicker
+from frametimer import FrameTimer
 import config_tools
+import datastore
 import sys
 import xlsxwriter
 import csv
-from bisect import bisect_left
 import argparse
 
 
@@ -41,6 +41,7 @@ class Exp:
         self.trial_nmb = self.cfg['trial_nmb']
         self.trial_dur = self.cfg['trial_dur']
         self.depthBits = self.cfg['depthBits']
+        self.mask_n = [30, 20]  # horizontal and vertical number of rects in the checkerboard mask
 
         self.ColorPicker = ColorPicker(c=self.param['c'],
                                        sscale=self.param['sscale'],
@@ -48,11 +49,10 @@ class Exp:
                                        depthBits=self.depthBits,
                                        subject=self.subject)
         self.ColorSpace = self.ColorPicker.colorSpace
+        # gather colors from a hue lookup table; set lut_res to null in the config file to transform every hue angle
+        self.ColorPicker.use_lut(self.cfg.get('lut_res', 0.01))
 
-        hue_list_path = 'config/colorlist/' + self.subject
-        if not os.path.exists(hue_list_path):
-            self.ColorPicker.gencolorlist(0.2)
-        self.hue_list = hue_list_path + '/hue-list-10bit-res0.2-sub-' + self.subject + '.npy'
+        self.hue_list = self.ColorPicker.colorlist_paths(0.2)[0]
 
         self.Csml = self.ColorPicker.center()
         self.Crgb = self.ColorPicker.sml2rgb(self.ColorPicker.center())
@@ -67,24 +67,31 @@ class Exp:
                                  allowGUI=True,
                                  fullscr=True,
                                  bpc=(self.depthBits, self.depthBits, self.depthBits), depthBits=self.depthBits)
+        # stimulus objects are created once per session; trials only update colors, positions and text
+        self.stim_pool = self.make_pool()
+        # phases of a trial are presented for fixed numbers of frames
+        self.timer = FrameTimer(self.win)
 
     """stimulus features"""
-    def patch_ref(self, theta, pos):  # reference patches
+    def patch_ref(self, color, pos):  # reference patches
         ref = visual.Circle(win=self.win,
                             units='deg',
                             pos=pos,
                             radius=self.cfg['ref_size'],
                             fillColorSpace=self.ColorSpace,
                             lineColorSpace=self.ColorSpace)
-        ref.fillColor = self.ColorPicker.newcolor(theta=theta)[1]
+        ref.fillColor = color
         ref.lineColor = ref.fillColor
         return ref
 
-    def patch_stim(self, xlim, ylim):  # standard and test stimuli
+    def patch_pos(self, xlim, ylim):  # positions of patches in standard and test stimuli
         n = int(np.sqrt(self.patch_nmb))
         pos = [[x, y]
                for x in np.linspace(xlim[0], xlim[1], n)
                for y in np.linspace(ylim[0], ylim[1], n)]
+        return pos
+
+    def patch_stim(self, pos):  # standard and test stimuli
         patch = visual.ElementArrayStim(win=self.win,
                                         units='deg',
                                         fieldSize=self.cfg['field_size'],
@@ -96,13 +103,31 @@ class Exp:
                                         colorSpace=self.ColorSpace)
         return patch
 
+    def make_pool(self):
+        """
+        Create all stimulus objects used in trials, in a dictionary.
+        """
+        horiz_n, vertic_n = self.mask_n
+        mask = visual.ElementArrayStim(self.win, units='norm', nElements=horiz_n * vertic_n, elementMask=None,
+                                       elementTex=None,
+                                       sizes=(2 / horiz_n, 2 / vertic_n), colorSpace=self.ColorSpace)
+        mask.xys = [(x, y) for x in np.linspace(-1, 1, horiz_n, endpoint=False) + 1 / horiz_n
+                    for y in np.linspace(-1, 1, vertic_n, endpoint=False) + 1 / vertic_n]
+        pool = {'ref': self.patch_ref(color=self.Crgb, pos=self.cfg['ref.pos']),
+                'sPatch': self.patch_stim(self.patch_pos(self.cfg['standard.xlim'], self.cfg['standard.ylim'])),
+                'tPatch': self.patch_stim(self.patch_pos(self.cfg['test.xlim'], self.cfg['test.ylim'])),
+                'fix': visual.TextStim(self.win, text="+", units='deg', pos=[0, 0], height=0.5, color='black',
+                                       colorSpace=self.ColorSpace),
+                'num': visual.TextStim(self.win, text="trial 0", units='deg', pos=[12, -10], height=0.4,
+                                       color='black', colorSpace=self.ColorSpace),
+                'mask': mask}
+        return pool
 
     """color noise & noise conditions"""
 
     def rand_color(self, theta, std, npatch):  # generate color noise
         noise = np.random.normal(theta, std, npatch)
-        color = [self.ColorPicker.newcolor(theta=n) for n in noise]
-        sml, rgb = zip(*color)
+        sml, rgb = self.ColorPicker.newcolors(noise)
         return sml, rgb
 
     def choose_con(self, standard, test, std):  # choose noise condition
@@ -129,26 +154,21 @@ class Exp:
 
     def take_closest(self, arr, val):
         """
-        Assumes arr is sorted. Returns closest value to val (could be itself).
+        Assumes arr is sorted. Returns closest value to val (could be itself); val can be a number or an array.
         If two numbers are equally close, return the smallest number.
         """
-        pos = bisect_left(arr, val)
-        if pos == 0:
-            return arr[0]
-        if pos == len(arr):
-            return arr[-1]
+        val = np.asarray(val)
+        pos = np.clip(np.searchsorted(arr, val, side='left'), 1, len(arr) - 1)
         before = arr[pos - 1]
         after = arr[pos]
-        if after - val < val - before:
-            return after
-        else:
-            return before
+        return np.where(after - val < val - before, after, before)
 
     """main experiment"""
     def run_trial(self, std, cond, count):
 
-        ref = self.patch_ref(theta=cond['ref'],
-                             pos=self.cfg['ref.pos'])
+        ref = self.stim_pool['ref']
+        ref.fillColor = self.ColorPicker.newcolor(theta=cond['ref'])[1]
+        ref.lineColor = ref.fillColor
 
         # randomly assign patch positions: upper (+) or lower (-)
         patchpos = [self.cfg['standard.ylim'],
@@ -156,8 +176,10 @@ class Exp:
         rndpos = patchpos.copy()
         np.random.shuffle(rndpos)
 
-        sPatch = self.patch_stim(self.cfg['standard.xlim'], rndpos[0])
-        tPatch = self.patch_stim(self.cfg['test.xlim'], rndpos[1])
+        sPatch = self.stim_pool['sPatch']
+        tPatch = self.stim_pool['tPatch']
+        sPatch.xys = self.patch_pos(self.cfg['standard.xlim'], rndpos[0])
+        tPatch.xys = self.patch_pos(self.cfg['test.xlim'], rndpos[1])
 
         # set colors of two stimuli
         standard = cond['standard']  # standard should be fixed
@@ -165,77 +187,65 @@ class Exp:
         sPatch.colors, tPatch.colors = self.choose_con(standard, test, std)
 
         # fixation cross
-        fix = visual.TextStim(self.win, text="+", units='deg', pos=[0, 0], height=0.5, color='black',
-                              colorSpace=self.ColorSpace)
+        fix = self.stim_pool['fix']
         # number of trial
-        num = visual.TextStim(self.win, text="trial " + str(count), units='deg', pos=[12, -10], height=0.4,
-                              color='black', colorSpace=self.ColorSpace)
+        num = self.stim_pool['num']
+        num.text = "trial " + str(count)
+
+        # colored checkerboard, prepared before the timed phases
+        horiz_n, vertic_n = self.mask_n
+        rect = self.stim_pool['mask']
+        rect.colors = self.ColorPicker.newcolors(np.random.randint(0, high=360, size=horiz_n * vertic_n))[1]
 
         trial_time_start = time.time()
+        self.timer.start_trial()
 
-        fix.draw()
-        num.draw()
-        ref.draw()
-        sPatch.draw()
-        tPatch.draw()
-        self.win.flip()
-        core.wait(self.trial_dur)
+        # present the stimuli for a fixed number of frames
+        self.timer.present([fix, num, ref, sPatch, tPatch], self.trial_dur)
+        event.clearEvents('keyboard')
 
         judge = None
         react_time_stop = -1
-        react_time_start = time.time()
 
         # refresh the window and show a colored checkerboard
-        horiz_n = 30
-        vertic_n = 20
-        rect = visual.ElementArrayStim(self.win, units='norm', nElements=horiz_n * vertic_n, elementMask=None,
-                                       elementTex=None,
-                                       sizes=(2 / horiz_n, 2 / vertic_n), colorSpace=self.ColorSpace)
-        rect.xys = [(x, y) for x in np.linspace(-1, 1, horiz_n, endpoint=False) + 1 / horiz_n
-                    for y in np.linspace(-1, 1, vertic_n, endpoint=False) + 1 / vertic_n]
-
-        rect.colors = [self.ColorPicker.newcolor(theta=x)[1] for x in
-                       np.random.randint(0, high=360, size=horiz_n * vertic_n)]
-        rect.draw()
-        self.win.flip()
-        core.wait(0.5)  # 0.5 sec checkerboard
+        react_time_start, _ = self.timer.present([rect], 0.5)  # 0.5 sec checkerboard
 
         # If response is given during the mask
         if judge is None:
-            kb = keyboard.Keyboard()
-            get_keys = kb.getKeys(['up', 'down', 'escape'])  # if response during the checkerboard
-            if ('up' in get_keys and rndpos[1][0] > 0) or ('down' in get_keys and rndpos[1][0] < 0):
+            get_keys = event.getKeys(keyList=['up', 'down', 'escape'], timeStamped=self.timer.clock)
+            keys = [key for key, key_time in get_keys]  # if response during the checkerboard
+            if ('up' in keys and rndpos[1][0] > 0) or ('down' in keys and rndpos[1][0] < 0):
                 judge = 1  # correct
-                react_time_stop = time.time()
-            elif ('up' in get_keys and rndpos[1][0] < 0) or ('down' in get_keys and rndpos[1][0] > 0):
+                react_time_stop = get_keys[0][1]
+            elif ('up' in keys and rndpos[1][0] < 0) or ('down' in keys and rndpos[1][0] > 0):
                 judge = 0  # incorrect
-                react_time_stop = time.time()
-            if 'escape' in get_keys:
+                react_time_stop = get_keys[0][1]
+            if 'escape' in keys:
                 config_tools.write_xrl(self.subject, break_info='userbreak')
                 core.quit()
 
         # Refresh and wait for response (if no response was given in the pause mode or during mask)
-        self.win.flip()
+        self.timer.flip()  # end of the checkerboard, the last frame counted for dropped frames
         fix.draw()
         self.win.flip()
 
         if judge is None:  # if response after the checkerboard
-            for wait_keys in event.waitKeys():
+            for wait_keys, key_time in event.waitKeys(timeStamped=self.timer.clock):
                 if (wait_keys == 'up' and rndpos[1][0] > 0) or (
                         wait_keys == 'down' and rndpos[1][0] < 0):
                     judge = 1  # correct
-                    react_time_stop = time.time()
+                    react_time_stop = key_time
                 elif (wait_keys == 'up' and rndpos[1][0] < 0) or (
                         wait_keys == 'down' and rndpos[1][0] > 0):
                     judge = 0  # incorrect
-                    react_time_stop = time.time()
+                    react_time_stop = key_time
                 elif wait_keys == 'escape':
                     config_tools.write_xrl(self.subject, break_info='userbreak')
                     core.quit()
 
         react_time = react_time_stop - react_time_start
 
-        return judge, react_time, trial_time_start
+        return judge, react_time, trial_time_start, self.timer.dropped
 
     def run_session(self):
 
@@ -255,6 +265,10 @@ class Exp:
         self.win.flip()
         event.waitKeys()
 
+        # the isoslant may have been refitted since the session was prepared
+        if self.ColorPicker.refresh_isoslant():
+            self.hue_list = self.ColorPicker.colorlist_paths(0.2)[0]
+
         # read staircase parameters
         conditions = [dict({'stimulus': key}, **value) for key, value in self.param.items() if
                       key.startswith('stimulus')]
@@ -290,7 +304,7 @@ class Exp:
 
     # write configuration files
         xpp = config_tools.WriteXpp(self.subject, self.idx, dir_path=self.res_dir)
-        xpp_file = xpp.head(self.cfg_file, self.par_file)
+        xpp_file = xpp.head(self.cfg_file, self.par_file, self.timer.frame_rate)
         config_tools.write_xrl(self.subject, cfg_file=self.cfg_file, par_file=self.par_file, xpp_file=xpp_file, dir_path=self.res_dir)
 
         xlsname = path + '/' + self.idx + self.param['noise_condition'] + '.xlsx'
@@ -306,7 +320,7 @@ class Exp:
                 # direction = (-1) ** (cond['label'].endswith('m'))  # direction as -1 if for minus stim
                 # rot = rot * direction  # rotation for this trial
                 std = 10 - rev_std
-                judge, react_time, trial_time_start = self.run_trial(std, cond, count)
+                judge, react_time, trial_time_start, dropped_frames = self.run_trial(std, cond, count)
 
                 # check whether the theta is valid - if not, the rotation given by staircase should be corrected by
                 # realizable values
@@ -322,14 +336,16 @@ class Exp:
                 #     disp_intensity = (disp_test + disp_standard) - 360
                 stairs.addResponse(judge, rev_std)
 
-                xpp.task(count, cond, cond['test'], std, judge, react_time, trial_time_start)
+                xpp.task(count, cond, cond['test'], std, judge, react_time, trial_time_start, dropped_frames)
 
                 if 'escape' in event.waitKeys():
                     config_tools.write_xrl(self.subject, break_info='userbreak')
                     core.quit()
 
+            xpp.close()
             config_tools.write_xrl(self.subject, xls_file=xlsname)
             stairs.saveAsExcel(xlsname)  # save results
+            datastore.store_xlsx(xlsname)  # for analysis, alongside the xlsx
             misc.toFile(os.path.join(psydat_path, self.idx + self.param['noise_condition'] + '.psydat'), stairs)
 
         elif isinstance(stairs, list):
@@ -347,8 +363,8 @@ class Exp:
                     rev_std = cur_handler._nextIntensity
                     std = 10 - rev_std
                     cond = cur_handler.extraInfo
-                    judge, react_time, trial_time_start = self.run_trial(std, cond, count)
-                    xpp.task(count, cond, cond['test'], std, judge, react_time, trial_time_start)
+                    judge, react_time, trial_time_start, dropped_frames = self.run_trial(std, cond, count)
+                    xpp.task(count, cond, cond['test'], std, judge, react_time, trial_time_start, dropped_frames)
 
                     if len(std_all) <= handler_idx:
                         std_all.append([])
@@ -375,6 +391,7 @@ class Exp:
                         config_tools.write_xrl(self.subject, break_info='userbreak', dir_path=self.res_dir)
                         core.quit()
 
+            xpp.close()
             config_tools.write_xrl(self.subject, xls_file=xlsname, dir_path=self.res_dir)
 
             # save results in xls-file
@@ -389,6 +406,7 @@ class Exp:
                     worksheet.write('C' + str(i + 2), std_all[handler_idx][i])
                     worksheet.write('D' + str(i + 2), judge_all[handler_idx][i])
             workbook.close()
+            datastore.store_xlsx(xlsname)  # for analysis, alongside the xlsx
 
             # print resulting parameters and estimates for each step
             res_file_path = os.path.join(path, self.idx + '_estimates.csv')
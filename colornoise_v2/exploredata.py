@@ -7,9 +7,18 @@ import colorpalette
 import glob
 import genconfig
 import config_tools
+import datastore
 import xlsxwriter
+import os
+import json
+import warnings
+import pickle
+import hashlib
 from psychopy import data
-from FitCumNormal import FitCumNormal
+from FitCumNormal import fit_batch
+from FitCumNormalMLE import fit_mle, bootstrap_mle, param_stats
+
+CACHE_VERSION = 2  # part of the keys of memoized results; bump it whenever loading or fitting data changes
 
 """gnerate colors for plotting"""
 
@@ -64,11 +73,13 @@ def session_profile(xls_file, title, res_file=False, show_fig=True, max_trials=N
 
 
 class ExploreData():
-    def __init__(self, sub, sel_par=None, sel_ses=None, rm_ses=None, xrl_path=None, sel_ses_idx=None):
+    def __init__(self, sub, sel_par=None, sel_ses=None, rm_ses=None, xrl_path=None, sel_ses_idx=None,
+                 disk_cache=True):
         """
         :param sub: the subject
         :param sel_par: parameter keywords, e.g. ['cn16_quest_LL_a', 'cn16_quest_LL_b']
         :param sel_ses: session keywords, e.g. ['20200730T1039L-L', '202007301122L-L']
+        :param disk_cache: also keep loaded and fitted data in a .cache folder next to the xrl file
         """
         self.sub = sub
         self.sel_par = sel_par
@@ -76,18 +87,19 @@ class ExploreData():
         self.rm_ses = rm_ses
         self.xrl_path = xrl_path
         self.sel_ses_idx = sel_ses_idx
+        self.disk_cache = disk_cache
+        self._cache = {}
 
-    def readxrl(self):
+    def xrl_file(self):
+        if self.xrl_path is None:
+            return 'data/' + self.sub + '/' + self.sub + '.xrl'
+        return self.xrl_path
+
+    def selected(self):
         """
-        :param xrl: a *.xrl file
-        :return: par: a dataframe merging params for all selected sessions
-        :return: xls: a dataframe merging results for all selected sessions
+        :return: lines of all selected and finished sessions in the xrl file
         """
-        xrl = self.xrl_path
-        if xrl is None:
-            xrl = 'data/' + self.sub + '/' + self.sub + '.xrl'
-
-        with open(xrl) as f:
+        with open(self.xrl_file()) as f:
             lines = f.read().splitlines()
             finished = [line for line in lines if line.endswith('.xlsx')]
 
@@ -104,18 +116,69 @@ class ExploreData():
             if self.sel_ses_idx is not None:
                 finished = [line for idx, line in enumerate(finished)
                             if (idx in self.sel_ses_idx)]
+        return finished
 
-            par = [None] * len(finished)
-            xls = [None] * len(finished)
-            count = 0
-            for line in finished:
-                stim_list = [v for k, v in config_tools.read_yml(line.split(', ')[1]).items() if
-                             k.startswith('stimulus')]
-                for idx, s in enumerate(stim_list):
-                    s['stimulus'] = idx
-                par[count] = pd.DataFrame(stim_list)
-                xls[count] = pd.read_excel(pd.ExcelFile(line.split(', ')[3]), sheet_name=None)
-                count += 1
+    """memoize loaded and fitted data"""
+
+    def cache_key(self):
+        """
+        :return: a hash of the cache version, the selected xrl lines and the modification times of the files in
+                 these lines
+        """
+        finished = self.selected()
+        mtimes = [[os.path.getmtime(f) if os.path.exists(f) else None for f in line.split(', ')]
+                  for line in finished]
+        return hashlib.sha1(json.dumps([CACHE_VERSION, finished, mtimes]).encode()).hexdigest()
+
+    def cached(self, name, compute):
+        """
+        Return the result of compute(), memoized per instance and on disk. It is computed again when the selection
+        of sessions or any of their files changes.
+
+        :param name: name of the result, e.g. 'sumxrl'
+        :param compute: function computing the result
+        :return: the (cached) result, to be used read-only
+        """
+        key = name + '_' + self.cache_key()
+        if key in self._cache:
+            return self._cache[key]
+        cache_file = os.path.join(os.path.dirname(self.xrl_file()), '.cache', key + '.pkl')
+        if self.disk_cache and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                result = pickle.load(f)
+        else:
+            result = compute()
+            if self.disk_cache:
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                tmp_file = cache_file + '.tmp' + str(os.getpid())
+                with open(tmp_file, 'wb') as f:
+                    pickle.dump(result, f)
+                os.replace(tmp_file, cache_file)
+        self._cache[key] = result
+        return result
+
+    def readxrl(self):
+        """
+        :param xrl: a *.xrl file
+        :return: par: a dataframe merging params for all selected sessions
+        :return: xls: a dataframe merging results for all selected sessions
+        """
+        finished = self.selected()
+        par = [None] * len(finished)
+        par_dicts = {}  # sessions often share a par file, read each once
+        count = 0
+        for line in finished:
+            par_file = line.split(', ')[1]
+            if par_file not in par_dicts:
+                par_dicts[par_file] = config_tools.read_yml(par_file)
+            stim_list = [dict(v) for k, v in par_dicts[par_file].items() if
+                         k.startswith('stimulus')]
+            for idx, s in enumerate(stim_list):
+                s['stimulus'] = idx
+            par[count] = pd.DataFrame(stim_list)
+            count += 1
+        # results of all sessions in bulk from the data stores, instead of parsing every xlsx file
+        xls = datastore.read_sessions([line.split(', ')[3] for line in finished])
         return par, xls, count
 
     """combine single *.par and *.xlsx"""
@@ -147,6 +210,9 @@ class ExploreData():
         return np.nanstd((np.concatenate(x.values[-3:])))
 
     def sumxrl(self):
+        return self.cached('sumxrl', self._sumxrl)
+
+    def _sumxrl(self):
 
         par, xls, count = self.readxrl()
 
@@ -162,6 +228,21 @@ class ExploreData():
     """psychometric curve"""
 
     def fitpf(self):
+        return self.cached('fitpf', self._fitpf)
+
+    def _fitpf(self):
+        ntrial, res = self.pfdata()
+        fits = fit_batch([(r['combinedInten'], r['combinedResp'], r['sems']) for r in res.values()],
+                         expectedMin=0.5, lapse=0.01)  # customized cumulative Gaussian
+        for label, fit in zip(res, fits):
+            res[label]['fit'] = fit
+            res[label]['thresh'] = fit.inverse(0.75)  # threshold
+        return ntrial, res
+
+    def pfdata(self):
+        """
+        :return: ntrial, and the binned data of each condition for fitting the psychometric functions
+        """
         dfs, pool = self.sumxrl()
         allIntensities = pool['allIntensities']
         allResponses = pool['allResponses']
@@ -183,23 +264,80 @@ class ExploreData():
             res[label]['sems'] = [1.0 / (n / sum(res[label]['combinedN']))
                                   for n in res[label]['combinedN']]  # sems is defined as 1/weight in Psychopy
 
-            # res[label]['fit'] = data.FitCumNormal(res[label]['combinedInten'],
-            #                                       res[label]['combinedResp'],
-            #                                       sems=res[label]['sems'], guess=None,
-            #                                       expectedMin=0.5)  # cumulative Gaussian
-            guess = [5, 0]
-
-            res[label]['fit'] = FitCumNormal(res[label]['combinedInten'],
-                                                  res[label]['combinedResp'],
-                                                  sems=res[label]['sems'], guess=None,
-                                                  expectedMin=0.5, lapse=0.01)  # customized cumulative Gaussian
+        return ntrial, res
 
-            # print(label + ':' + str(res[label]['fit'].params) + ', ' + str(
-            #     res[label]['fit'].ssq))  # a list with [centre, sd] for the Gaussian distribution forming the cumulative
+    def fitmle(self, fit_lapse=True, fit_guess=False):
+        return self.cached('fitmle_%d%d' % (fit_lapse, fit_guess),
+                           lambda: self._fitmle(fit_lapse=fit_lapse, fit_guess=fit_guess))
 
-            res[label]['thresh'] = res[label]['fit'].inverse(0.75)  # threshold
+    def _fitmle(self, fit_lapse=True, fit_guess=False):
+        """
+        Fit the psychometric functions to single trials by maximum likelihood, instead of to binned data.
 
-        return ntrial, res
+        :param fit_lapse: fit the lapse rate of each condition
+        :param fit_guess: fit the guess rate of each condition
+        :return: ntrial, and the trials, fit and threshold of each condition
+        """
+        dfs, pool = self.sumxrl()
+        res = {}
+        for label in pool['allResponses'].index:
+            res[label] = {}
+            res[label]['intensities'] = abs(np.asarray(pool['allIntensities'][label], dtype=float))
+            res[label]['responses'] = np.asarray(pool['allResponses'][label], dtype=float)
+        fits = fit_mle([(r['intensities'], r['responses']) for r in res.values()],
+                       expectedMin=0.5, lapse=0.01, fit_lapse=fit_lapse, fit_guess=fit_guess)
+        for label, fit in zip(res, fits):
+            res[label]['fit'] = fit
+            res[label]['thresh'] = fit.inverse(0.75)  # threshold
+        return pool['ntrial'], res
+
+    def bootstrap(self, n_boot=2000, method='parametric', rearranged=False, fit_lapse=False, ci=95, seed=0,
+                  processes=None):
+        return self.cached('bootstrap_%s_%d_%s_%d_%d_%d' % (method, n_boot, rearranged, fit_lapse, ci, seed),
+                           lambda: self._bootstrap(n_boot, method, rearranged, fit_lapse, ci, seed, processes))
+
+    def _bootstrap(self, n_boot=2000, method='parametric', rearranged=False, fit_lapse=False, ci=95, seed=0,
+                   processes=None):
+        """
+        Bootstrap confidence intervals of the psychometric functions: trials of each hue are resampled and refitted
+        by maximum likelihood (see FitCumNormalMLE.bootstrap_mle).
+
+        :param n_boot: number of bootstrap replicates
+        :param method: 'parametric' (responses drawn from the fitted functions) or 'nonparametric' (trials drawn
+                       with replacement)
+        :param rearranged: the data of rearrange (both references of a hue, "more plus"), or of fitpf
+        :param fit_lapse: fit the lapse rate of each replicate
+        :param ci: confidence level in percent
+        :param seed: seed of the resampling
+        :param processes: number of processes, see bootstrap_mle
+        :return: a dataframe with a row per hue: the estimates of thresh, pse, sd and slope, and their lower (_lo)
+                 and upper (_hi) confidence limits
+        """
+        if rearranged:
+            table = self.rearrange()
+            labels = list(table['hue'])
+            trials = list(zip(table['intensity'], table['response']))
+            kwargs = dict(expectedMin=0.0, lapse=0.01)
+            levels = dict(thresh_level=0.75 - .01, pse_level=0.5 - .01)  # as in rearrange
+        else:
+            dfs, pool = self.sumxrl()
+            labels = list(pool['allResponses'].index)
+            trials = [(abs(np.asarray(pool['allIntensities'][label], dtype=float)), pool['allResponses'][label])
+                      for label in labels]
+            kwargs = dict(expectedMin=0.5, lapse=0.01)
+            levels = dict(thresh_level=0.75)
+        fits, samples = bootstrap_mle(trials, n_boot=n_boot, method=method, seed=seed, processes=processes,
+                                      fit_lapse=fit_lapse, **kwargs)
+
+        estimates = param_stats(*np.array([[f.params[0], f.params[1], f.expectedMin, f.lapse] for f in fits]).T,
+                                **levels)
+        replicates = param_stats(*np.moveaxis(samples, -1, 0), **levels)
+        res = pd.DataFrame(index=labels)
+        for name in ['thresh', 'pse', 'sd', 'slope']:
+            res[name] = estimates[name]
+            res[name + '_lo'], res[name + '_hi'] = np.nanpercentile(replicates[name], [50 - ci / 2, 50 + ci / 2],
+                                                                    axis=0)
+        return res
 
     def pfplot(self, savefig=False):
         ntrial, res = self.fitpf()
@@ -245,13 +383,20 @@ class ExploreData():
 
         plt.show()
 
-    def threshplot(self, polar=False, savefig=False):
+    def threshplot(self, polar=False, savefig=False, boot=None):
+        """
+        :param boot: bootstrap estimates from self.bootstrap(): their thresholds are plotted with their confidence
+                     intervals, instead of the binned fits with the fitted covariance
+        """
         ntrial, res = self.fitpf()
         labels = res.keys()
         N = int(len(labels) / 2)
         color_codes = color4plot(N)
         thresh = [res[k]['thresh'] for k in res.keys()]
         thre_err = [np.sqrt(np.diagonal(res[k]['fit'].covar))[0] for k in res.keys()]
+        if boot is not None:
+            thresh, thre_err = boot_values(boot, 'thresh', labels)
+            thresh = list(thresh)
 
         if polar is False:
             angles = np.repeat([(n / float(N) * 360 + 22.5) for n in range(N)], 2, axis=0)
@@ -294,14 +439,18 @@ class ExploreData():
                 ax.plot(angles[idx] + 2 * np.pi / 180, thresh_p[idx], marker='<', markersize=8, color=c)
             shift_angles += shift_angles[:1]
             thresh += thresh[:1]
-            thre_err += thre_err[:1]
+            thre_err = np.hstack([thre_err, np.asarray(thre_err)[..., :1]])
             ax.errorbar(shift_angles, thresh, yerr=thre_err, color='grey', ls='--', capsize=2)
             plt.legend(loc='upper right', bbox_to_anchor=(0.1, 0.1))
             if savefig:
                 plt.savefig('data_analysis_LL/pf_plots/' + self.sub + '_' + 'threshplot_radar_' + str(ntrial) + '_trials' + '.pdf')
             plt.show()
 
-    def paramplot(self, savefig=False):
+    def paramplot(self, savefig=False, boot=None):
+        """
+        :param boot: bootstrap estimates from self.bootstrap(): their centres (PSEs) and sds are plotted with their
+                     confidence intervals, instead of the binned fits with the fitted covariance
+        """
         ntrial, res = self.fitpf()
         labels = res.keys()
         N = int(len(labels) / 2)
@@ -310,13 +459,19 @@ class ExploreData():
         centre = [res[k]['fit'].params[0] for k in res.keys()]
         std = [res[k]['fit'].params[1] for k in res.keys()]
         par_err = [np.sqrt(np.diagonal(res[k]['fit'].covar)) for k in res.keys()]
+        if boot is not None:
+            centre, centre_err = boot_values(boot, 'pse', labels)
+            std, std_err = boot_values(boot, 'sd', labels)
+            par_err = list(zip(centre_err.T, std_err.T))
         plt.figure(figsize=(16, 10))
         ax = plt.subplot(111)
         ax.set_title('cumulative Gaussian params')
         ax.scatter(range(2 * N), centre, s=50, color=np.repeat(color_codes, repeats=2, axis=0), marker='o', label='mean')
         ax.scatter(range(2 * N), std, s=50, color=np.repeat(color_codes, repeats=2, axis=0), marker='v', label='std')
-        ax.errorbar(range(2 * N), centre, yerr=[x[0] for x in par_err], label='mean', color='grey', ls='--')
-        ax.errorbar(range(2 * N), std, yerr=[x[1] for x in par_err], label='std', color='silver', ls='--')
+        ax.errorbar(range(2 * N), centre, yerr=np.transpose([x[0] for x in par_err]), label='mean', color='grey',
+                    ls='--')
+        ax.errorbar(range(2 * N), std, yerr=np.transpose([x[1] for x in par_err]), label='std', color='silver',
+                    ls='--')
         xlabels = [f"{l}\n{a}" for l, a in zip(labels, angles)]
         ax.set_xticks(range(2 * N))
         ax.set_xticklabels(xlabels)
@@ -352,11 +507,15 @@ class ExploreData():
 
     """ Rearrange data by changing the response criteria"""
     def rearrange(self, savefig=False):
+        return self.cached('rearrange', self._rearrange)
+
+    def _rearrange(self):
         dfs, pool = self.sumxrl()
 
         # Change the question: whether it is more plus? so you need to swap 0 and 1 during a minus reference
+        # (on a copy, the pool is cached)
         pool_labels = pool['allResponses'].index
-        pool['revResponses'] = pool['allResponses']
+        pool = dict(pool, revResponses=pool['allResponses'].copy())
         for label in pool_labels:
             if label.endswith('m'):
                 pool['revResponses'][label] = 1 - pool['allResponses'][label]
@@ -370,7 +529,7 @@ class ExploreData():
             idx = ii//2
             rearranged.loc[idx, 'hue'] = 'hue_' + str(idx + 1)
             rearranged.loc[idx, 'intensity'] = np.hstack([pool['allIntensities'][ii], pool['allIntensities'][ii+1]])
-            rearranged.loc[idx, 'response'] = np.hstack([pool['allResponses'][ii], pool['allResponses'][ii+1]])
+            rearranged.loc[idx, 'response'] = np.hstack([pool['revResponses'][ii], pool['revResponses'][ii+1]])
             rearranged.loc[idx, 'ntrial'] = pool['ntrial'][0] * 2
 
             rearranged.loc[idx, 'combinedInten'],  \
@@ -381,13 +540,12 @@ class ExploreData():
             rearranged.loc[idx, 'sems'] = [sum(rearranged.loc[idx, 'combinedN']) / n
                                            for n in rearranged.loc[idx, 'combinedN'] ]  # sems is defined as 1/weight in Psychopy
 
-            guess = [5, 1]
-            rearranged.loc[idx, 'fit'] = FitCumNormal(rearranged.loc[idx, 'combinedInten'],
-                                         rearranged.loc[idx, 'combinedResp'],
-                                         sems=rearranged.loc[idx, 'sems'] , guess=None,
-                                         expectedMin=0.0, lapse=0.01)  # customized cumulative Gaussian
-            rearranged.loc[idx, 'pse'] = rearranged.loc[idx, 'fit'].inverse(0.5-.01)
-            rearranged.loc[idx, 'thre'] = rearranged.loc[idx, 'fit'].inverse(0.75-.01)
+        fits = fit_batch(zip(rearranged['combinedInten'], rearranged['combinedResp'], rearranged['sems']),
+                         expectedMin=0.0, lapse=0.01)  # customized cumulative Gaussian
+        for idx, fit in zip(rearranged.index, fits):
+            rearranged.loc[idx, 'fit'] = fit
+            rearranged.loc[idx, 'pse'] = fit.inverse(0.5-.01)
+            rearranged.loc[idx, 'thre'] = fit.inverse(0.75-.01)
 
 
         return rearranged
@@ -447,7 +605,11 @@ class ExploreData():
         plt.show()
 
 
-    def rearrange_paramplot(self):
+    def rearrange_paramplot(self, boot=None):
+        """
+        :param boot: bootstrap estimates from self.bootstrap(rearranged=True): their PSEs and sds are plotted with
+                     their confidence intervals, instead of the binned fits with the fitted covariance
+        """
         rearranged = self.rearrange()
         num = len(rearranged)
         hues = rearranged['hue']
@@ -456,13 +618,19 @@ class ExploreData():
         centre = rearranged['fit'].map(lambda x: x.params[0])
         std = rearranged['fit'].map(lambda x: x.params[1])
         par_err = rearranged['fit'].map(lambda x: np.sqrt(np.diagonal(x.covar)))
+        if boot is not None:
+            centre, centre_err = boot_values(boot, 'pse', hues)
+            std, std_err = boot_values(boot, 'sd', hues)
+            par_err = list(zip(centre_err.T, std_err.T))
 
         plt.figure(figsize=(12, 10))
         ax = plt.subplot(111)
         ax.set_title('cumulative Gaussian params')
 
-        ax.errorbar(range(num), centre, yerr=[x[0] for x in par_err], label='mean/PSE', color='grey', ls='--')
-        ax.errorbar(range(num), std, yerr=[x[1] for x in par_err], label='std/JND/threshold', color='black', ls='--')
+        ax.errorbar(range(num), centre, yerr=np.transpose([x[0] for x in par_err]), label='mean/PSE', color='grey',
+                    ls='--')
+        ax.errorbar(range(num), std, yerr=np.transpose([x[1] for x in par_err]), label='std/JND/threshold',
+                    color='black', ls='--')
         ax.scatter(range(num), centre, s=80, color=color_codes, marker='o', label='mean/PSE')
         ax.scatter(range(num), std, s=80, color=color_codes,  marker='v', label='std/JND/threshold')
 
@@ -480,6 +648,51 @@ class ExploreData():
 
 
 
+def boot_values(boot, name, labels=None):
+    """
+    Values to plot with asymmetric error bars from bootstrap confidence intervals: the maximum likelihood estimates
+    which were bootstrapped, so that points and intervals come from the same estimator.
+
+    :param boot: a dataframe from ExploreData.bootstrap
+    :param name: 'thresh', 'pse', 'sd' or 'slope'
+    :param labels: hue labels of the plotted values, rows of boot; default: all rows
+    :return: values, and a (2, len(values)) array of lower and upper errors
+    """
+    if labels is not None:
+        boot = boot.loc[list(labels)]
+    values = boot[name].to_numpy(dtype=float)
+    err = np.array([values - boot[name + '_lo'].to_numpy(dtype=float),
+                    boot[name + '_hi'].to_numpy(dtype=float) - values])
+    outside = np.any(err < 0, axis=0)
+    if np.any(outside):
+        warnings.warn('%s of %s lies outside its bootstrap confidence interval, the error bar is cut at it'
+                      % (name, ', '.join(map(str, boot.index[outside]))))
+    return values, np.maximum(0, err)
+
+
+def fitpf_group(explorers, processes=None):
+    """
+    Fit the psychometric functions of several subjects (or selections) in one batch.
+
+    :param explorers: a list of ExploreData
+    :param processes: number of processes for fitting, see fit_batch
+    :return: a list of (ntrial, res) as from ExploreData.fitpf, in the order of explorers
+    """
+    binned = [e.pfdata() for e in explorers]
+    fits = fit_batch([(r['combinedInten'], r['combinedResp'], r['sems'])
+                      for ntrial, res in binned for r in res.values()],
+                     processes=processes, expectedMin=0.5, lapse=0.01)
+    fits = iter(fits)
+    for ntrial, res in binned:
+        for label in res:
+            res[label]['fit'] = next(fits)
+            res[label]['thresh'] = res[label]['fit'].inverse(0.75)
+    return binned
+
+
 """examples"""
 # ExploreData('ysu', sel_par=['cn2x8_LL_easy_a.yaml'], rm_ses=['0917T10']).rearrange_pfplot()
-# ExploreData('ysu', sel_par=['cn2x8_LL_easy_a.yaml'], rm_ses=['0917T10']).rearrange_paramplot()
\ No newline at end of file
+# ExploreData('ysu', sel_par=['cn2x8_LL_easy_a.yaml'], rm_ses=['0917T10']).rearrange_paramplot()
+# fitpf_group([ExploreData('ysu', sel_par=['cn2x8_LL_easy_a.yaml']), ExploreData('fschrader')])
+# boot = ExploreData('ysu', sel_par=['cn2x8_LL_easy_a.yaml']).bootstrap(n_boot=2000)
+# ExploreData('ysu', sel_par=['cn2x8_LL_easy_a.yaml']).threshplot(boot=boot)
@@ -0,0 +1,93 @@
+# !/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+This module presents stimuli for exact numbers of screen refreshes instead of waiting for durations.
+Each flip is timestamped with the return value of win.flip(); flip intervals longer than one and a half refresh
+periods are counted as dropped frames.
+
+Main class: FrameTimer
+
+@author: yannansu
+"""
+import warnings
+from psychopy import core, event
+
+
+class FrameTimer:
+    def __init__(self, win, frame_rate=None):
+        """
+        Frame-counted presentation in a window.
+
+        :param win:         PsychoPy window
+        :param frame_rate:  refresh rate in Hz; measured from the window if not given
+        """
+        if frame_rate is None:
+            frame_rate = win.getActualFrameRate()
+            if frame_rate is None:
+                frame_rate = 60.0
+                warnings.warn('The frame rate could not be measured, 60 Hz is assumed!')
+        self.win = win
+        self.frame_rate = float(frame_rate)
+        self.frame_dur = 1.0 / self.frame_rate
+        self.clock = core.monotonicClock  # the clock of flip timestamps, also used for key timestamps
+        self.last_flip = None
+        self.dropped = 0
+
+    def n_frames(self, dur):
+        """
+        Number of refreshes closest to a duration, at least one.
+
+        :param dur:     duration in sec
+        :return:        number of frames
+        """
+        return max(1, int(round(dur * self.frame_rate)))
+
+    def start_trial(self):
+        """
+        Reset the count of dropped frames at the beginning of a trial.
+        """
+        self.last_flip = None
+        self.dropped = 0
+
+    def interrupt(self):
+        """
+        Do not count the interval up to the next flip, e.g. after waiting for keys in the pause mode.
+        """
+        self.last_flip = None
+
+    def flip(self):
+        """
+        Flip the window and count the frames dropped since the last flip.
+
+        :return: flip timestamp
+        """
+        flip_time = self.win.flip()
+        if self.last_flip is not None:
+            missed = int(round((flip_time - self.last_flip) / self.frame_dur)) - 1
+            if missed > 0:
+                self.dropped += missed
+        self.last_flip = flip_time
+        return flip_time
+
+    def present(self, stims, dur, keys=None):
+        """
+        Draw the stimuli on every refresh for the number of frames closest to dur.
+        The phase ends with the first flip of the next phase.
+
+        :param stims:   stimuli to draw
+        :param dur:     duration in sec
+        :param keys:    keys which end the presentation early, e.g. ['p']; other keys stay in the buffer
+        :return:        onset (timestamp of the first flip) and the pressed [key, time], or None if not stopped
+        """
+        onset = None
+        for frame in range(self.n_frames(dur)):
+            for stim in stims:
+                stim.draw()
+            flip_time = self.flip()
+            if onset is None:
+                onset = flip_time
+            if keys is not None:
+                pressed = event.getKeys(keyList=keys, timeStamped=self.clock)
+                if pressed:
+                    return onset, pressed[0]
+        return onset, None
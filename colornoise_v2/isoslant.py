@@ -0,0 +1,211 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+
+# python version 3.7.6
+"""
+This module fits the subjective iso-luminance planes (isoslant) of all subjects from their flicker measurements,
+isolum/subject/*.isodata, and writes them as isolum/subject/*.isoslant in the format of iris-tool.
+
+The gray level which looks iso-luminant with the hue angle theta (rad) is fitted by
+    response = offset + dl * cos(theta - phi)
+which is linear in (1, cos(theta), sin(theta)), so all fits and all bootstrap resamples are solved at once by least
+squares. ColorPicker.isoslant_dlum uses dl and phi. Confidence intervals of dl and phi are bootstrapped from the
+measurements.
+
+Fit and validate all subjects in Python3.7:
+    fits = fit_all('isolum')
+Or in bash (with --write, the isoslant files are (re)written):
+    python3.7 isoslant.py [optional isolum_dir] [--n_boot n] [--calib calib_id] [--write]
+
+@author: yannansu
+"""
+import os
+import io
+import argparse
+import numpy as np
+import pandas as pd
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+import config_tools
+
+
+def read_isodata(file_path):
+    """
+    Read a flicker measurement file, written by iris-tool (YAML) or by the earlier isolum script (text header).
+
+    :param file_path:   isodata file path
+    :return:            metadata (id, subject, rgb2lms, display), hue angles (rad) and responses (gray levels)
+    """
+    with open(file_path, encoding='utf-8') as file:
+        text = file.read()
+    try:
+        info = yaml.safe_load(text)['isodata']
+        meta = {key: info.get(key) for key in ['id', 'subject', 'display', 'rgb2lms']}
+        data = info['data']
+    except (yaml.YAMLError, KeyError, TypeError):
+        head, data = text.split('stimulus', 1)
+        info = yaml.safe_load(head)
+        calib = info.get('rgb2lms') or {}
+        meta = {'id': info.get('id'), 'subject': info.get('user'), 'display': calib.get('display'),
+                'rgb2lms': calib.get('id')}
+        data = 'stimulus' + data
+    stimulus, response = np.loadtxt(io.StringIO(data.replace(',', ' ')), skiprows=1, unpack=True, ndmin=2)
+    meta['id'] = str(meta['id'])
+    if meta['subject'] is None:
+        meta['subject'] = os.path.basename(os.path.dirname(file_path))
+    return meta, stimulus, response
+
+
+def fit(stimulus, response):
+    """
+    Fit offset + dl * cos(theta - phi) by least squares, for one measurement or for a batch of them.
+
+    :param stimulus:    hue angles (rad) in shape (..., N)
+    :param response:    gray levels in shape (..., N)
+    :return:            offset, dl, phi (in [0, 2pi)) and rms residual, each in shape (...)
+    """
+    stimulus = np.asarray(stimulus, dtype=float)
+    response = np.asarray(response, dtype=float)
+    design = np.stack([np.ones_like(stimulus), np.cos(stimulus), np.sin(stimulus)], axis=-1)
+    gram = np.einsum('...ni,...nj->...ij', design, design)
+    coef = np.linalg.solve(gram, np.einsum('...ni,...n->...i', design, response)[..., None])[..., 0]
+    residual = response - np.einsum('...ni,...i->...n', design, coef)
+    offset, a, b = coef[..., 0], coef[..., 1], coef[..., 2]
+    return offset, np.hypot(a, b), np.arctan2(b, a) % (2 * np.pi), np.sqrt(np.mean(residual ** 2, axis=-1))
+
+
+def bootstrap(stimulus, response, n_boot=2000, level=0.95, seed=0):
+    """
+    Percentile bootstrap confidence intervals of dl and phi; all resamples are fitted at once.
+    The interval of phi is taken around its estimate, so that it may extend below 0 or above 2pi.
+
+    :param stimulus:    hue angles (rad)
+    :param response:    gray levels
+    :param n_boot:      number of resamples
+    :param level:       confidence level
+    :param seed:        seed of the resamples
+    :return:            (lower, upper) of dl, (lower, upper) of phi
+    """
+    stimulus = np.asarray(stimulus, dtype=float)
+    response = np.asarray(response, dtype=float)
+    idx = np.random.default_rng(seed).integers(0, len(stimulus), size=(n_boot, len(stimulus)))
+    _, dl, phi, _ = fit(stimulus[idx], response[idx])
+    phi_hat = fit(stimulus, response)[2]
+    dphi = np.angle(np.exp(1j * (phi - phi_hat)))
+    q = [(1 - level) / 2, (1 + level) / 2]
+    return tuple(np.quantile(dl, q)), tuple(phi_hat + np.quantile(dphi, q))
+
+
+def write_isoslant(file_path, meta, dl, phi, ci=None):
+    """
+    Write an isoslant file in the format of iris-tool.
+
+    :param file_path:   isoslant file path
+    :param meta:        metadata from read_isodata
+    :param dl:          fitted dl
+    :param phi:         fitted phi
+    :param ci:          optional confidence intervals: level, (lower, upper) of dl, (lower, upper) of phi
+    """
+    info = {'id': meta['id'], 'subject': meta['subject'], 'dl': float(dl), 'phi': float(phi)}
+    if meta.get('display') is not None:
+        info['display'] = meta['display']
+    if meta.get('rgb2lms') is not None:
+        info['rgb2lms'] = meta['rgb2lms']
+    if ci is not None:  # 'ci_' keys, since config_tools.read_value matches keys by their beginning
+        level, ci_dl, ci_phi = ci
+        info.update({'ci_level': float(level), 'ci_dl': [float(v) for v in ci_dl],
+                     'ci_phi': [float(v) for v in ci_phi]})
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        yaml.safe_dump({'isoslant': info}, file, default_flow_style=None, sort_keys=False)
+    os.replace(tmp_path, file_path)
+
+
+def _fit_files(args):
+    """
+    Fit and bootstrap isodata files one after another, in a worker process.
+
+    :return: a list of result rows
+    """
+    files, n_boot, level, calib, write, seed = args
+    rows = []
+    for file_path in files:
+        meta, stimulus, response = read_isodata(file_path)
+        offset, dl, phi, rmse = fit(stimulus, response)
+        ci_dl, ci_phi = bootstrap(stimulus, response, n_boot, level, seed)
+        row = {'subject': meta['subject'], 'id': meta['id'], 'file': file_path, 'n': len(stimulus),
+               'offset': float(offset), 'dl': float(dl), 'phi': float(phi), 'rmse': float(rmse),
+               'dl_lo': ci_dl[0], 'dl_hi': ci_dl[1], 'phi_lo': ci_phi[0], 'phi_hi': ci_phi[1],
+               'rgb2lms': meta['rgb2lms'], 'calib_ok': None if calib is None else meta['rgb2lms'] == calib,
+               'saved_dl': np.nan, 'saved_phi': np.nan}
+
+        slant_path = os.path.splitext(file_path)[0] + '.isoslant'
+        if os.path.exists(slant_path):
+            for key in ['dl', 'phi']:
+                value = config_tools.read_value(slant_path, [key], sep=':')
+                if isinstance(value, float):  # not in the files of the earlier isolum script
+                    row['saved_' + key] = value
+        if write:
+            write_isoslant(slant_path, meta, dl, phi, (level, ci_dl, ci_phi))
+        rows.append(row)
+    return rows
+
+
+def fit_all(isolum_dir='isolum', n_boot=2000, level=0.95, calib=None, processes=None, write=False, seed=0):
+    """
+    Fit the isoslant of all isodata files under a directory, in a pool of processes, and validate them against the
+    saved isoslant files and the current calibration.
+
+    On platforms which spawn processes (Windows, macOS), call it under
+    `if __name__ == '__main__':` in scripts.
+
+    :param isolum_dir:  directory of the subject directories, e.g. 'isolum'
+    :param n_boot:      number of bootstrap resamples per file
+    :param level:       confidence level
+    :param calib:       id of the current calibration; measurements of other calibrations are marked in calib_ok
+    :param processes:   number of processes, default: number of CPUs
+    :param write:       write the fits into the isoslant files next to the isodata files
+    :param seed:        seed of the bootstrap resamples
+    :return:            a DataFrame of one row per isodata file, with the fits, their confidence intervals, the saved
+                        values (saved_dl, saved_phi), and whether the saved values lie in the intervals (saved_ok)
+    """
+    files = sorted(os.path.join(root, name) for root, dirs, names in os.walk(isolum_dir)
+                   for name in names if name.endswith('.isodata'))
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(files)))
+    jobs = [(files[part::processes], n_boot, level, calib, write, seed) for part in range(processes)]
+    if processes == 1:
+        results = [_fit_files(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_fit_files, jobs))
+
+    fits = pd.DataFrame([row for rows in results for row in rows])
+    if len(fits):
+        dphi = np.angle(np.exp(1j * (fits['saved_phi'] - fits['phi'])))
+        fits['saved_ok'] = (fits['saved_dl'] >= fits['dl_lo']) & (fits['saved_dl'] <= fits['dl_hi']) & \
+                           (fits['phi'] + dphi >= fits['phi_lo']) & (fits['phi'] + dphi <= fits['phi_hi'])
+        fits = fits.sort_values(['subject', 'id']).reset_index(drop=True)
+    return fits
+
+
+"""example"""
+
+# fits = fit_all('isolum', calib='20200723T1108')
+# fits[['subject', 'dl', 'dl_lo', 'dl_hi', 'phi', 'phi_lo', 'phi_hi', 'saved_ok', 'calib_ok']]
+# fit_all('isolum', write=True)  # rewrite all isoslant files, with confidence intervals
+
+""" fit all subjects in bash """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('isolum_dir', nargs='?', default='isolum')
+    parser.add_argument('--n_boot', type=int, default=2000)
+    parser.add_argument('--level', type=float, default=0.95)
+    parser.add_argument('--calib', default=None)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--write', action='store_true')
+    args = parser.parse_args()
+    results = fit_all(args.isolum_dir, args.n_boot, args.level, args.calib, args.processes, args.write)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(results.drop(columns=['file']))
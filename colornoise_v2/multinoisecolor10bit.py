@@ -14,27 +14,76 @@ Or in bash:
 Running experiments requires config files in config folder:
     config/experiment_config.yaml   - experiment config file
     config/parameter.yaml           - parameters of stimuli
-It writes log files in data folder:
+It writes log files in data folder (or results_dir):
     data/subject/*.yaml             - single session log file
     data/subject/*.xrl              - single subject log file
-It saves results in data folder:
+It saves results in data folder (or results_dir):
     data/subject/*.xlsx             - results of each complete session; no results will be saved if userbreak occurs
+    data/subject/posteriors.npz     - staircases of all complete sessions, priors of later sessions (see posteriors)
+
+Sessions can also run headless with a simulated observer, see simobserver.
 
 @author: yannansu
 """
 
 import numpy as np
 import time
-from psychopy import visual, data, core, event, monitors, misc
-from psychopy.hardware import keyboard
+from psychopy import visual, data, core, event, monitors
 import os
-from colorpalette import ColorPicker
+from colorpalette import ColorPicker, Gamut
 import config_tools
+import datastore
+import adaptive
+import posteriors
 import sys
 import xlsxwriter
 import csv
-from bisect import bisect_left
 import argparse
+import itertools
+from stimqueue import StimQueue, LookAhead
+from frametimer import FrameTimer
+
+WARMUP_N = 5  # warm-up trials of each staircase of the quest and psi methods, not added to the staircases
+GAMUT_TOL = 1e-4  # expected fraction of out-of-gamut colors which is tolerated in a condition
+
+
+def make_stairs(conditions, trial_nmb, priors_file_path=None):
+    """
+    Create the staircases of a session.
+
+    :param conditions:          conditions from the parameter file, all of one stairType
+    :param trial_nmb:           number of trials of each staircase
+    :param priors_file_path:    prefix of the prior session of the quest and psi methods, optional,
+                                e.g. 'data/ysu/20200916T1708L-L' (see posteriors.load_prior)
+    :return:                    a MultiStairHandler for the simple method, or a list of QuestHandler or PsiHandler
+                                (adaptive, with fast posterior updates)
+    """
+    if conditions[0]['stairType'] == 'simple':
+        stairs = data.MultiStairHandler(stairType='simple', conditions=conditions, nTrials=trial_nmb,
+                                        method='sequential')
+    elif conditions[0]['stairType'] == 'quest':
+        stairs = []
+        for cond in conditions:
+            if priors_file_path:
+                prior = posteriors.load_prior(priors_file_path, cond['label'])
+            else:
+                prior = None
+            cur_handler = adaptive.QuestHandler(cond['startVal'], cond['startValSd'], pThreshold=cond['pThreshold'],
+                                                nTrials=trial_nmb, minVal=cond['min_val'], maxVal=cond['max_val'],
+                                                staircase=prior, extraInfo=cond, grain=0.02)
+            stairs.append(cur_handler)
+    elif conditions[0]['stairType'] == 'psi':
+        stairs = []
+        for cond in conditions:
+            if priors_file_path:
+                prior = posteriors.load_prior(priors_file_path, cond['label']).posterior
+            else:
+                prior = None
+            cur_handler = adaptive.PsiHandler(nTrials=trial_nmb, intensRange=[1, 10], alphaRange=[1, 10],
+                                              betaRange=[0.01, 10], intensPrecision=0.1, alphaPrecision=0.1,
+                                              betaPrecision=0.01, delta=0.01, extraInfo=cond, prior=prior)
+            stairs.append(cur_handler)
+    return stairs
 
 
 class Exp:
@@ -42,12 +91,21 @@ class Exp:
     Class for performing the experiment.
     """
 
-    def __init__(self, subject, par_file, cfg_file, res_dir, priors_file_path):
+    def __init__(self, subject, par_file, cfg_file, res_dir, priors_file_path, observer=None, idx=None):
+        """
+        :param observer:    a simulated observer (simobserver.SimObserver) answering trials headless instead of
+                            a subject, optional
+        :param idx:         session index, default: the current date and time
+        """
         self.subject = subject
-        self.idx = time.strftime("%Y%m%dT%H%M", time.localtime())  # add the current date
+        if idx is None:
+            idx = time.strftime("%Y%m%dT%H%M", time.localtime())  # add the current date
+        self.idx = idx
         if not res_dir:
             res_dir = 'data/'
         self.res_dir = res_dir
+        self.log_dir = os.path.join(res_dir, subject)  # logs and results of this subject
+        self.observer = observer
         self.priors_file_path = priors_file_path
         self.cfg_file = cfg_file
         self.cfg = config_tools.read_yml(cfg_file)
@@ -59,18 +117,21 @@ class Exp:
         self.trial_nmb = self.cfg['trial_nmb']
         self.trial_dur = self.cfg['trial_dur']
         self.depthBits = self.cfg['depthBits']
+        self.mask_n = [30, 20]  # horizontal and vertical number of rects in the checkerboard mask
 
         self.ColorPicker = ColorPicker(c=self.param['c'],
                                        sscale=self.param['sscale'],
                                        unit='deg',
                                        depthBits=self.depthBits,
-                                       subject=self.subject)
+                                       subject=self.subject,
+                                       calib=self.cfg.get('calib'))  # calibration id, if there are several
         self.ColorSpace = self.ColorPicker.colorSpace
+        # gather colors from a hue lookup table; set lut_res to null in the config file to transform every hue angle
+        self.ColorPicker.use_lut(self.cfg.get('lut_res', 0.01))
 
-        hue_list_path = 'config/colorlist/' + self.subject
-        if not os.path.exists(hue_list_path):
-            self.ColorPicker.gencolorlist(0.2)
-        self.hue_list = hue_list_path + '/hue-list-10bit-res0.2-sub-' + self.subject + '.npy'
+        self.hue_list = None
+        self.valid_theta = None
+        self.init_colors()
 
         self.Csml = self.ColorPicker.center()
         self.Crgb = self.ColorPicker.sml2rgb(self.ColorPicker.center())
@@ -78,6 +139,11 @@ class Exp:
                                     width=self.cfg['monitor']['width'],
                                     distance=self.cfg['monitor']['distance'])
         self.mon.setSizePix((self.cfg['monitor']['size']))
+        if self.observer is not None:  # simulated sessions draw nothing
+            self.win = None
+            self.stim_pool = None
+            self.timer = None
+            return
         self.win = visual.Window(monitor=self.mon,
                                  unit='deg',
                                  colorSpace=self.ColorSpace,
@@ -85,25 +151,47 @@ class Exp:
                                  allowGUI=True,
                                  fullscr=True,
                                  bpc=(self.depthBits, self.depthBits, self.depthBits), depthBits=self.depthBits)
+        # stimulus objects are created once per session; trials only update colors, positions and text
+        self.stim_pool = self.make_pool()
+        # phases of a trial are presented for fixed numbers of frames
+        self.timer = FrameTimer(self.win)
+
+    def init_colors(self):
+        """
+        Set up what depends on the isoslant of the subject: the realizable hue angles, and the gamut check.
+        """
+        self.hue_list = self.ColorPicker.colorlist_paths(0.2)[0]
+        self.valid_theta = None
+        if self.ColorPicker.lut is None:
+            # realizable hue angles, sorted; the color list is only generated if there is none for its key
+            self.valid_theta = np.round(self.ColorPicker.colorlist(0.2)[0], decimals=1)
+
+        out_of_gamut = self.check_gamut()
+        if out_of_gamut:
+            sys.exit("Colors are out of the display gamut (expected fraction of colors): " + str(out_of_gamut) +
+                     " Please lower the contrast or the noise!")
 
     """stimulus features"""
 
-    def patch_ref(self, theta, pos):  # reference patches
+    def patch_ref(self, color, pos):  # reference patches
         ref = visual.Circle(win=self.win,
                             units='deg',
                             pos=pos,
                             radius=self.cfg['ref_size'],
                             fillColorSpace=self.ColorSpace,
                             lineColorSpace=self.ColorSpace)
-        ref.fillColor = self.ColorPicker.newcolor(theta=theta)[1]
+        ref.fillColor = color
         ref.lineColor = ref.fillColor
         return ref
 
-    def patch_stim(self, xlim, ylim):  # standard and test stimuli
+    def patch_pos(self, xlim, ylim):  # positions of patches in standard and test stimuli
         n = int(np.sqrt(self.patch_nmb))
         pos = [[x, y]
                for x in np.linspace(xlim[0], xlim[1], n)
                for y in np.linspace(ylim[0], ylim[1], n)]
+        return pos
+
+    def patch_stim(self, pos):  # standard and test stimuli
         patch = visual.ElementArrayStim(win=self.win,
                                         units='deg',
                                         fieldSize=self.cfg['field_size'],
@@ -115,16 +203,38 @@ class Exp:
                                         colorSpace=self.ColorSpace)
         return patch
 
+    def make_pool(self):
+        """
+        Create all stimulus objects used in trials, in a dictionary.
+        """
+        horiz_n, vertic_n = self.mask_n
+        mask = visual.ElementArrayStim(self.win, units='norm', nElements=horiz_n * vertic_n, elementMask=None,
+                                       elementTex=None,
+                                       sizes=(2 / horiz_n, 2 / vertic_n), colorSpace=self.ColorSpace)
+        mask.xys = [(x, y) for x in np.linspace(-1, 1, horiz_n, endpoint=False) + 1 / horiz_n
+                    for y in np.linspace(-1, 1, vertic_n, endpoint=False) + 1 / vertic_n]
+        pool = {'ref': self.patch_ref(color=self.Crgb, pos=self.cfg['ref.pos']),
+                'sPatch': self.patch_stim(self.patch_pos(self.cfg['standard.xlim'], self.cfg['standard.ylim'])),
+                'tPatch': self.patch_stim(self.patch_pos(self.cfg['test.xlim'], self.cfg['test.ylim'])),
+                'fix': visual.TextStim(self.win, text="+", units='deg', pos=[0, 0], height=0.5, color='black',
+                                       colorSpace=self.ColorSpace),
+                'num': visual.TextStim(self.win, text="trial 0", units='deg', pos=[12, -10], height=0.4,
+                                       color='black', colorSpace=self.ColorSpace),
+                'pause': visual.TextStim(self.win, text="Enter pause mode. Exit by pressing 'p'", units='deg',
+                                         pos=[12, -8], height=0.4, color='black', colorSpace=self.ColorSpace),
+                'mask': mask}
+        return pool
+
 
     """color noise & noise conditions"""
 
-    def rand_color(self, theta, std, npatch):  # generate color noise
-        noise = np.random.normal(theta, std, npatch)
-        color = [self.ColorPicker.newcolor(theta=n) for n in noise]
-        sml, rgb = zip(*color)
+    def rand_color(self, theta, std, npatch, noise=None):  # generate color noise
+        if noise is None:
+            noise = np.random.normal(0, 1, npatch)  # standard normal samples, can be drawn ahead of time
+        sml, rgb = self.ColorPicker.newcolors(theta + std * np.asarray(noise))
         return sml, rgb
 
-    def choose_con(self, standard, test, std):  # choose noise condition
+    def choose_con(self, standard, test, std, sNoise=None, tNoise=None):  # choose noise condition
         sColor = None
         tColor = None
         if self.param['noise_condition'] == 'L-L':  # low - low noise
@@ -133,227 +243,292 @@ class Exp:
 
         elif self.param['noise_condition'] == 'L-H':  # low - high noise: only test stimulus has high noise
             sColor = self.ColorPicker.newcolor(theta=standard)[1]
-            tColor = self.rand_color(test, std, self.patch_nmb)[1]
+            tColor = self.rand_color(test, std, self.patch_nmb, tNoise)[1]
 
         elif self.param['noise_condition'] == 'H-H':  # high - high noise
-            sColor = self.rand_color(standard, std, self.patch_nmb)[1]
-            tColor = self.rand_color(test, std, self.patch_nmb)[1]
+            sColor = self.rand_color(standard, std, self.patch_nmb, sNoise)[1]
+            tColor = self.rand_color(test, std, self.patch_nmb, tNoise)[1]
 
         else:
             print("No noise condition corresponds to the input!")
 
         return sColor, tColor
 
+    """stimulus generation ahead of time"""
+
+    def gen_stim(self, cond=None, rot=None):
+        """
+        Generate the arrays of one trial without touching the window, so that it can run on a worker thread:
+        random patch positions, noise samples and mask colors; and also the reference and patch colors
+        if the condition and the rotation are given (see set_stim_colors).
+
+        :param cond:    condition of this trial
+        :param rot:     rotation of hue angle of the test stimulus
+        :return:        a dictionary of stimulus arrays
+        """
+        # Randomly assign patch positions: upper (+) or lower (-)
+        patchpos = [self.cfg['standard.ylim'],
+                    self.cfg['test.ylim']]
+        rndpos = patchpos.copy()
+        np.random.shuffle(rndpos)
+
+        stim = {'rndpos': rndpos,
+                'sPos': self.patch_pos(self.cfg['standard.xlim'], rndpos[0]),
+                'tPos': self.patch_pos(self.cfg['test.xlim'], rndpos[1]),
+                'sNoise': np.random.normal(0, 1, self.patch_nmb),
+                'tNoise': np.random.normal(0, 1, self.patch_nmb),
+                'maskColors': self.ColorPicker.newcolors(
+                    np.random.randint(0, high=360, size=self.mask_n[0] * self.mask_n[1]))[1]}
+        if cond is not None:
+            self.set_stim_colors(stim, cond, rot)
+        return stim
+
+    def set_stim_colors(self, stim, cond, rot):
+        """
+        Add the reference and patch colors of a trial to its stimulus arrays.
+
+        :param stim:    stimulus arrays from gen_stim
+        :param cond:    condition of this trial
+        :param rot:     rotation of hue angle of the test stimulus
+        """
+        standard = cond['standard']  # standard should be fixed
+        test = standard + rot
+        stim['refColor'] = self.ColorPicker.newcolor(theta=cond['ref'])[1]
+        stim['sColors'], stim['tColors'] = self.choose_con(standard, test, cond['std'], stim['sNoise'], stim['tNoise'])
+
     """tool fucntion"""
 
+    def check_gamut(self, tol=GAMUT_TOL):
+        """
+        Check before the session that its colors are realizable on the display: the mask colors (all hue angles)
+        and, for every condition, the standard and all test hue angles within the range of the staircase,
+        both with their noise.
+
+        :param tol: expected fraction of out-of-gamut colors which is tolerated
+        :return:    a dictionary of 'mask' or condition labels -> expected fraction of out-of-gamut colors,
+                    only for those above tol
+        """
+        gamut = Gamut(self.ColorPicker)
+        out = {}
+        mask = float(np.max(gamut.fraction_out(np.arange(360))))
+        if mask > tol:
+            out['mask'] = mask
+        noise = self.param['noise_condition']
+        for key, cond in self.param.items():
+            if not key.startswith('stimulus'):
+                continue
+            direction = (-1) ** (cond['label'].endswith('m'))
+            tests = cond['standard'] + direction * np.arange(cond['min_val'], cond['max_val'] + gamut.hue_res,
+                                                             gamut.hue_res)
+            std = cond.get('std', 0)
+            frac = max(np.max(gamut.fraction_out([cond['standard']], std if noise == 'H-H' else 0)),
+                       np.max(gamut.fraction_out(tests % 360, std if noise in ['L-H', 'H-H'] else 0)))
+            if frac > tol:
+                out[cond['label']] = float(frac)
+        return out
+
     def take_closest(self, arr, val):
         """
-        Assumes arr is sorted. Returns closest value to val (could be itself).
+        Assumes arr is sorted. Returns closest value to val (could be itself); val can be a number or an array.
         If two numbers are equally close, return the smallest number.
         """
-        pos = bisect_left(arr, val)
-        if pos == 0:
-            return arr[0]
-        if pos == len(arr):
-            return arr[-1]
+        val = np.asarray(val)
+        pos = np.clip(np.searchsorted(arr, val, side='left'), 1, len(arr) - 1)
         before = arr[pos - 1]
         after = arr[pos]
-        if after - val < val - before:
-            return after
-        else:
-            return before
+        return np.where(after - val < val - before, after, before)
 
-    """main experiment"""
+    def disp_hues(self, standard, test):
+        """
+        Hue angles truly displayed for the standard and the test, read from the hue lookup table if it is in use.
+        """
+        if self.ColorPicker.lut is not None:
+            return self.ColorPicker.lut.realizable([standard, test])
+        return self.take_closest(self.valid_theta, [standard, test])
+
+    def disp_intensity(self, standard, rot):
+        """
+        Hue difference truly displayed for a test rotated from the standard.
 
-    def run_trial(self, rot, cond, count):
+        :param standard:    hue angle of the standard
+        :param rot:         calculated rotation of the test
+        :return:            displayed hue difference
+        """
+        stair_test = standard + rot  # calculated test hue for this trial
+        if stair_test < 0:
+            stair_test += 360
+        # actual displayed standard and test hue for this trial
+        disp_standard, disp_test = self.disp_hues(standard, stair_test)
 
-        ref = self.patch_ref(theta=cond['ref'],
-                             pos=self.cfg['ref.pos'])
+        disp_intensity = disp_test - disp_standard  # actual displayed hue difference
+        if disp_intensity > 300:
+            disp_intensity = (disp_test + disp_standard) - 360
+        return disp_intensity
 
-        # Randomly assign patch positions: upper (+) or lower (-)
-        patchpos = [self.cfg['standard.ylim'],
-                    self.cfg['test.ylim']]
-        rndpos = patchpos.copy()
-        np.random.shuffle(rndpos)
+    """main experiment"""
+
+    def set_trial(self, stim, count):
+        """
+        Update the pooled stimulus objects with the arrays of one trial.
+
+        :param stim:    stimulus arrays from gen_stim, including colors
+        :param count:   count of this trial
+        :return:        reference, standard patch, test patch, fixation cross and trial number
+        """
+        ref = self.stim_pool['ref']
+        ref.fillColor = stim['refColor']
+        ref.lineColor = ref.fillColor
 
-        sPatch = self.patch_stim(self.cfg['standard.xlim'], rndpos[0])
-        tPatch = self.patch_stim(self.cfg['test.xlim'], rndpos[1])
+        sPatch = self.stim_pool['sPatch']
+        tPatch = self.stim_pool['tPatch']
+        sPatch.xys, tPatch.xys = stim['sPos'], stim['tPos']
 
         # Set colors of two stimuli
-        standard = cond['standard']  # standard should be fixed
-        test = standard + rot
-        sPatch.colors, tPatch.colors = self.choose_con(standard, test, cond['std'])
+        sPatch.colors, tPatch.colors = stim['sColors'], stim['tColors']
 
         # Fixation cross & Number of trial
-        fix = visual.TextStim(self.win, text="+", units='deg', pos=[0, 0], height=0.5, color='black',
-                              colorSpace=self.ColorSpace)
-        num = visual.TextStim(self.win, text="trial " + str(count), units='deg', pos=[12, -10], height=0.4,
-                              color='black', colorSpace=self.ColorSpace)
+        fix = self.stim_pool['fix']
+        num = self.stim_pool['num']
+        num.text = "trial " + str(count)
+        return ref, sPatch, tPatch, fix, num
 
-        trial_time_start = time.time()
+    def run_trial(self, rot, cond, count, stim=None):
 
-        # Present the standard and the test stimuli together with the reference
-        fix.draw()
-        num.draw()
-        ref.draw()
-        sPatch.draw()
-        tPatch.draw()
-        self.win.flip()
+        # A simulated observer answers the displayed hue difference at once, nothing is drawn
+        if self.observer is not None:
+            judge, react_time = self.observer.respond(abs(self.disp_intensity(cond['standard'], rot)), cond)
+            return judge, react_time, time.time(), 0
+
+        # Stimulus arrays are usually prepared ahead of time; only the colors may be left for this trial
+        if stim is None:
+            stim = self.gen_stim(cond, rot)
+        elif 'sColors' not in stim:
+            self.set_stim_colors(stim, cond, rot)
+        rndpos = stim['rndpos']
+
+        ref, sPatch, tPatch, fix, num = self.set_trial(stim, count)
+
+        trial_time_start = time.time()
+        self.timer.start_trial()
 
         judge = None
         react_time_stop = -1
-        react_time_start = time.time()
-
-        # Allow entering a pause mode by pressing 'p', either response or exit is possible in pause mode
-        pre_start = time.time()
-        mode_keys = event.waitKeys(maxWait=self.trial_dur)
-        if mode_keys is not None:
-            press_start = time.time()
-            if 'p' in mode_keys:
-                react_time_start = time.time()
-                enter_text = visual.TextStim(self.win, text="Enter pause mode. Exit by pressing 'p'", units='deg',
-                                             pos=[12, -8], height=0.4,
-                                             color='black', colorSpace=self.ColorSpace)
-                enter_text.draw()
-                fix.draw()
-                num.draw()
-                ref.draw()
-                sPatch.draw()
-                tPatch.draw()
-                self.win.flip()
-                for wait_keys in event.waitKeys():
-                    if (wait_keys == 'up' and rndpos[1][0] > 0) or (
-                            wait_keys == 'down' and rndpos[1][0] < 0):
-                        judge = 1  # correct
-                        react_time_stop = time.time()
-                    elif (wait_keys == 'up' and rndpos[1][0] < 0) or (
-                            wait_keys == 'down' and rndpos[1][0] > 0):
-                        judge = 0  # incorrect
-                        react_time_stop = time.time()
-                    elif wait_keys == 'escape':
-                        config_tools.write_xrl(self.subject, break_info='userbreak')
-                        core.quit()
-                    elif wait_keys == 'p':
-                        exit_text = visual.TextStim(self.win, text="Exit pause mode.", units='deg', pos=[12, -8],
-                                                    height=0.4, color='black', colorSpace=self.ColorSpace)
-                        exit_text.draw()
-                        fix.draw()
-                        num.draw()
-                        self.win.flip()
-            else:  # keep presenting if other keys are pressed by accident
-                core.wait(self.trial_dur - (press_start - pre_start))
+
+        # Present the standard and the test stimuli together with the reference for a fixed number of frames;
+        # allow entering a pause mode by pressing 'p', either response or exit is possible in pause mode
+        react_time_start, pause_key = self.timer.present([fix, num, ref, sPatch, tPatch], self.trial_dur,
+                                                         keys=['p'])
+        if pause_key is not None:
+            react_time_start = pause_key[1]
+            enter_text = self.stim_pool['pause']
+            enter_text.text = "Enter pause mode. Exit by pressing 'p'"
+            enter_text.draw()
+            fix.draw()
+            num.draw()
+            ref.draw()
+            sPatch.draw()
+            tPatch.draw()
+            self.win.flip()
+            for wait_keys, key_time in event.waitKeys(timeStamped=self.timer.clock):
+                if (wait_keys == 'up' and rndpos[1][0] > 0) or (
+                        wait_keys == 'down' and rndpos[1][0] < 0):
+                    judge = 1  # correct
+                    react_time_stop = key_time
+                elif (wait_keys == 'up' and rndpos[1][0] < 0) or (
+                        wait_keys == 'down' and rndpos[1][0] > 0):
+                    judge = 0  # incorrect
+                    react_time_stop = key_time
+                elif wait_keys == 'escape':
+                    config_tools.write_xrl(self.subject, break_info='userbreak', dir_path=self.log_dir)
+                    core.quit()
+                elif wait_keys == 'p':
+                    exit_text = self.stim_pool['pause']
+                    exit_text.text = "Exit pause mode."
+                    exit_text.draw()
+                    fix.draw()
+                    num.draw()
+                    self.win.flip()
+            self.timer.interrupt()  # the pause is not a dropped frame
+        else:  # keys pressed by accident during the presentation are ignored
+            event.clearEvents('keyboard')
 
         # Refresh and show a colored checkerboard mask for 0.5 sec
         mask_dur = 0.5
-        horiz_n = 30
-        vertic_n = 20
-        rect = visual.ElementArrayStim(self.win, units='norm', nElements=horiz_n * vertic_n, elementMask=None,
-                                       elementTex=None,
-                                       sizes=(2 / horiz_n, 2 / vertic_n), colorSpace=self.ColorSpace)
-        rect.xys = [(x, y) for x in np.linspace(-1, 1, horiz_n, endpoint=False) + 1 / horiz_n
-                    for y in np.linspace(-1, 1, vertic_n, endpoint=False) + 1 / vertic_n]
-
-        rect.colors = [self.ColorPicker.newcolor(theta=x)[1] for x in
-                       np.random.randint(0, high=360, size=horiz_n * vertic_n)]
-        rect.draw()
-        self.win.flip()
-        core.wait(mask_dur)
+        rect = self.stim_pool['mask']
+        rect.colors = stim['maskColors']
+        self.timer.present([rect], mask_dur)
 
         # If response is given during the mask
         if judge is None:
-            kb = keyboard.Keyboard()
-            get_keys = kb.getKeys(['up', 'down', 'escape'])  # if response during the checkerboard
-            if ('up' in get_keys and rndpos[1][0] > 0) or ('down' in get_keys and rndpos[1][0] < 0):
+            get_keys = event.getKeys(keyList=['up', 'down', 'escape'], timeStamped=self.timer.clock)
+            keys = [key for key, key_time in get_keys]
+            if ('up' in keys and rndpos[1][0] > 0) or ('down' in keys and rndpos[1][0] < 0):
                 judge = 1  # correct
-                react_time_stop = time.time()
-            elif ('up' in get_keys and rndpos[1][0] < 0) or ('down' in get_keys and rndpos[1][0] > 0):
+                react_time_stop = get_keys[0][1]
+            elif ('up' in keys and rndpos[1][0] < 0) or ('down' in keys and rndpos[1][0] > 0):
                 judge = 0  # incorrect
-                react_time_stop = time.time()
-            if 'escape' in get_keys:
-                config_tools.write_xrl(self.subject, break_info='userbreak')
+                react_time_stop = get_keys[0][1]
+            if 'escape' in keys:
+                config_tools.write_xrl(self.subject, break_info='userbreak', dir_path=self.log_dir)
                 core.quit()
 
         # Refresh and wait for response (if no response was given in the pause mode or during mask)
-        self.win.flip()
+        self.timer.flip()  # end of the mask, the last frame counted for dropped frames
         fix.draw()
         self.win.flip()
 
         if judge is None:  # if no response in the pause mode
-            for wait_keys in event.waitKeys(keyList=['up', 'down', 'escape']):
+            for wait_keys, key_time in event.waitKeys(keyList=['up', 'down', 'escape'], timeStamped=self.timer.clock):
                 if (wait_keys == 'up' and rndpos[1][0] > 0) or (
                         wait_keys == 'down' and rndpos[1][0] < 0):
                     judge = 1  # correct
-                    react_time_stop = time.time()
+                    react_time_stop = key_time
                 elif (wait_keys == 'up' and rndpos[1][0] < 0) or (
                         wait_keys == 'down' and rndpos[1][0] > 0):
                     judge = 0  # incorrect
-                    react_time_stop = time.time()
+                    react_time_stop = key_time
                 elif wait_keys == 'escape':
-                    config_tools.write_xrl(self.subject, break_info='userbreak')
+                    config_tools.write_xrl(self.subject, break_info='userbreak', dir_path=self.log_dir)
                     core.quit()
 
         react_time = react_time_stop - react_time_start - self.trial_dur
 
-        return judge, react_time, trial_time_start
+        return judge, react_time, trial_time_start, self.timer.dropped
 
     def run_session(self):
 
-        path = os.path.join(self.res_dir, self.subject)
+        path = self.log_dir
         if not os.path.exists(path):
             os.makedirs(path)
-        psydat_path = os.path.join(path, 'psydat')
-        if not os.path.exists(psydat_path):
-            os.makedirs(psydat_path)
 
         # welcome
-        msg = visual.TextStim(self.win, 'Welcome!' + '\n' + ' Press any key to start this session :)', color='black',
-                              units='deg',
-                              pos=(0, 0), height=0.8)
-        msg.draw()
-        self.win.mouseVisible = False
-        self.win.flip()
-        event.waitKeys()
+        if self.observer is None:
+            msg = visual.TextStim(self.win, 'Welcome!' + '\n' + ' Press any key to start this session :)',
+                                  color='black', units='deg', pos=(0, 0), height=0.8)
+            msg.draw()
+            self.win.mouseVisible = False
+            self.win.flip()
+            event.waitKeys()
+
+        # the isoslant may have been refitted since the session was prepared
+        if self.ColorPicker.refresh_isoslant():
+            self.init_colors()
 
         # read staircase parameters
         conditions = [dict({'stimulus': key}, **value) for key, value in self.param.items() if
                       key.startswith('stimulus')]
 
-        if conditions[0]['stairType'] == 'simple':
-            stairs = data.MultiStairHandler(stairType='simple', conditions=conditions, nTrials=self.trial_nmb,
-                                            method='sequential')
-        elif conditions[0]['stairType'] == 'quest':
-            stairs = []
-            for cond in conditions:
-                if self.priors_file_path:
-                    prior_file = self.priors_file_path + cond['label'] + '.psydat'
-                    print(prior_file)
-                    prior_handler = misc.fromFile(prior_file)
-                else:
-                    prior_handler = None
-                cur_handler = data.QuestHandler(cond['startVal'], cond['startValSd'], pThreshold=cond['pThreshold'],
-                                                nTrials=self.trial_nmb, minVal=cond['min_val'], maxVal=cond['max_val'],
-                                                staircase=prior_handler, extraInfo=cond, grain=0.02)
-                stairs.append(cur_handler)
-        elif conditions[0]['stairType'] == 'psi':
-            stairs = []
-            for cond in conditions:
-                if self.priors_file_path:
-                    prior_file = self.priors_file_path + cond['label'] + '.npy'
-                else:
-                    prior_file = None
-                print(prior_file)
-                cur_handler = data.PsiHandler(nTrials=self.trial_nmb, intensRange=[1, 10], alphaRange=[1, 10],
-                                              betaRange=[0.01, 10], intensPrecision=0.1, alphaPrecision=0.1,
-                                              betaPrecision=0.01, delta=0.01, extraInfo=cond,
-                                              prior=prior_file, fromFile=(prior_file is not None))
-                stairs.append(cur_handler)
+        stairs = make_stairs(conditions, self.trial_nmb, self.priors_file_path)
 
         # write configuration files
-        xpp = config_tools.WriteXpp(self.subject, self.idx)
-        xpp_file = xpp.head(self.cfg_file, self.par_file)
-        config_tools.write_xrl(self.subject, cfg_file=self.cfg_file, par_file=self.par_file, xpp_file=xpp_file)
+        xpp = config_tools.WriteXpp(self.subject, self.idx, dir_path=path)
+        xpp_file = xpp.head(self.cfg_file, self.par_file, None if self.timer is None else self.timer.frame_rate,
+                            self.ColorPicker.calib_id, self.ColorPicker.calib_hash)
+        config_tools.write_xrl(self.subject, cfg_file=self.cfg_file, par_file=self.par_file, xpp_file=xpp_file,
+                               dir_path=path)
 
         xlsname = path + '/' + self.idx + self.param['noise_condition'] + '.xlsx'
+        self.xlsname = xlsname
 
         """ running staircase """
 
@@ -361,36 +536,40 @@ class Exp:
             # Not in use currently. Need test before use.
             # Start running the staircase using the MultiStairHandler for the up-down method
             count = 0
+            # positions, noise samples and masks do not depend on the staircase, so prepare them ahead of time
+            stim_queue = StimQueue(self.gen_stim, itertools.repeat(())) if self.observer is None else None
 
             for rot, cond in stairs:
                 count += 1
                 direction = (-1) ** (cond['label'].endswith('m'))  # direction as -1 if for minus stim
                 rot = rot * direction  # rotation for this trial
-                judge, react_time, trial_time_start = self.run_trial(rot, cond, count)
+                judge, react_time, trial_time_start, dropped_frames = self.run_trial(
+                    rot, cond, count, None if stim_queue is None else stim_queue.get())
 
                 # check whether the theta is valid - if not, the rotation given by staircase should be corrected by
                 # realizable values
-                valid_theta = np.round(np.load(self.hue_list), decimals=1)
-
-                disp_standard = self.take_closest(valid_theta, cond['standard'])  # theta actually displayed
                 stair_test = cond['standard'] + stairs._nextIntensity * direction
                 if stair_test < 0:
                     stair_test += 360
-                disp_test = self.take_closest(valid_theta, stair_test)
+                disp_standard, disp_test = self.disp_hues(cond['standard'], stair_test)  # theta actually displayed
                 disp_intensity = disp_test - disp_standard
                 if disp_intensity > 300:
                     disp_intensity = (disp_test + disp_standard) - 360
                 stairs.addResponse(judge, abs(disp_intensity))
 
-                xpp.task(count, cond, rot, float(disp_intensity), judge, react_time, trial_time_start)
+                xpp.task(count, cond, rot, float(disp_intensity), judge, react_time, trial_time_start, dropped_frames)
 
-                if 'escape' in event.waitKeys():
-                    config_tools.write_xrl(self.subject, break_info='userbreak')
+                if self.observer is None and 'escape' in event.waitKeys():
+                    config_tools.write_xrl(self.subject, break_info='userbreak', dir_path=self.log_dir)
                     core.quit()
+            if stim_queue is not None:
+                stim_queue.stop()
 
-            config_tools.write_xrl(self.subject, xls_file=xlsname)
+            xpp.close()
+            config_tools.write_xrl(self.subject, xls_file=xlsname, dir_path=path)
             stairs.saveAsExcel(xlsname)  # save results
-            misc.toFile(os.path.join(psydat_path, self.idx + self.param['noise_condition'] + '.psydat'), stairs)
+            datastore.store_xlsx(xlsname)  # for analysis, alongside the xlsx
+            posteriors.save_session(posteriors.store_path(xlsname), datastore.session_key(xlsname), stairs)
 
         elif isinstance(stairs, list):
             # QUEST is in use currently.
@@ -402,59 +581,68 @@ class Exp:
             estimates = {s.extraInfo['label']: [] for s in stairs}
 
             # Set the first few trials as warm-up
-            warmup_n = 5
-            warmup = np.random.default_rng().choice(range(2, 10), warmup_n, replace=False)
+            warmup_n = WARMUP_N
+            rng = np.random.default_rng() if self.observer is None else self.observer.rng
+            warmup = rng.choice(range(2, 10), warmup_n, replace=False)
+
+            # positions, noise samples and masks do not depend on the staircase, so prepare them ahead of time
+            stim_queue = None
+            if self.observer is None:
+                stim_queue = StimQueue(self.gen_stim, itertools.repeat((), self.trial_nmb * len(stairs)))
+
+            def stair_rot(trial_n, handler_idx):
+                """
+                Rotation of a trial of a staircase: a warm-up rotation, or the next intensity of the staircase,
+                moved by 0.5 if the last 3 trials had the same intensity and response.
+                It only depends on this staircase, so it can be computed for the next trial before the current one.
+                """
+                handler = stairs[handler_idx]
+                direction = (-1) ** (handler.extraInfo['label'].endswith('m'))  # direction as -1 if for minus stim
+                if trial_n < warmup_n:
+                    return warmup[trial_n] * direction
+                rot = handler._nextIntensity * direction
+                if trial_n >= 5 + warmup_n:  # avoid repeating an intensity more than 3 times
+                    last_rots = [np.round(r, decimals=1) for r in rot_all_disp[handler_idx][-3:]]
+                    last_resp = judge_all[handler_idx][-3:]
+                    if last_rots[0] == last_rots[1] == last_rots[2] and last_resp[0] == last_resp[1] == last_resp[2]:
+                        if handler._nextIntensity > 0.5:
+                            rot = (handler._nextIntensity - 0.5) * direction
+                        else:
+                            rot = (handler._nextIntensity + 0.5) * direction
+                return rot
+
+            # the colors of the next trial are prepared while the current one is presented and answered
+            look_ahead = None if stim_queue is None else LookAhead(stim_queue, self.set_stim_colors)
 
             for trial_n in range(self.trial_nmb):
                 for handler_idx, cur_handler in enumerate(stairs):
                     count += 1
-                    # Set direction as -1 if for minus stimlus
-                    direction = (-1) ** (
-                        cur_handler.extraInfo['label'].endswith('m'))
 
                     # Generate stimulus hue angles, run a trial, and get response measurements
                     # The first warm-up trials are only recorded in xpp but not in xlsx or QUEST stairs.
-                    if trial_n < warmup_n:
-                        rot = warmup[trial_n] * direction
-                    # Run staircase after the warm-up
-                    else:
-                        if cur_handler._nextIntensity >= 10.0:
-                            sys.exit("Hue difference is out of range! Please enlarge the testing range or take more training!")
-
-                        rot = cur_handler._nextIntensity * direction  # rotation for this trial
-                        if trial_n >= 5 + warmup_n:  # avoid repeating an intensity more than 3 times
-                            last_rots = [np.round(r, decimals=1) for r in
-                                         [rot_all_disp[handler_idx][trial_n + warmup_n - 1],
-                                          rot_all_disp[handler_idx][trial_n + warmup_n - 2],
-                                          rot_all_disp[handler_idx][trial_n + warmup_n - 3]]]
-                            last_resp = [judge_all[handler_idx][trial_n + warmup_n - 1],
-                                         judge_all[handler_idx][trial_n + warmup_n - 2],
-                                         judge_all[handler_idx][trial_n + warmup_n - 3]]
-                            if last_rots[0] == last_rots[1] == last_rots[2] \
-                                    and last_resp[0] == last_resp[1] == last_resp[2]:
-                                if cur_handler._nextIntensity > 0.5:
-                                    rot = (cur_handler._nextIntensity - 0.5) * direction
-                                    print('Intensity decreases by 0.5!')
-                                if cur_handler._nextIntensity <= 0.5:
-                                    rot = (cur_handler._nextIntensity + 0.5) * direction
-                                    print('Intensity increases by 0.5!')
+                    if trial_n >= warmup_n and cur_handler._nextIntensity >= 10.0:
+                        sys.exit("Hue difference is out of range! Please enlarge the testing range or take more training!")
+                    rot = stair_rot(trial_n, handler_idx)  # rotation for this trial
+                    if trial_n >= warmup_n and abs(rot) != cur_handler._nextIntensity:
+                        print('Intensity %s by 0.5!' % ('decreases' if abs(rot) < cur_handler._nextIntensity
+                                                        else 'increases'))
                     cond = cur_handler.extraInfo
-                    judge, react_time, trial_time_start = self.run_trial(rot, cond, count)
 
-                    # Check whether the stimuli are truly displayed in the given monitor resolution
-                    valid_theta = np.round(np.load(self.hue_list), decimals=1)
-                    disp_standard = self.take_closest(valid_theta, cond['standard'])
-                    stair_test = cond['standard'] + rot  # calculated test hue for this trial
-                    if stair_test < 0:
-                        stair_test += 360
-                    disp_test = self.take_closest(valid_theta, stair_test)  # actual displayed test hue for this trial
+                    stim = None
+                    if look_ahead is not None:
+                        stim = look_ahead.get((handler_idx, len(cur_handler.data)), cond, rot)
+                        next_idx = (handler_idx + 1) % len(stairs)
+                        next_n = trial_n + (next_idx == 0)
+                        if next_n < self.trial_nmb:
+                            look_ahead.prefetch((next_idx, len(stairs[next_idx].data)), stairs[next_idx].extraInfo,
+                                                stair_rot(next_n, next_idx))
+                    judge, react_time, trial_time_start, dropped_frames = self.run_trial(rot, cond, count, stim)
 
-                    disp_intensity = disp_test - disp_standard  # actual displayed hue difference
-                    if disp_intensity > 300:
-                        disp_intensity = (disp_test + disp_standard) - 360
+                    # Check whether the stimuli are truly displayed in the given monitor resolution
+                    disp_intensity = self.disp_intensity(cond['standard'], rot)
 
                     # Write to xpp
-                    xpp.task(count, cond, rot, disp_intensity, judge, react_time, trial_time_start)
+                    xpp.task(count, cond, rot, disp_intensity, judge, react_time, trial_time_start, dropped_frames)
 
                     # Add stimuli and responses to the staircase
                     if trial_n >= warmup_n:
@@ -474,7 +662,7 @@ class Exp:
                         if isinstance(cur_handler, data.PsiHandler):
                             estimates[cur_handler.extraInfo['label']].append(
                                 [cur_handler.estimateLambda()[0],  # location
-                                 cur_handler.estimateLambda768()[1],  # slope
+                                 cur_handler.estimateLambda()[1],  # slope
                                  cur_handler.estimateThreshold(0.75)])
                         elif isinstance(cur_handler, data.QuestHandler):
                             estimates[cur_handler.extraInfo['label']].append(
@@ -482,11 +670,15 @@ class Exp:
                                  cur_handler.mode(),
                                  cur_handler.quantile(0.5)])
 
-                    if 'escape' in event.waitKeys():
-                        config_tools.write_xrl(self.subject, break_info='userbreak')
+                    if self.observer is None and 'escape' in event.waitKeys():
+                        config_tools.write_xrl(self.subject, break_info='userbreak', dir_path=self.log_dir)
                         core.quit()
+            if look_ahead is not None:
+                look_ahead.stop()
+                stim_queue.stop()
 
-            config_tools.write_xrl(self.subject, xls_file=xlsname)
+            xpp.close()
+            config_tools.write_xrl(self.subject, xls_file=xlsname, dir_path=path)
 
             # Save results in xls-file
             workbook = xlsxwriter.Workbook(xlsname)
@@ -501,6 +693,7 @@ class Exp:
                     worksheet.write('C' + str(i + 2), rot_all_disp[handler_idx][i])
                     worksheet.write('D' + str(i + 2), judge_all[handler_idx][i])
             workbook.close()
+            datastore.store_xlsx(xlsname)  # for analysis, alongside the xlsx
 
             # Print resulting parameters and estimates for each step
             res_file_path = os.path.join(path, self.idx + '_estimates.csv')
@@ -509,13 +702,8 @@ class Exp:
                 for res_val_id, res_val in enumerate(res_vals):
                     res_writer.writerow([res_stim, res_val_id, res_val[0], res_val[1], res_val[2]])
 
-            # Save each handler into a psydat-file and save posterior into a numpy-file
-            for cur_handler in stairs:
-                file_name = os.path.join(psydat_path,
-                                         self.idx + self.param['noise_condition'] + cur_handler.extraInfo['label'])
-                misc.toFile(file_name + '.psydat', cur_handler)
-                if isinstance(cur_handler, data.PsiHandler):
-                    cur_handler.savePosterior(file_name + '.npy')
+            # Save the posteriors of all handlers, as priors of later sessions
+            posteriors.save_session(posteriors.store_path(xlsname), datastore.session_key(xlsname), stairs)
 
 
 def run_exp(subject, par_file_path=None, cfg_file_path=None, res_dir=None, priors_file_path=None):
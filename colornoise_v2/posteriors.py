@@ -0,0 +1,351 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+
+# python version 3.7.6
+"""
+This module keeps the staircases of all sessions of a subject in one compact file (posteriors.npz), next to the xlsx
+workbooks, instead of pickled handlers (psydat/*.psydat) and Psi posteriors (psydat/*.npy).
+For every session and hue label the file holds plain numpy arrays, no pickles:
+    intensities, responses  - trials given to the staircase (for QUEST the trials of its posterior, which pickled
+                              handlers of sessions do not keep in their intensities)
+    log_pdf                 - QUEST posterior on the grid tGuess + grain * (-dim/2 ... dim/2)
+    posterior               - Psi posterior over (alpha, beta), with its grid alpha and beta
+and the metadata of the session as json ('<session>/meta': labels, parameters and conditions of the staircases).
+Sessions are appended to the file; arrays are read lazily, so loading the prior of a hue only reads its own arrays.
+
+Save the staircases of a session, at the end of the session:
+    save_session(store_path(xls_file), session, stairs)
+Load the prior of a hue, for make_stairs:
+    load_prior(priors_file_path, label)
+Convert the existing psydat files once (unpickling them requires PsychoPy), in Python3.7 or in bash:
+    convert_psydat(data_dir)
+    python3.7 posteriors.py [optional data_dir]
+
+@author: yannansu
+"""
+import os
+import glob
+import json
+import zipfile
+import warnings
+import argparse
+import numpy as np
+
+FORMAT_VERSION = 1
+STORE_NAME = 'posteriors.npz'
+
+
+def store_path(xls_file):
+    """
+    :param xls_file:    data xlsx file path
+    :return:            the posterior file of the directory of this xlsx file
+    """
+    return os.path.join(os.path.dirname(xls_file), STORE_NAME)
+
+
+def _stair_type(handler):
+    """
+    :param handler:     a staircase handler
+    :return:            'quest', 'psi' or 'simple'
+    """
+    if hasattr(handler, '_quest'):
+        return 'quest'
+    if hasattr(handler, '_psi'):
+        return 'psi'
+    return 'simple'
+
+
+def handler_arrays(handler):
+    """
+    :param handler:     a staircase handler: QuestHandler, PsiHandler (of PsychoPy or adaptive) or StairHandler
+    :return:            label, a dictionary of arrays and a dictionary of metadata of this staircase
+    """
+    cond = getattr(handler, 'condition', None) or handler.extraInfo or {}
+    meta = {'stairType': _stair_type(handler), 'extraInfo': cond}
+    if meta['stairType'] == 'quest':
+        quest = handler._quest
+        if hasattr(quest, 'log_pdf'):
+            log_pdf = quest.log_pdf
+        else:
+            with np.errstate(divide='ignore'):
+                log_pdf = np.log(quest.pdf / quest.pdf.max())
+        arrays = {'intensities': quest.intensity, 'responses': quest.response, 'log_pdf': log_pdf}
+        meta.update({k: float(getattr(quest, k)) for k in ['tGuess', 'tGuessSd', 'pThreshold', 'beta', 'delta',
+                                                          'gamma', 'grain']})
+        meta['dim'] = int(quest.dim)
+    elif meta['stairType'] == 'psi':
+        psi = handler._psi
+        if hasattr(psi, 'posterior'):
+            posterior = psi.posterior.reshape(len(psi.alpha), len(psi.beta))
+            intensities, responses = psi.intensity, psi.response
+        else:  # PsiObject of PsychoPy does not keep its trials
+            posterior = psi._probLambda.reshape(len(psi.alpha), len(psi.beta))
+            intensities, responses = handler.intensities, handler.data
+        arrays = {'intensities': intensities, 'responses': responses, 'posterior': posterior, 'x': psi.x,
+                  'alpha': psi.alpha, 'beta': psi.beta}
+        meta.update({'delta': float(psi.delta), 'TwoAFC': bool(psi._TwoAFC)})
+    else:
+        arrays = {'intensities': handler.intensities, 'responses': handler.data}
+    arrays['intensities'] = np.asarray(arrays['intensities'], dtype=float)
+    arrays['responses'] = np.asarray(arrays['responses'], dtype=np.int8)
+    return cond.get('label', handler.name), arrays, meta
+
+
+def _write(path, session, staircases, overwrite=True):
+    """
+    Append the staircases of a session to a posterior file; an earlier copy of this session is replaced.
+
+    :param path:        posterior file path
+    :param session:     session name
+    :param staircases:  a list of (label, arrays, meta) from handler_arrays
+    :param overwrite:   replace the session if it is in the file, otherwise keep it and skip
+    """
+    existing = []
+    _forget(path)
+    if os.path.exists(path):
+        with zipfile.ZipFile(path) as zf:
+            existing = zf.namelist()
+        if session + '/meta.npy' in existing:
+            if not overwrite:
+                return
+            tmp_path = path + '.tmp'
+            with zipfile.ZipFile(path) as src, zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as dst:
+                for name in existing:
+                    if not name.startswith(session + '/'):
+                        dst.writestr(src.getinfo(name), src.read(name))
+            os.replace(tmp_path, path)
+    else:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    members = {} if 'format_version.npy' in existing else {'format_version': np.array(FORMAT_VERSION)}
+    meta = {'format_version': FORMAT_VERSION, 'labels': [], 'staircases': {}}
+    for label, arrays, stair_meta in staircases:
+        meta['labels'].append(label)
+        meta['staircases'][label] = stair_meta
+        for name, array in arrays.items():
+            members['%s/%s/%s' % (session, label, name)] = np.asarray(array)
+    members[session + '/meta'] = np.array(json.dumps(meta))
+    with zipfile.ZipFile(path, 'a', zipfile.ZIP_DEFLATED) as zf:
+        for name, array in members.items():
+            with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, array, allow_pickle=False)
+
+
+def save_session(path, session, stairs, overwrite=True):
+    """
+    Save the staircases of a session.
+
+    :param path:        posterior file path, e.g. store_path(xls_file)
+    :param session:     session name, e.g. '20200916T1708L-L' (see datastore.session_key)
+    :param stairs:      a list of handlers, or a MultiStairHandler
+    :param overwrite:   replace the session if it is in the file
+    """
+    if hasattr(stairs, 'staircases'):
+        stairs = stairs.staircases
+    _write(path, session, [handler_arrays(handler) for handler in stairs], overwrite)
+
+
+class Posterior:
+    def __init__(self, npz, session, label, meta):
+        """
+        The staircase of one hue in one session, read lazily from a posterior file.
+        Its intensities and data can be given to QuestHandler as staircase, like a handler.
+
+        :param npz:     opened posterior file
+        :param session: session name
+        :param label:   hue label
+        :param meta:    metadata of this staircase
+        """
+        self._npz = npz
+        self._key = session + '/' + label + '/'
+        self.label = label
+        self.meta = meta
+        self.stairType = meta['stairType']
+
+    def __getattr__(self, name):
+        if name.startswith('_') or self._key + name not in self._npz.files:
+            raise AttributeError(name)
+        return self._npz[self._key + name]
+
+    @property
+    def data(self):
+        """
+        :return: responses, as in handlers
+        """
+        return self.responses.astype(int).tolist()
+
+    def mean(self):
+        """
+        :return: mean of the QUEST posterior
+        """
+        pdf = np.exp(self.log_pdf)
+        x = (np.arange(len(pdf)) - self.meta['dim'] / 2) * self.meta['grain']
+        return self.meta['tGuess'] + np.sum(pdf * x) / np.sum(pdf)
+
+
+class PosteriorStore:
+    def __init__(self, path):
+        """
+        A posterior file, opened once; arrays are read when they are used.
+
+        :param path:    posterior file path
+        """
+        self.path = path
+        self.npz = np.load(path, allow_pickle=False)
+        version = int(self.npz['format_version'])
+        if version > FORMAT_VERSION:
+            raise ValueError('%s has format version %d, newer than %d!' % (path, version, FORMAT_VERSION))
+        self._meta = {}
+
+    def sessions(self):
+        """
+        :return: names of all sessions in this file
+        """
+        return sorted(name[:-len('/meta')] for name in self.npz.files if name.endswith('/meta'))
+
+    def meta(self, session):
+        """
+        :param session: session name
+        :return:        metadata of this session
+        """
+        if session not in self._meta:
+            self._meta[session] = json.loads(str(self.npz[session + '/meta']))
+        return self._meta[session]
+
+    def load(self, session, label):
+        """
+        :param session: session name
+        :param label:   hue label
+        :return:        Posterior of this hue
+        """
+        return Posterior(self.npz, session, label, self.meta(session)['staircases'][label])
+
+    def close(self):
+        self.npz.close()
+
+
+_STORES = {}  # opened posterior files: absolute path -> ((mtime, size), PosteriorStore)
+
+
+def open_store(path):
+    """
+    Get an opened posterior file of this process; it is opened again if the file has been changed since.
+
+    :param path:    posterior file path
+    :return:        PosteriorStore
+    """
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _STORES.get(os.path.abspath(path))
+    if cached is None or cached[0] != key:
+        _forget(path)
+        _STORES[os.path.abspath(path)] = (key, PosteriorStore(path))
+    return _STORES[os.path.abspath(path)][1]
+
+
+def _forget(path):
+    """
+    Close an opened posterior file and remove it from the opened ones, e.g. before it is written.
+
+    :param path:    posterior file path
+    """
+    cached = _STORES.pop(os.path.abspath(path), None)
+    if cached is not None:
+        cached[1].close()
+
+
+def load_prior(priors_file_path, label):
+    """
+    Load the staircase of an earlier session as the prior of a hue. The session is the base name of
+    priors_file_path, e.g. 'data/ysu/20200916T1708L-L' or, as for psydat files, 'data/ysu/psydat/20200916T1708L-L'.
+    It is read from the posterior file of its directory, or else from its psydat (QUEST) or npy (Psi) files.
+
+    :param priors_file_path:    prefix of the prior files
+    :param label:               hue label
+    :return:                    Posterior with intensities, data and, for Psi, posterior
+    """
+    session_dir, session = os.path.split(priors_file_path)
+    if os.path.basename(session_dir) == 'psydat':
+        session_dir = os.path.dirname(session_dir)
+    path = os.path.join(session_dir, STORE_NAME)
+    if os.path.exists(path):
+        store = open_store(path)
+        if session in store.sessions():
+            return store.load(session, label)
+
+    # files of earlier versions
+    if os.path.exists(priors_file_path + label + '.npy'):
+        posterior = np.load(priors_file_path + label + '.npy', allow_pickle=False)
+        return _converted(label, {'intensities': np.array([]), 'responses': np.array([], dtype=np.int8),
+                                  'posterior': posterior.squeeze()}, {'stairType': 'psi'})
+    from psychopy import misc
+    label, arrays, meta = handler_arrays(misc.fromFile(priors_file_path + label + '.psydat'))
+    return _converted(label, arrays, meta)
+
+
+def _converted(label, arrays, meta):
+    """
+    :return: a Posterior holding arrays in memory
+    """
+    return Posterior(type('Arrays', (dict,), {'files': property(lambda self: list(self))})(
+        {'old/' + label + '/' + k: v for k, v in arrays.items()}), 'old', label, meta)
+
+
+def convert_psydat(data_dir='data', overwrite=False):
+    """
+    Convert all psydat files under a directory into posterior files, one posterior file per subject directory
+    (the parent of each psydat directory). Files which cannot be unpickled are skipped with a warning.
+    The psydat files are kept, they can be removed after the conversion.
+
+    :param data_dir:    data directory, e.g. 'data' or 'data/ysu'
+    :param overwrite:   convert sessions which are already in the posterior files again
+    :return:            number of converted sessions and a list of skipped files
+    """
+    from psychopy import misc
+
+    sessions = {}
+    skipped = []
+    for psydat_file in sorted(glob.glob(os.path.join(data_dir, '**', 'psydat', '*.psydat'), recursive=True)):
+        try:
+            handler = misc.fromFile(psydat_file)
+        except Exception as err:
+            warnings.warn('%s is skipped: %r' % (psydat_file, err))
+            skipped.append(psydat_file)
+            continue
+        name = os.path.splitext(os.path.basename(psydat_file))[0]
+        path = os.path.join(os.path.dirname(os.path.dirname(psydat_file)), STORE_NAME)
+        handlers = handler.staircases if hasattr(handler, 'staircases') else [handler]
+        for handler in handlers:
+            label, arrays, meta = handler_arrays(handler)
+            session = name[:-len(label)] if name.endswith(label) and len(handlers) == 1 else name
+            sessions.setdefault((path, session), []).append((label, arrays, meta))
+
+    stored = {}  # sessions in the posterior files before the conversion
+    for path in set(path for path, session in sessions):
+        stored[path] = set()
+        if not overwrite and os.path.exists(path):
+            store = PosteriorStore(path)
+            stored[path] = set(store.sessions())
+            store.close()
+    count = 0
+    for (path, session), staircases in sorted(sessions.items()):
+        if session in stored[path]:
+            continue
+        _write(path, session, staircases)
+        count += 1
+    return count, skipped
+
+
+"""example"""
+
+# count, skipped = convert_psydat('data')
+# prior = load_prior('data/ysu/20200916T1708L-L', 'hue_1m')
+# prior.intensities, prior.data, prior.mean()
+
+""" convert psydat files in bash """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_dir', nargs='?', default='data')
+    args = parser.parse_args()
+    n_sessions, n_skipped = convert_psydat(args.data_dir)
+    print('{} sessions converted, {} files skipped.'.format(n_sessions, len(n_skipped)))
@@ -27,20 +27,10 @@ def show_colorcircle(subject, contrast, depthBits, numStim):
     theta = np.linspace(0, 2 * np.pi, numStim, endpoint=False)
 
     cp = ColorPicker(c=contrast, sscale=2.6, unit='rad', depthBits=depthBits, subject=None)
-    Msml = []
-    Mrgb = []
-    for t in theta:
-        sml, rgb = cp.newcolor(theta=t)
-        Msml.append(sml)
-        Mrgb.append(rgb)
+    Msml, Mrgb = cp.newcolors(theta)
 
     sub_cp = ColorPicker(c=contrast, sscale=2.6, unit='rad', depthBits=depthBits, subject=subject)
-    sub_Msml = []
-    sub_Mrgb = []
-    for t in theta:
-        sml, rgb = sub_cp.newcolor(theta=t)
-        sub_Msml.append(sml)
-        sub_Mrgb.append(rgb)
+    sub_Msml, sub_Mrgb = sub_cp.newcolors(theta)
 
     winM = visual.Window(fullscr=True, allowGUI=True, bpc=(cp.depthBits, cp.depthBits, cp.depthBits),
                          depthBits=cp.depthBits, colorSpace=cp.colorSpace, color=cp.sml2rgb(cp.center()))
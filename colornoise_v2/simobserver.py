@@ -0,0 +1,181 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+
+# python version 3.7.6
+"""
+This module runs color-noise sessions headless with a simulated observer instead of a subject: nothing is drawn and
+nothing is waited for, the observer answers every trial from a psychometric function. Sessions write the same
+xpp/xrl/xlsx/posterior outputs as real ones, so that staircase settings can be compared before running subjects.
+
+The observer answers correctly with probability
+    0.5 + (0.5 - lapse) * Phi((intensity - centre) / sd)
+where the centre is set by the threshold (75% correct) of each condition, and sd can grow with the noise of the
+condition (sd * (1 + noise_slope * std)).
+
+Simulate in Python3.7:
+    simulate(par_file, SimObserver(threshold=2.0), n_sessions)
+Or in bash:
+    python3.7 simobserver.py [par_file] [n_sessions] [--threshold t] [--sd sd] [--lapse l] [--res_dir dir]
+
+@author: yannansu
+"""
+import os
+import copy
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from FitCumNormal import FitCumNormal
+import config_tools
+import build_colorlists
+
+
+class SimObserver:
+    def __init__(self, threshold=2.0, sd=1.0, lapse=0.02, noise_slope=0.0, react_time=0.6, seed=None):
+        """
+        A simulated observer of the 2AFC color-noise task.
+
+        :param threshold:   hue difference (deg) answered 75% correctly: a number, a dictionary of condition labels,
+                            or a function of the condition (defined at module level, to be used in processes)
+        :param sd:          sd of the cumulative normal (deg) without noise
+        :param lapse:       lapse rate
+        :param noise_slope: increase of sd per unit of the noise std of the condition
+        :param react_time:  reaction time (sec) written in the session log
+        :param seed:        seed of the responses
+        """
+        self.threshold = threshold
+        self.sd = sd
+        self.lapse = lapse
+        self.noise_slope = noise_slope
+        self.react_time = react_time
+        self.rng = np.random.default_rng(seed)
+
+    def reseed(self, seed):
+        """
+        :param seed:    seed of the responses
+        :return:        a copy of this observer with its own random generator
+        """
+        observer = copy.copy(self)
+        observer.rng = np.random.default_rng(seed)
+        return observer
+
+    def params(self, cond):
+        """
+        :param cond:    condition of a trial, from the parameter file
+        :return:        centre and sd of the psychometric function of this condition
+        """
+        if callable(self.threshold):
+            threshold = self.threshold(cond)
+        elif isinstance(self.threshold, dict):
+            threshold = self.threshold[cond['label']]
+        else:
+            threshold = self.threshold
+        sd = self.sd * (1 + self.noise_slope * cond.get('std', 0))
+        centre = threshold - FitCumNormal._inverse(0.75, 0, sd, chance=0.5, lapse=self.lapse)
+        return centre, sd
+
+    def p_correct(self, intensity, cond):
+        """
+        :param intensity:   absolute hue difference of the test (deg)
+        :param cond:        condition of the trial
+        :return:            probability of a correct answer
+        """
+        return FitCumNormal._eval(intensity, *self.params(cond), chance=0.5, lapse=self.lapse)
+
+    def respond(self, intensity, cond):
+        """
+        Answer one trial.
+
+        :param intensity:   absolute hue difference of the test (deg)
+        :param cond:        condition of the trial
+        :return:            judge (1 correct, 0 incorrect) and reaction time
+        """
+        judge = int(self.rng.random() < self.p_correct(intensity, cond))
+        return judge, self.react_time
+
+
+def _simulate_part(args):
+    """
+    Run simulated sessions one after another, in a worker process.
+
+    :return: xlsx files of the finished sessions and the number of broken sessions
+    """
+    from multinoisecolor10bit import Exp  # imports PsychoPy, only in the workers
+
+    subject, par_file, cfg_file, res_dir, observer, seeds, idx = args
+    xls_files = []
+    broken = 0
+    for count, seed in enumerate(seeds):
+        exp = Exp(subject, par_file, cfg_file, res_dir, None, observer=observer.reseed(seed),
+                  idx=idx + 'S%05d' % count)
+        try:
+            exp.run_session()
+            xls_files.append(exp.xlsname)
+        except SystemExit as err:  # e.g. the hue difference is out of range
+            config_tools.write_xrl(subject, break_info='simbreak: ' + str(err), dir_path=exp.log_dir)
+            broken += 1
+    return xls_files, broken
+
+
+def simulate(par_file, observer, n_sessions=1, subject='pseudo', cfg_file='config/expconfig.yaml',
+             res_dir='data_sim', processes=None, seed=0):
+    """
+    Run sessions with a simulated observer, in a pool of processes. Each process writes its sessions into its own
+    directory res_dir/partNN/subject, with its own xrl file; every session has its own seed derived from seed.
+
+    On platforms which spawn processes (Windows, macOS), call it under
+    `if __name__ == '__main__':` in scripts.
+
+    :param par_file:    parameter file of the sessions
+    :param observer:    SimObserver
+    :param n_sessions:  number of sessions
+    :param subject:     subject whose isoslant and hue list are used for the colors; also the name of the results
+    :param cfg_file:    experiment config file
+    :param res_dir:     results directory, apart from the data of subjects
+    :param processes:   number of processes, default: number of CPUs
+    :param seed:        seed of all sessions
+    :return:            xlsx files of the finished sessions, and the number of broken sessions
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, n_sessions))
+    build_colorlists.build_session(par_file, cfg_file, subject)  # once here, not by every process at once
+    seeds = np.random.SeedSequence(seed).spawn(n_sessions)
+    idx = time.strftime("%Y%m%dT%H%M%S", time.localtime())
+    jobs = [(subject, par_file, cfg_file, os.path.join(res_dir, 'part%02d' % part), observer,
+             seeds[part::processes], idx) for part in range(processes)]
+    if processes == 1:
+        results = [_simulate_part(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_simulate_part, jobs))
+    return [f for xls_files, broken in results for f in xls_files], sum(broken for xls_files, broken in results)
+
+
+"""example"""
+
+# hue-dependent thresholds, higher for the minus references
+# labels = ['hue_%d%s' % (n, s) for n in range(1, 9) for s in 'mp']
+# observer = SimObserver(threshold={l: 2.5 if l.endswith('m') else 1.5 for l in labels}, lapse=0.03)
+# xls_files, broken = simulate('config/cn2x8_LL_easy_a.yaml', observer, n_sessions=1000)
+# analyse them with batch_analysis.run_batch('data_sim', 'data_sim_analysis')
+
+""" simulate sessions in bash """
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('par_file')
+    parser.add_argument('n_sessions', nargs='?', type=int, default=1)
+    parser.add_argument('--threshold', type=float, default=2.0)
+    parser.add_argument('--sd', type=float, default=1.0)
+    parser.add_argument('--lapse', type=float, default=0.02)
+    parser.add_argument('--noise_slope', type=float, default=0.0)
+    parser.add_argument('--subject', default='pseudo')
+    parser.add_argument('--cfg_file', default='config/expconfig.yaml')
+    parser.add_argument('--res_dir', default='data_sim')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    sim = SimObserver(args.threshold, args.sd, args.lapse, args.noise_slope)
+    finished, n_broken = simulate(args.par_file, sim, args.n_sessions, args.subject, args.cfg_file, args.res_dir,
+                                  args.processes, args.seed)
+    print('{} sessions finished, {} broken.'.format(len(finished), n_broken))
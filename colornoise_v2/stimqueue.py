@@ -0,0 +1,131 @@
+# !/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+This module prepares trial stimuli ahead of time on a worker thread, so that the render loop only assigns arrays
+and draws.
+
+Main classes:
+    StimQueue   - arrays which do not depend on the staircase (positions, noise samples, mask colors)
+    LookAhead   - colors of the next trial, prepared while the current trial is presented and answered
+
+@author: yannansu
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StimQueue:
+    def __init__(self, make_stim, jobs, maxsize=4):
+        """
+        Run make_stim(*job) for every job on a worker thread and keep the results in a bounded queue.
+        The worker stays at most maxsize trials ahead of the render loop.
+
+        :param make_stim:   function generating the stimulus arrays of one trial, must not touch the window
+        :param jobs:        iterable of argument tuples for make_stim, in trial order; can be endless
+        :param maxsize:     the number of trials prepared ahead
+        """
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.worker = threading.Thread(target=self._work, args=(make_stim, jobs), daemon=True)
+        self.worker.start()
+
+    def _work(self, make_stim, jobs):
+        try:
+            for job in jobs:
+                stim = make_stim(*job)
+                while not self.stopped.is_set():
+                    try:
+                        self.queue.put(stim, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if self.stopped.is_set():
+                    return
+        except Exception as err:  # hand over to the render loop
+            self.queue.put(err)
+            return
+        self.queue.put(StopIteration())
+
+    def get(self):
+        """
+        Take the stimulus of the next trial, waiting for the worker if it is not ready yet.
+
+        :return: the stimulus generated by make_stim
+        """
+        stim = self.queue.get()
+        if isinstance(stim, Exception):
+            self.stopped.set()
+            raise stim
+        return stim
+
+    def stop(self):
+        """
+        Stop the worker, e.g. at the end of a session or after a userbreak.
+        """
+        self.stopped.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.worker.join(timeout=1.0)
+
+
+class LookAhead:
+    def __init__(self, stim_queue, set_colors):
+        """
+        Prepare the stimulus of the next trial, including its colors, on a worker thread while the current trial runs.
+        With interleaved staircases the next trial belongs to another staircase, whose intensity does not depend on
+        the current response; a prepared stimulus is only computed again if its staircase changed in the meantime.
+
+        :param stim_queue:  StimQueue of the arrays which do not depend on the staircase
+        :param set_colors:  function(stim, cond, rot) adding the colors of a trial to its arrays
+        """
+        self.stim_queue = stim_queue
+        self.set_colors = set_colors
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.hits = 0  # prepared stimuli used
+        self.misses = 0  # stimuli computed in the trial
+
+    def prefetch(self, key, cond, rot):
+        """
+        Start preparing the stimulus of the next trial.
+
+        :param key:     state of the staircase of the next trial, e.g. its index and number of responses
+        :param cond:    condition of the next trial
+        :param rot:     rotation of the next trial
+        """
+        stim = self.stim_queue.get()
+        self.pending = (key, rot, stim, self.executor.submit(self.set_colors, stim, cond, rot))
+
+    def get(self, key, cond, rot):
+        """
+        Take the stimulus of this trial: the prepared one if it was prepared for the same state and rotation,
+        otherwise its colors are computed now.
+
+        :param key:     state of the staircase of this trial
+        :param cond:    condition of this trial
+        :param rot:     rotation of this trial
+        :return:        stimulus arrays including colors
+        """
+        if self.pending is None:
+            stim = self.stim_queue.get()
+        else:
+            pending_key, pending_rot, stim, future = self.pending
+            self.pending = None
+            future.result()
+            if pending_key == key and pending_rot == rot:
+                self.hits += 1
+                return stim
+        self.set_colors(stim, cond, rot)
+        self.misses += 1
+        return stim
+
+    def stop(self):
+        """
+        Stop the worker, e.g. at the end of a session.
+        """
+        self.pending = None
+        self.executor.shutdown(wait=True)